@@ -1,15 +1,143 @@
-from flask import Flask, render_template, request, redirect,session,url_for,flash
+from flask import Flask, render_template, request, redirect,session,url_for,flash,g,abort,stream_template,jsonify
+from flask import get_flashed_messages
+import atexit
+import logging
+
+import pymysql
 
 from settings import *
 from db_connections import Connection,RecipeDb
+from cache import LRUCache
+from catalog_snapshot import SharedCatalog
+from write_behind import WriteBehind
+from nutrition import NUTRIENTS
 
-from graphs_drawer import save_user_counts_plot_as_image,plot_top_rated_recipes,plot_most_liked_cuisines
+from trends import TrendsRefresher
+from instrumentation import QueryStats,setup_logging
+from sessions import ServerSideSessionInterface,MemorySessionStore,FileSessionStore
 
 app = Flask(__name__)
 app.secret_key = "super secret key"
-
-conn = Connection(username=USERNAME,password=PASSWORD,host=HOST)
-recipe_db = RecipeDb(dbname=DBNAME,connection=conn)
+app.session_interface = ServerSideSessionInterface(
+    FileSessionStore(SESSION_DIR) if SESSION_STORE == 'file' else MemorySessionStore(),
+    lifetime=SESSION_LIFETIME)
+
+setup_logging(LOG_LEVEL)
+log = logging.getLogger('recipe_hub.app')
+query_stats = QueryStats(slow_query_ms=SLOW_QUERY_MS)
+
+conn = Connection(username=USERNAME,password=PASSWORD,host=HOST,
+                  min_size=POOL_MIN_SIZE,max_size=POOL_MAX_SIZE,timeout=POOL_TIMEOUT,
+                  stats=query_stats)
+recipe_db = RecipeDb(dbname=DBNAME,connection=conn,cache_user_likes=CACHE_USER_LIKES,
+                     cache=LRUCache(max_entries=CACHE_MAX_ENTRIES,ttl=CACHE_TTL),
+                     snapshot=SharedCatalog(CATALOG_SNAPSHOT_DIR,SNAPSHOT_CHECK_INTERVAL) if CATALOG_SNAPSHOT_DIR else None)
+# rendered template fragments, keys start with the catalog version (see cached_fragment)
+fragments = LRUCache(max_entries=FRAGMENT_CACHE_ENTRIES,ttl=CACHE_TTL)
+trends_refresher = TrendsRefresher(recipe_db,static_dir=app.static_folder,interval=TRENDS_REFRESH_INTERVAL)
+if WRITE_BEHIND:
+    recipe_db.write_behind = WriteBehind(recipe_db.apply_writes,max_pending=WRITE_BEHIND_MAX_PENDING,
+                                         batch_size=WRITE_BEHIND_BATCH_SIZE,interval=WRITE_BEHIND_INTERVAL,
+                                         journal_dir=WRITE_BEHIND_JOURNAL_DIR,fsync=WRITE_BEHIND_FSYNC)
+    atexit.register(recipe_db.write_behind.stop)
+
+
+# endpoints served without a database connection, autocomplete only queries
+# to build its in-memory index
+NO_DB_ENDPOINTS = {'static','debug_queries','autocomplete'}
+
+@app.before_request
+def checkout_connection():
+    if request.endpoint in NO_DB_ENDPOINTS:
+        return
+    query_stats.begin_request()
+    try:
+        conn.begin_request()
+    except pymysql.Error as e: # pool exhausted (PoolTimeout) or database unreachable
+        return f"<h1>{e.args[-1]}</h1>", 503
+
+    # the session only holds the user id, the user row comes from the shared cache
+    g.user = recipe_db.get_user(session['user_id']) if session.get('user_id') else None
+    if session.get('user_id') and not g.user:
+        session.pop('user_id')
+
+@app.after_request
+def add_timing_headers(response):
+    queries,db_ms,elapsed_ms = query_stats.request_totals()
+    if request.endpoint not in NO_DB_ENDPOINTS:
+        response.headers['X-DB-Queries'] = str(queries)
+        response.headers['Server-Timing'] = f'db;dur={db_ms:.1f};desc="{queries} queries", app;dur={elapsed_ms:.1f}'
+    return response
+
+@app.after_request
+def add_validators(response):
+    # a page that showed a flash message must not be revalidated, the message is gone
+    etag = g.get('etag')
+    if etag and response.status_code == 200 and not session.get('_flashes') and not get_flashed_messages():
+        set_validators(response,etag,g.last_modified)
+    return response
+
+def set_validators(response,etag: str,last_modified: float):
+    response.set_etag(etag)
+    response.last_modified = int(last_modified)
+    # pages show the signed in user, so only the browser may keep them, and must revalidate
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+
+def not_modified(*keys):
+    '''
+        Tags the page with an ETag and Last-Modified made of the versions of the
+        data it shows (see RecipeDb.versions), plus the catalog's and the signed
+        in user's. Views call it before loading anything.
+        Returns:
+            a 304 response when the browser's copy is current, else None
+    '''
+    if session.get('_flashes'):
+        return None
+    user_id = g.user['user_id'] if g.user else None
+    g.etag,g.last_modified = recipe_db.versions.tag(('catalog',),('user',user_id),*keys)
+    if request.if_none_match:
+        current = request.if_none_match.contains(g.etag)
+    else:
+        since = request.if_modified_since
+        current = since is not None and int(g.last_modified) <= since.timestamp()
+    if not current:
+        return None
+    response = app.response_class(status=304)
+    set_validators(response,g.etag,g.last_modified)
+    return response
+
+@app.teardown_request
+def return_connection(exception=None):
+    conn.end_request()
+    # streamed responses end here, after their last query
+    query_stats.end_request(request.endpoint or 'unknown')
+
+@app.route("/debug/queries")
+def debug_queries():
+    # statements and timings reveal the schema, so the endpoint is opt-in
+    if not DEBUG_QUERIES_ENDPOINT:
+        abort(404)
+    if request.args.get('reset') == '1':
+        query_stats.reset()
+    return jsonify(query_stats.snapshot())
+
+@app.template_global()
+def cached_fragment(key: tuple,render,*args):
+    '''
+        Renders a macro once per catalog version and key, e.g.
+        {{ cached_fragment(('steps',recipe['recipe_name']),recipe_steps,recipe) }}.
+        The key must hold everything else the fragment depends on.
+    '''
+    key = (recipe_db.versions.get(('catalog',)),) + tuple(key)
+    return fragments.get_or_load(key,lambda: render(*args))
+
+@app.context_processor
+def inject_shared_lookups():
+    return {
+        'current_user': g.get('user'),
+        'cuisines': recipe_db.get_cuisine_names(),
+    }
 
 
 
@@ -18,53 +146,53 @@ recipe_db = RecipeDb(dbname=DBNAME,connection=conn)
 
 @app.route("/")
 def home_page(recipes = None):
-    if 'user' not in session:
-        session['user'] = None
-   
-    if 'cuisines' not in session:
-        session['cuisines'] = recipe_db.get_cuisine_names()
-        
-        
     session['page'] = 'Home'
+    # like counts and recommendations move with every like
+    unchanged = not_modified(('activity',))
+    if unchanged:
+        return unchanged
     if not recipes:
          recipes = recipe_db.get_top_recipes()
     if conn.error:
             flash(conn.error_message)
     
-    if session['user']:
-        user_id = session['user']['user_id']
-        for recipe in recipes:
-            recipe['user_liked_recipe'] = recipe_db.did_user_liked_recipe(
-                user_id,recipe['recipe_name'])
+    recommended = []
+    if g.user:
+        user_id = g.user['user_id']
+        recommended = recipe_db.get_recommended_recipes(user_id)
+        liked = recipe_db.get_liked_recipes(user_id,[recipe['recipe_name'] for recipe in recipes+recommended])
+        for recipe in recipes+recommended:
+            recipe['user_liked_recipe'] = recipe['recipe_name'] in liked
      
     return render_template(
         "home.html",
         recipes = recipes,
+        recommended = recommended,
         categories = recipe_db.get_all_recipe_categories()
     )
 
 
-@app.route('/like_recipe',methods=['GET'])
-def like_recipe():
-    recipe_name = session['recipe']['recipe_name']
-    user_id = session['user']['user_id']
-    recipe_db.toggle_like_recipe(user_id,recipe_name)
+@app.route('/like_recipe/<recipe_name>',methods=['GET'])
+def like_recipe(recipe_name):
+    if g.user:
+        recipe_db.toggle_like_recipe(g.user['user_id'],recipe_name)
 
-    return redirect(url_for("recipe",recipe_name=session['recipe']['recipe_name']))
+    return redirect(url_for("recipe",recipe_name=recipe_name))
 
 @app.route('/recipe/<recipe_name>')
 def recipe(recipe_name):
-    recipe = recipe_db.get_recipe_page_details(recipe_name)
-    session['recipe'] = recipe
-    ingredients = {}
-    for ingredient in recipe['ingredients']:
-        ing = ingredient['ingredient_name']
-        ingredients[ing] = recipe_db.get_ingredient_details(ing)
+    unchanged = not_modified(('recipe',recipe_name.casefold()))
+    if unchanged:
+        return unchanged
+    recipe = recipe_db.get_recipe_page(recipe_name)
+    if not recipe:
+        abort(404)
+    ingredients = recipe['ingredient_details']
     
     reviews = recipe_db.get_all_reviews_of_recipe(recipe_name)
 
-    if session['user']:
-        user_id = user_id = session['user']['user_id']
+    if g.user:
+        user_id = g.user['user_id']
         user_review = recipe_db.get_user_review_of_recipe(user_id,recipe_name)
         
         user_liked_recipe = recipe_db.did_user_liked_recipe(user_id,recipe_name)
@@ -76,7 +204,11 @@ def recipe(recipe_name):
     session['page'] = 'Recipe'
     return render_template('recipe.html', recipe=recipe,
                            ingredients = ingredients,
+                           nutrition = recipe_db.get_recipe_nutrition(recipe['recipe_name']),
                            reviews=reviews,
+                           # the reviews render the same for everyone but their author
+                           reviewer = user_id if g.user and user_review else None,
+                           reviews_key = tuple(tuple(review.values()) for review in reviews),
                            user_review = user_review,
                            user_liked_recipe = user_liked_recipe)
 
@@ -96,7 +228,7 @@ def login():
                 return render_template(
                     "login_page.html",
                 )
-            session['user'] = user
+            session['user_id'] = user['user_id']
             return redirect('/')
              
         except Exception as e:
@@ -125,65 +257,98 @@ def login():
 
 @app.route("/trends")
 def trends():
-    save_user_counts_plot_as_image(*recipe_db.get_user_count_by_preference())
-    plot_top_rated_recipes(*recipe_db.get_top_rated_recipes())
-    plot_most_liked_cuisines(*recipe_db.get_most_liked_cuisines())
-    return render_template("trends.html")
+    # charts are rendered in the background, serve whatever images are current
+    trends_refresher.start()
+    return render_template("trends.html",images = trends_refresher.images)
 
 
-@app.route("/post_comment", methods=['POST'])
-def post_comment():
-    if request.method == 'POST':
-        recipe_db.post_user_review(user_id = int(session['user']['user_id']),
-                                   recipe = session['recipe']['recipe_name'],
+@app.route("/post_comment/<recipe_name>", methods=['POST'])
+def post_comment(recipe_name):
+    if request.method == 'POST' and g.user:
+        recipe_db.post_user_review(user_id = int(g.user['user_id']),
+                                   recipe = recipe_name,
                                    comment = request.form['comment'],
                                    rating = float(request.form['rating']))
 
         if conn.error:
-                print(conn.error_message)
+                log.warning('could not post review',extra={'recipe':recipe_name,'error':conn.error_message})
                 return f"<h1>{conn.error_message}</h1>"
         
-    return redirect(url_for("recipe",recipe_name=session['recipe']['recipe_name']))
-
-@app.route('/delete_review', methods=['POST'])
-def delete_review():
-    recipe_db.delete_review(user_id = int(session['user']['user_id']),
-                            recipe = session['recipe']['recipe_name'])
-    return redirect(url_for("recipe",recipe_name=session['recipe']['recipe_name']))
-
-
-
-@app.route("/search",methods=['POST'])
+    return redirect(url_for("recipe",recipe_name=recipe_name))
+
+@app.route('/delete_review/<recipe_name>', methods=['POST'])
+def delete_review(recipe_name):
+    if g.user:
+        recipe_db.delete_review(user_id = int(g.user['user_id']),
+                                recipe = recipe_name)
+    return redirect(url_for("recipe",recipe_name=recipe_name))
+
+
+
+def render_results(ranked: list,empty_message: str,**url_args):
+    '''
+        Renders one page of ranked recipes, or all of them streamed card by card
+        with ?stream=1 so large result sets are never held in memory at once
+    '''
+    if request.args.get('stream') == '1':
+        return stream_template("search_result.html",recipes=recipe_db.iter_recipes(ranked),
+                               total=len(ranked),next_url=None)
+
+    page_size = request.args.get('page_size',PAGE_SIZE,type=int)
+    page_size = min(max(page_size,1),MAX_PAGE_SIZE)
+    page = recipe_db.get_recipes_page(ranked,request.args.get('cursor'),page_size)
+    if page['total']<1:
+        flash(empty_message,"error")
+    next_url = None
+    if page['next_cursor']:
+        next_url = url_for(request.endpoint,**request.view_args,**url_args,
+                           cursor=page['next_cursor'],page_size=page_size)
+    return render_template("search_result.html",recipes=page['recipes'],
+                           total=page['total'],next_url=next_url)
+
+@app.route("/search",methods=['GET','POST'])
 def search():
-    query = request.form['query']
-    user_id = session['user']['user_id'] if session['user'] else -1
-    recipes = recipe_db.search_recipes(query,user_id)
-    if len(recipes)<1:
-        flash("Your search doesn't match your preferences","error")
-
-    return render_template("search_result.html",recipes=recipes)
+    if request.method == 'POST':
+        return redirect(url_for("search",q=request.form['query']))
+    query = request.args.get('q','')
+    user_id = g.user['user_id'] if g.user else -1
+    return render_results(recipe_db.rank_search(query,user_id),
+                          "Your search doesn't match your preferences",q=query)
+
+@app.route("/autocomplete")
+def autocomplete():
+    '''
+        Recipe and ingredient names for what was typed so far, served from memory
+        ?q=prefix&limit=8&kind=recipe|ingredient
+    '''
+    limit = min(max(request.args.get('limit',AUTOCOMPLETE_LIMIT,type=int),1),MAX_AUTOCOMPLETE_LIMIT)
+    only = request.args.get('kind')
+    if only not in ('recipe','ingredient'):
+        only = None
+    suggestions = recipe_db.suggest(request.args.get('q',''),limit,only)
+    response = jsonify([{'name':name,'kind':kind,'url':url_for(kind,**{kind + '_name':name})}
+                        for name,kind in suggestions])
+    # the same for every user, browsers may reuse it while the user retypes
+    response.headers['Cache-Control'] = 'public, max-age=60'
+    return response
     
 @app.route("/cuisine/<cuisine_name>")
 def cuisine(cuisine_name):
-    user_id = session['user']['user_id'] if session['user'] else -1
-    recipes = recipe_db.get_recipes_by_cuisine(cuisine_name,user_id)
-    if len(recipes)<1:
-              flash("No recipes with that cuisine","error")
-    return render_template("search_result.html",recipes=recipes)
+    user_id = g.user['user_id'] if g.user else -1
+    return render_results(recipe_db.rank_cuisine(cuisine_name,user_id),"No recipes with that cuisine")
           
 @app.route("/category/<category_name>")
 def category(category_name):
-    recipes = recipe_db.get_recipes_by_category(category_name)
-    if len(recipes)<1:
-              flash("No recipes with that category","error")
-    return render_template("search_result.html",recipes=recipes)
+    return render_results(recipe_db.rank_category(category_name),"No recipes with that category")
 
 @app.route("/profile")
 def profile():
+     if not g.user:
+          return redirect(url_for("login"))
      session['page'] = 'Profile'
      return render_template(
             "profile.html",
-            avatar = recipe_db.get_avatar_link(session['user']['user_id'])
+            avatar = recipe_db.get_avatar_link(g.user['user_id'])
         )
 
 @app.route("/register", methods=['POST','GET'])
@@ -196,7 +361,8 @@ def register():
         user['email'] = request.form['email']
         user['password'] = request.form['password']
         user['preferences'] = request.form.getlist('preferences')  # Assuming preferences are checkboxes
-        user['allergies'] = request.form.getlist('allergies') 
+        # comma separated ingredient names
+        user['allergies'] = [allergy for field in request.form.getlist('allergies') for allergy in field.split(',')]
         user['avatar'] = request.form['avatar']
        
         recipe_db.add_user(user)
@@ -204,11 +370,7 @@ def register():
             flash(conn.error_message,'error')
             return redirect(url_for("register"))
         
-        session['user'] = recipe_db.get_user_by_email(user['email'],user['password'])
-        print(session['user'])
-        
-        
-        session['user']['preferences'] = recipe_db.get_user_preferences(session['user']['user_id'])
+        session['user_id'] = recipe_db.get_user_by_email(user['email'],user['password'])['user_id']
         
         return redirect('/')
         
@@ -226,51 +388,92 @@ def register():
 
 @app.route("/logout", methods=['POST'])
 def logout():
-    session['user'] = None
+    session.pop('user_id',None)
     return redirect(url_for("home_page"))
 
 @app.route("/meal_plans")
 def meal_plans():
+     unchanged = not_modified()
+     if unchanged:
+          return unchanged
      meal_plans = recipe_db.get_meal_plans()
-     if session['user']:
-          user_id = session['user']['user_id']
-          for i in range(len(meal_plans)):
-               meal_plans[i]['liked_by_user'] = recipe_db.did_user_like_meal_plan(
-                    user_id,meal_plans[i]['meal_plan_name']
-               )
+     if g.user:
+          user_id = g.user['user_id']
+          liked = recipe_db.get_liked_meal_plans(user_id,[plan['meal_plan_name'] for plan in meal_plans])
+          for plan in meal_plans:
+               plan['liked_by_user'] = plan['meal_plan_name'] in liked
      return render_template("meal_plans.html",
                             meal_plans = meal_plans)
 
+@app.route("/generate_meal_plans")
+def generate_meal_plans():
+    targets = {}
+    for nutrient in NUTRIENTS:
+        try:
+            targets[nutrient] = float(request.args.get(nutrient,''))
+        except ValueError:
+            pass
+    allergies = request.args.get('allergies','').split(',')
+    user_id = g.user['user_id'] if g.user else -1
+    plans = recipe_db.generate_meal_plans(user_id,allergies,targets or None,count=5)
+    return render_template("generate_meal_plans.html",
+                           plans = plans,
+                           targets = targets,
+                           allergies = request.args.get('allergies',''))
+
 @app.route("/like_meal_plan/<meal_plan>",methods=['POST','GET'])
 def like_meal_plan(meal_plan):
-    if session['user']:
-        user_id = session['user']['user_id']
+    if g.user:
+        user_id = g.user['user_id']
         recipe_db.toggle_like_meal_plan(user_id,meal_plan)
     return redirect(url_for("meal_plans"))
 
 
 @app.route("/edit_preferences",methods=['POST'])
 def edit_preferences():
-    if session['user']:
-        user_id = session['user']['user_id']
+    if g.user:
+        user_id = g.user['user_id']
         recipe_db.edit_preferences(user_id,request.form.getlist('preferences'))
-        session['user'] = recipe_db.get_user_by_email(
-            session['user']['email'],
-            session['user']['password'],
-        )
     return redirect(url_for("profile"))
 
 @app.route("/delete_account",methods=['POST'])
 def delete_account():
-    user_id = session['user']['user_id']
-    recipe_db.delete_user(user_id)
-    session['user'] = None
+    if g.user:
+        recipe_db.delete_user(g.user['user_id'])
+    session.pop('user_id',None)
     return redirect(url_for("home_page"))
 
 @app.route("/ingredient/<ingredient_name>")
 def ingredient(ingredient_name):
+    unchanged = not_modified()
+    if unchanged:
+        return unchanged
     ing = recipe_db.get_ingredient(ingredient_name)
+    if not ing:
+        abort(404)
     return render_template("ingredient.html",ing = ing)
 
+@app.route("/shopping_list")
+def shopping_list():
+    '''
+        Shopping list of the recipes given as ?recipe=...&recipe=..., a recipe
+        given twice is bought for twice
+    '''
+    recipes = request.args.getlist('recipe')[:MAX_SHOPPING_LIST_RECIPES]
+    return render_template("shopping_list.html",title = "Shopping List",
+                           shopping_list = recipe_db.get_shopping_list(recipes),days = 1)
+
+@app.route("/meal_plans/<meal_plan>/shopping_list")
+def meal_plan_shopping_list(meal_plan):
+    unchanged = not_modified()
+    if unchanged:
+        return unchanged
+    days = min(max(request.args.get('days',1,type=int),1),MAX_SHOPPING_LIST_DAYS)
+    shopping_list = recipe_db.get_meal_plan_shopping_list(meal_plan,days)
+    if shopping_list is None:
+        abort(404)
+    return render_template("shopping_list.html",title = shopping_list['meal_plan_name'],
+                           shopping_list = shopping_list,days = days)
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5001, debug=False)
\ No newline at end of file
@@ -0,0 +1,96 @@
+import heapq
+from bisect import bisect_left
+
+from search_engine import tokenize
+
+
+RECIPE = 'recipe'
+INGREDIENT = 'ingredient'
+
+# prefixes this short match thousands of keys, their results are memoized
+MEMO_PREFIX_LENGTH = 2
+
+def fold_key(text: str) -> str:
+    '''
+        Folded words of text joined by single spaces, e.g. "Crème  Brûlée!" -> "creme brulee"
+    '''
+    return ' '.join(tokenize(text))
+
+
+class Autocomplete:
+    def __init__(self,entries: list):
+        '''
+            Prefix index over recipe and ingredient names for suggestions as you type.
+            Every name is keyed by each of its word suffixes, so "chick" finds
+            "Butter Chicken", in one sorted array searched with bisect.
+            The index is immutable, RecipeDb swaps in a new one to update it.
+            Args:
+                entries: (name, kind, popularity) tuples
+        '''
+        self._names = []
+        self._kinds = []
+        self._popularity = []
+        keys = []
+        for name,kind,popularity in entries:
+            words = fold_key(name).split(' ')
+            if not words[0]:
+                continue
+            entry = len(self._names)
+            self._names.append(name)
+            self._kinds.append(kind)
+            self._popularity.append(float(popularity or 0))
+            for i in range(len(words)):
+                keys.append((' '.join(words[i:]),i,entry))
+        keys.sort()
+        self._keys = [key for key,_,_ in keys]
+        self._matches = [(position,entry) for _,position,entry in keys]
+        self._memo = {}
+
+    def __len__(self):
+        return len(self._names)
+
+    @classmethod
+    def build(cls,recipes: list,ingredients: list):
+        '''
+            Args:
+                recipes: rows with recipe_name and popularity
+                ingredients: rows with ingredient_name and popularity
+        '''
+        # likes and recipe counts are on different scales, each is relative to its most popular
+        entries = []
+        for rows,column,kind in ((recipes,'recipe_name',RECIPE),(ingredients,'ingredient_name',INGREDIENT)):
+            top = max((float(row['popularity'] or 0) for row in rows),default=0) or 1.0
+            entries += [(row[column],kind,float(row['popularity'] or 0)/top) for row in rows]
+        return cls(entries)
+
+    def suggest(self,prefix: str,limit: int = 8,kind: str = None) -> list:
+        '''
+            Names starting with prefix, or with a word starting with it, ignoring
+            case, accents and punctuation. Names starting with the prefix come
+            first, then the more popular, then the shorter.
+            Returns:
+                (name, kind) tuples
+        '''
+        prefix = fold_key(prefix)
+        if not prefix or limit < 1:
+            return []
+        memo_key = (prefix,limit,kind)
+        if len(prefix) <= MEMO_PREFIX_LENGTH and memo_key in self._memo:
+            return self._memo[memo_key]
+
+        start = bisect_left(self._keys,prefix)
+        end = bisect_left(self._keys,prefix + '\uffff',start)
+        best = {} # entry -> rank, an entry matches once per word suffix
+        names,kinds,popularity = self._names,self._kinds,self._popularity
+        for position,entry in self._matches[start:end]:
+            if kind is not None and kinds[entry] != kind:
+                continue
+            rank = (position == 0,popularity[entry],-len(names[entry]))
+            if entry not in best or rank > best[entry]:
+                best[entry] = rank
+        top = heapq.nlargest(limit,best,key=best.__getitem__)
+        result = [(names[entry],kinds[entry]) for entry in top]
+
+        if len(prefix) <= MEMO_PREFIX_LENGTH:
+            self._memo[memo_key] = result
+        return result
@@ -0,0 +1,51 @@
+'''
+    Measures the import time and resident memory of the web app modules, each
+    in a fresh interpreter so the numbers match a newly started worker.
+
+    Usage:
+        python benchmarks/import_cost.py [module ...] [--repeat N]
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run in the child interpreter, prints the measurement as json
+PROBE = '''
+import json, resource, sys, time
+sys.path.insert(0, {root!r})
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+heavy = sorted(m for m in ('matplotlib', 'seaborn', 'pandas', 'scipy') if m in sys.modules)
+print(json.dumps({{'seconds': elapsed, 'rss_kb': after, 'rss_delta_kb': after - before, 'plotting_modules': heavy}}))
+'''
+
+def measure(module: str) -> dict:
+    result = subprocess.run([sys.executable,'-c',PROBE.format(root=ROOT,module=module)],
+                            cwd=ROOT,capture_output=True,text=True,check=True)
+    # the app module may print while importing, the probe result is the last line
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules',nargs='*',default=['app','graphs_drawer'])
+    parser.add_argument('--repeat',type=int,default=5)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        runs = [measure(module) for _ in range(args.repeat)]
+        seconds = statistics.median(run['seconds'] for run in runs)
+        rss = statistics.median(run['rss_kb'] for run in runs)
+        print(f'{module:<16} import {seconds*1000:8.1f} ms   max rss {rss/1024:7.1f} MiB   '
+              f'plotting modules loaded: {", ".join(runs[-1]["plotting_modules"]) or "none"}')
+
+if __name__ == '__main__':
+    main()
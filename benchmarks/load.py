@@ -0,0 +1,173 @@
+'''
+    Drives the Flask routes through the test client against a benchmark
+    database (see seed.py) and reports latency percentiles, throughput and
+    database queries per request for each route.
+
+    Usage:
+        python benchmarks/load.py [--database recipe_management_bench] [--threads 8] [--duration 30]
+                                  [--save-baseline FILE] [--baseline FILE] [--tolerance 0.2]
+
+    With --baseline the run fails (exit code 1) when a route's p95 latency grew
+    by more than the tolerance, or its queries per request grew at all.
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from urllib.parse import quote
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,ROOT)
+
+
+def scenarios(recipe_db,seed: int = 0) -> dict:
+    '''
+        Route name -> function returning a url to request, drawing recipes,
+        cuisines and search terms from the seeded catalog
+    '''
+    recipes = recipe_db.conn.execute_query('SELECT recipe_name FROM recipes ORDER BY recipe_name;')
+    recipes = [row['recipe_name'] for row in recipes]
+    cuisines = [row['cuisine_name'] for row in recipe_db.get_cuisine_names()]
+    words = sorted({word for name in recipes[:500] for word in name.split() if len(word) > 3 and word.isalpha()})
+    plans = [row['meal_plan_name'] for row in recipe_db.get_meal_plans()] or ['']
+    rng = random.Random(seed)
+    return {
+        'home':lambda: '/',
+        'recipe':lambda: '/recipe/' + quote(rng.choice(recipes),safe=''),
+        'search':lambda: '/search?q=' + quote(rng.choice(words)),
+        'cuisine':lambda: '/cuisine/' + quote(rng.choice(cuisines),safe=''),
+        'meal_plans':lambda: '/meal_plans',
+        'shopping_list':lambda: '/meal_plans/' + quote(rng.choice(plans),safe='') + '/shopping_list?days=7',
+        'trends':lambda: '/trends',
+    }
+
+def run(app,routes: dict,threads: int,duration: float,warmup: int = 3) -> dict:
+    '''
+        Requests random routes from `threads` threads for `duration` seconds
+        Returns:
+            route name -> list of (seconds, db queries, status) samples
+    '''
+    samples = {name:[] for name in routes}
+    lock = threading.Lock()
+    names = sorted(routes)
+
+    client = app.test_client()
+    for name in names: # fills the caches and indexes a long-running worker would have
+        for _ in range(warmup):
+            client.get(routes[name]())
+
+    deadline = time.perf_counter() + duration
+    def worker(index):
+        client = app.test_client()
+        rng = random.Random(index)
+        local = []
+        while time.perf_counter() < deadline:
+            name = rng.choice(names)
+            url = routes[name]()
+            start = time.perf_counter()
+            response = client.get(url)
+            response.get_data() # consumes streamed bodies
+            local.append((name,time.perf_counter() - start,int(response.headers.get('X-DB-Queries',0)),
+                          response.status_code))
+        with lock:
+            for name,*sample in local:
+                samples[name].append(tuple(sample))
+
+    pool = [threading.Thread(target=worker,args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return samples
+
+def summarize(samples: dict,duration: float) -> dict:
+    report = {}
+    for name,rows in samples.items():
+        if len(rows) < 1:
+            continue
+        seconds = np.array([row[0] for row in rows])*1000
+        queries = np.array([row[1] for row in rows])
+        errors = sum(1 for row in rows if row[2] >= 500)
+        report[name] = {
+            'requests':len(rows),
+            'errors':errors,
+            'throughput_rps':round(len(rows)/duration,2),
+            'p50_ms':round(float(np.percentile(seconds,50)),3),
+            'p95_ms':round(float(np.percentile(seconds,95)),3),
+            'p99_ms':round(float(np.percentile(seconds,99)),3),
+            'queries_per_request':round(float(queries.mean()),2),
+        }
+    return report
+
+def regressions(report: dict,baseline: dict,tolerance: float) -> list:
+    found = []
+    for name,old in baseline.get('routes',{}).items():
+        new = report.get(name)
+        if new is None:
+            continue
+        if new['p95_ms'] > old['p95_ms']*(1 + tolerance):
+            found.append(f"{name}: p95 {old['p95_ms']} ms -> {new['p95_ms']} ms")
+        if new['queries_per_request'] > old['queries_per_request'] + 0.01:
+            found.append(f"{name}: queries per request {old['queries_per_request']} -> {new['queries_per_request']}")
+        if new['errors'] > old.get('errors',0):
+            found.append(f"{name}: {new['errors']} server errors")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database',default='recipe_management_bench')
+    parser.add_argument('--threads',type=int,default=8)
+    parser.add_argument('--duration',type=float,default=30.0,help='seconds')
+    parser.add_argument('--routes',nargs='*',default=None,help='subset of the routes to drive')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--save-baseline',default=None,help='write the report to this json file')
+    parser.add_argument('--baseline',default=None,help='compare against this json report')
+    parser.add_argument('--tolerance',type=float,default=0.2,help='allowed relative p95 growth')
+    args = parser.parse_args()
+
+    # the app reads its settings at import, point it at the benchmark database first
+    import settings
+    settings.DBNAME = args.database
+    settings.LOG_LEVEL = 'WARNING'
+    import app as webapp
+
+    with webapp.app.app_context():
+        webapp.conn.begin_request()
+        try:
+            routes = scenarios(webapp.recipe_db,args.seed)
+        finally:
+            webapp.conn.end_request()
+    if args.routes:
+        routes = {name:url for name,url in routes.items() if name in args.routes}
+
+    samples = run(webapp.app,routes,args.threads,args.duration)
+    report = {
+        'database':args.database,
+        'threads':args.threads,
+        'duration_s':args.duration,
+        'routes':summarize(samples,args.duration),
+    }
+    webapp.trends_refresher.stop()
+
+    print(f"{'route':<12}{'requests':>10}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}{'errors':>8}")
+    for name,row in report['routes'].items():
+        print(f"{name:<12}{row['requests']:>10}{row['throughput_rps']:>9}{row['p50_ms']:>10}{row['p95_ms']:>10}"
+              f"{row['p99_ms']:>10}{row['queries_per_request']:>9}{row['errors']:>8}")
+
+    if args.save_baseline:
+        with open(args.save_baseline,'w') as f:
+            json.dump(report,f,indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report['routes'],json.load(f),args.tolerance)
+        for line in found:
+            print('REGRESSION',line)
+        sys.exit(1 if found else 0)
+
+if __name__ == '__main__':
+    main()
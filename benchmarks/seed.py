@@ -0,0 +1,175 @@
+'''
+    Creates a benchmark database on a local MySQL server from projedt_dump.sql
+    and the migrations, optionally scaled up with synthetic recipes, users,
+    likes and comments. Scaling is deterministic, the same factor always
+    produces the same data.
+
+    Usage:
+        python benchmarks/seed.py [--database recipe_management_bench] [--scale 100]
+'''
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+
+import pymysql
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,ROOT)
+
+import settings
+
+
+DUMP = os.path.join(ROOT,'projedt_dump.sql')
+MIGRATIONS = sorted(glob.glob(os.path.join(ROOT,'migrations','*.sql')))
+
+_DEFINER_RE = re.compile(r'DEFINER=`[^`]*`@`[^`]*`\s*')
+
+def statements(path: str,database: str):
+    '''
+        Splits a mysql client script into statements, following DELIMITER
+        changes the way the mysql command line client does
+    '''
+    delimiter = ';'
+    statement = []
+    with open(path,encoding='utf8') as f:
+        for line in f:
+            stripped = line.strip()
+            if stripped.upper().startswith('DELIMITER '):
+                delimiter = stripped.split(None,1)[1]
+                continue
+            if not statement and (not stripped or stripped.startswith('--')):
+                continue
+            statement.append(line)
+            if stripped.endswith(delimiter):
+                text = ''.join(statement).rstrip()[:-len(delimiter)]
+                statement = []
+                # the dump names its database and the account that created the procedures
+                text = text.replace('`recipe_management`',f'`{database}`')
+                yield _DEFINER_RE.sub('',text)
+    if ''.join(statement).strip():
+        yield ''.join(statement)
+
+def run_script(cur,path: str,database: str) -> int:
+    count = 0
+    for statement in statements(path,database):
+        cur.execute(statement)
+        count += 1
+    return count
+
+def scale(cur,factor: int) -> None:
+    '''
+        Multiplies recipes (with their images, ingredients, steps and categories),
+        users, likes and comments by factor
+    '''
+    if factor <= 1:
+        return
+    count = lambda table: (cur.execute(f'SELECT COUNT(*) AS n FROM {table};'),cur.fetchone()['n'])[1]
+    base = {table:count(table) for table in ('recipes','users','user_liked_recipes','user_comments')}
+    likes = max(base['user_liked_recipes'],base['users'])*factor
+    comments = max(base['user_comments'],base['users'])*factor
+    size = max(likes,comments,base['users']*factor,factor)
+
+    cur.execute('SET SESSION cte_max_recursion_depth = %s;',(size + 1,))
+    cur.execute('DROP TEMPORARY TABLE IF EXISTS seq;')
+    cur.execute('CREATE TEMPORARY TABLE seq (n INT PRIMARY KEY);')
+    cur.execute('INSERT INTO seq WITH RECURSIVE s (n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM s WHERE n < %s)\n'
+                'SELECT n FROM s;',(size,))
+
+    # copy k of recipe "x" is "x #k", for k in 1..factor-1
+    cur.execute('CREATE TEMPORARY TABLE base_recipes AS SELECT recipe_name FROM recipes;')
+    copy = "CONCAT(LEFT(b.recipe_name,170),' #',s.n)"
+    copies = f'FROM base_recipes b JOIN seq s ON s.n < {factor}'
+    cur.execute('INSERT INTO recipes (recipe_name,tagline,rating,preparation_time,cooking_time,vegan,gluten_free,\n'
+                'vegetarian,eggetarian,cuisine_name) SELECT '+copy+',r.tagline,r.rating,r.preparation_time,r.cooking_time,r.vegan,\n'
+                'r.gluten_free,r.vegetarian,r.eggetarian,r.cuisine_name '+copies+'\n'
+                'JOIN recipes r ON r.recipe_name = b.recipe_name;')
+    cur.execute('INSERT INTO recipe_images (recipe_name,recipe_image) SELECT '+copy+',t.recipe_image '+copies+'\n'
+                'JOIN recipe_images t ON t.recipe_name = b.recipe_name;')
+    cur.execute('INSERT INTO recipe_ingredients (recipe_name,ingredient_name,quantity) SELECT '+copy+',t.ingredient_name,t.quantity '+copies+'\n'
+                'JOIN recipe_ingredients t ON t.recipe_name = b.recipe_name;')
+    cur.execute('INSERT INTO recipe_instructions (step_number,recipe_name,instruction) SELECT t.step_number,'+copy+',t.instruction '+copies+'\n'
+                'JOIN recipe_instructions t ON t.recipe_name = b.recipe_name;')
+    cur.execute('INSERT INTO recipes_to_categories (recipe_name,recipe_category_name) SELECT '+copy+',t.recipe_category_name '+copies+'\n'
+                'JOIN recipes_to_categories t ON t.recipe_name = b.recipe_name;')
+
+    cur.execute("INSERT INTO users (first_name,last_name,email,password,avatar)\n"
+                "SELECT 'Bench',CONCAT('User ',s.n),CONCAT('bench',s.n,'@example.com'),'benchmark',\n"
+                "(SELECT MIN(avatar_id) FROM avatars) FROM seq s WHERE s.n <= %s;",
+                (base['users']*(factor - 1),))
+
+    # RAND(seed) makes the picks reproducible, they are materialized before joining
+    cur.execute('CREATE TEMPORARY TABLE numbered_users (i INT AUTO_INCREMENT PRIMARY KEY,user_id INT)\n'
+                'SELECT user_id FROM users ORDER BY user_id;')
+    cur.execute('CREATE TEMPORARY TABLE numbered_recipes (i INT AUTO_INCREMENT PRIMARY KEY,recipe_name VARCHAR(180))\n'
+                'SELECT recipe_name FROM recipes ORDER BY recipe_name;')
+    users,recipes = count('numbered_users'),count('numbered_recipes')
+    cur.execute('CREATE TEMPORARY TABLE picks (n INT PRIMARY KEY,ui INT,ri INT,rating DECIMAL(3,1))\n'
+                'SELECT n,1 + FLOOR(RAND(n)*%s) AS ui,1 + FLOOR(RAND(n + 1000003)*%s) AS ri,\n'
+                'ROUND(1 + RAND(n + 2000003)*4,0) AS rating FROM seq WHERE n <= %s;',
+                (users,recipes,max(likes,comments)))
+    cur.execute('INSERT IGNORE INTO user_liked_recipes (user_id,recipe_name,liked_date)\n'
+                'SELECT u.user_id,r.recipe_name,NOW() - INTERVAL p.n MINUTE FROM picks p\n'
+                'JOIN numbered_users u ON u.i = p.ui JOIN numbered_recipes r ON r.i = p.ri WHERE p.n <= %s;',(likes,))
+    # reviews use the other end of the picks so they do not mirror the likes
+    cur.execute("INSERT IGNORE INTO user_comments (user_id,recipe_name,user_comment,rating,commented_datetime)\n"
+                "SELECT u.user_id,r.recipe_name,'Benchmark review',p.rating,NOW() - INTERVAL p.n SECOND FROM picks p\n"
+                "JOIN numbered_users u ON u.i = p.ri %% %s + 1 JOIN numbered_recipes r ON r.i = p.ui %% %s + 1\n"
+                "WHERE p.n <= %s;",(users,recipes,comments))
+
+def refresh_recipe_stats(cur) -> None:
+    cur.execute("SHOW TABLES LIKE 'recipe_stats';")
+    if cur.fetchone() is None:
+        return
+    cur.execute('REPLACE INTO recipe_stats (recipe_name,like_count,review_count,rating_sum)\n'
+                'SELECT r.recipe_name,COALESCE(l.n,0),COALESCE(c.n,0),COALESCE(c.total,0) FROM recipes r\n'
+                'LEFT JOIN (SELECT recipe_name,COUNT(*) AS n FROM user_liked_recipes GROUP BY recipe_name) l\n'
+                'ON l.recipe_name = r.recipe_name\n'
+                'LEFT JOIN (SELECT recipe_name,COUNT(*) AS n,SUM(rating) AS total FROM user_comments GROUP BY recipe_name) c\n'
+                'ON c.recipe_name = r.recipe_name;')
+
+def seed(database: str,factor: int = 1,host: str = None,user: str = None,password: str = None) -> dict:
+    '''
+        Drops and recreates the database. Returns the row counts of the main tables.
+    '''
+    db = pymysql.connect(host=host or settings.HOST,user=user or settings.USERNAME,
+                         password=password if password is not None else settings.PASSWORD,
+                         cursorclass=pymysql.cursors.DictCursor,autocommit=True,charset='utf8mb4')
+    try:
+        cur = db.cursor()
+        cur.execute(f'DROP DATABASE IF EXISTS `{database}`;')
+        run_script(cur,DUMP,database)
+        cur.execute(f'USE `{database}`;')
+        for migration in MIGRATIONS:
+            run_script(cur,migration,database)
+        cur.execute('SET FOREIGN_KEY_CHECKS = 0;')
+        scale(cur,factor)
+        cur.execute('SET FOREIGN_KEY_CHECKS = 1;')
+        refresh_recipe_stats(cur)
+        counts = {}
+        for table in ('recipes','recipe_ingredients','users','user_liked_recipes','user_comments'):
+            cur.execute(f'SELECT COUNT(*) AS n FROM {table};')
+            counts[table] = cur.fetchone()['n']
+        return counts
+    finally:
+        db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database',default='recipe_management_bench')
+    parser.add_argument('--scale',type=int,default=1,help='multiply recipes, users, likes and comments')
+    parser.add_argument('--host',default=None)
+    parser.add_argument('--user',default=None)
+    parser.add_argument('--password',default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = seed(args.database,args.scale,args.host,args.user,args.password)
+    print(f'seeded {args.database} x{args.scale} in {time.perf_counter() - start:.1f} s')
+    for table,n in counts.items():
+        print(f'  {table:<20} {n:>10}')
+
+if __name__ == '__main__':
+    main()
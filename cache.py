@@ -0,0 +1,137 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+_MISSING = object()
+
+class LRUCache:
+    def __init__(self,max_entries: int = 4096, ttl: float = 600.0):
+        '''
+            Thread-safe in-process cache with least-recently-used eviction
+            and a per-entry time to live
+            Args:
+                max_entries: number of entries kept before the oldest are evicted
+                ttl: seconds an entry stays valid, None keeps entries until evicted
+        '''
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self,key,default = None):
+        with self._lock:
+            entry = self._entries.get(key,_MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            expires_at,value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self,key,value) -> None:
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires_at,value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self,key,loader):
+        '''
+            Returns the cached value for key, calling loader() and caching
+            its result on a miss
+        '''
+        value = self.get(key,_MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.set(key,value)
+        return value
+
+    def get_many(self,keys) -> dict:
+        '''
+            Returns a dict with the cached values of the keys that are present
+        '''
+        found = {}
+        for key in keys:
+            value = self.get(key,_MISSING)
+            if value is not _MISSING:
+                found[key] = value
+        return found
+
+    def invalidate(self,*keys) -> None:
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key,None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries':len(self._entries),
+                'max_entries':self.max_entries,
+                'hits':self.hits,
+                'misses':self.misses,
+                'evictions':self.evictions,
+            }
+
+
+class Versions:
+    def __init__(self,ttl: float = None):
+        '''
+            Version counters of cached data, e.g. ("catalog",) or ("user", 7),
+            bumped by every write to that data. A page made of some of them is
+            unchanged while none of their versions moved, which makes its ETag.
+            Args:
+                ttl: time to live of the data caches. Tags also change every ttl
+                    seconds, so writes by other processes (which do not bump these
+                    counters) show up in conditional requests when the caches pick
+                    them up.
+        '''
+        self.ttl = ttl
+        self.started = time.time()
+        self._process = os.urandom(4).hex() # tags from another process never match
+        self._versions = {} # key -> (version, time of the last bump)
+        self._lock = threading.Lock()
+
+    def bump(self,*keys) -> None:
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                version,_ = self._versions.get(key,(0,None))
+                self._versions[key] = (version + 1,now)
+
+    def get(self,key) -> int:
+        return self._versions.get(key,(0,None))[0]
+
+    def tag(self,*keys):
+        '''
+            Returns:
+                (etag, last_modified) of data made of the given keys, last_modified
+                is the unix time of the latest bump, process start or ttl rollover
+        '''
+        now = time.time()
+        epoch = int(now // self.ttl) if self.ttl else 0
+        modified = max(self.started,epoch*self.ttl if self.ttl else 0)
+        parts = [self._process,str(epoch)]
+        with self._lock:
+            for key in keys:
+                version,bumped = self._versions.get(key,(0,None))
+                parts.append(f'{key!r}={version}')
+                if bumped is not None and bumped > modified:
+                    modified = bumped
+        return hashlib.sha1('|'.join(parts).encode()).hexdigest()[:24],modified
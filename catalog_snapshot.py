@@ -0,0 +1,420 @@
+'''
+    Read-only catalog snapshot shared by the worker processes.
+
+    The export step writes the recipes with their images, categories, steps and
+    ingredients, and the ingredients with their nutrition, into one binary file:
+    fixed-width numpy record arrays, a string table and offset indexes. Workers
+    memory-map it, so lookups read straight from pages the OS shares between
+    processes instead of every worker caching its own copy.
+
+    Snapshots are versioned files in one directory, CURRENT names the live one.
+    Publishing writes the new file first and then swaps CURRENT atomically,
+    workers notice within SNAPSHOT_CHECK_INTERVAL and map the new file.
+
+    Usage:
+        python catalog_snapshot.py [--directory catalog_snapshots]
+'''
+import argparse
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+from search_engine import fold
+
+
+log = logging.getLogger('recipe_hub.db')
+
+MAGIC = b'RHCS'
+FORMAT_VERSION = 1
+CURRENT = 'CURRENT'
+KEEP_SNAPSHOTS = 3 # published files kept, workers may still map the previous ones
+
+_HEADER = struct.Struct('<4sIQdI') # magic, format version, catalog version, created, section count
+_SECTION = struct.Struct('<32sQQ') # name, offset, size in bytes
+_ALIGN = 8
+
+NULL = 0xFFFFFFFF # string id of a NULL column
+
+# string columns hold ids into the string table, child lists are [offsets[i], offsets[i + 1]) ranges
+RECIPE = np.dtype([('recipe_name','<u4'),('key','<u4'),('tagline','<u4'),('rating','<f4'),
+                   ('preparation_time','<i4'),('cooking_time','<i4'),('vegan','i1'),('gluten_free','i1'),
+                   ('vegetarian','i1'),('eggetarian','i1'),('cuisine_name','<u4')])
+INGREDIENT = np.dtype([('ingredient_name','<u4'),('key','<u4'),('calories','<f8'),('protein','<f8'),
+                       ('fats','<f8'),('carbs','<f8'),('sugar','<f8'),('measurement','<u4'),('image_link','<u4')])
+# ingredient is a row of ingredients, NULL for names the ingredients table lacks
+RECIPE_INGREDIENT = np.dtype([('ingredient_name','<u4'),('ingredient','<u4'),('quantity','<u4')])
+STEP = np.dtype([('step_number','<i4'),('instruction','<u4')])
+
+_NUTRIENTS = ('calories','protein','fats','carbs','sugar')
+_FLAGS = ('vegan','gluten_free','vegetarian','eggetarian')
+_NO_INT = -2**31 # NULL int column
+_NO_FLAG = -1
+
+
+class _Strings:
+    def __init__(self):
+        self._ids = {}
+        self._data = bytearray()
+        self._offsets = [0]
+
+    def add(self,text) -> int:
+        if text is None:
+            return NULL
+        text = str(text)
+        sid = self._ids.get(text)
+        if sid is None:
+            sid = self._ids[text] = len(self._offsets) - 1
+            self._data += text.encode('utf8')
+            self._offsets.append(len(self._data))
+        return sid
+
+    def sections(self) -> dict:
+        return {'strings.offsets':np.array(self._offsets,dtype='<u8'),'strings':bytes(self._data)}
+
+
+def _csr(groups: list,dtype) -> tuple:
+    '''
+        (offsets, values) of a list of lists, the values of row i are
+        values[offsets[i]:offsets[i + 1]]
+    '''
+    offsets = np.zeros(len(groups) + 1,dtype='<u4')
+    offsets[1:] = np.cumsum([len(group) for group in groups],dtype=np.int64)
+    values = np.array([value for group in groups for value in group],dtype=dtype)
+    return offsets,values
+
+def build_sections(recipes: list,ingredients: list,images: list,categories: list,steps: list,
+                   recipe_ingredients: list) -> dict:
+    '''
+        Args:
+            recipes: rows of the recipes table
+            ingredients: rows of the ingredients table
+            images: rows with recipe_name and recipe_image
+            categories: rows with recipe_name and recipe_category_name
+            steps: rows with recipe_name, step_number and instruction
+            recipe_ingredients: rows with recipe_name, ingredient_name and quantity
+        Returns:
+            section name -> numpy array or bytes
+    '''
+    strings = _Strings()
+    # sorted by folded name, the collation is case and accent insensitive and so are lookups
+    ingredients = sorted(ingredients,key=lambda row: fold(row['ingredient_name']))
+    ingredient_ids = {fold(row['ingredient_name']):i for i,row in enumerate(ingredients)}
+    ingredient_array = np.zeros(len(ingredients),dtype=INGREDIENT)
+    for i,row in enumerate(ingredients):
+        ingredient_array[i] = (strings.add(row['ingredient_name']),strings.add(fold(row['ingredient_name'])),
+                               *[np.nan if row[n] is None else float(row[n]) for n in _NUTRIENTS],
+                               strings.add(row['measurement']),strings.add(row['image_link']))
+
+    recipes = sorted(recipes,key=lambda row: fold(row['recipe_name']))
+    recipe_ids = {fold(row['recipe_name']):i for i,row in enumerate(recipes)}
+    recipe_array = np.zeros(len(recipes),dtype=RECIPE)
+    for i,row in enumerate(recipes):
+        recipe_array[i] = (strings.add(row['recipe_name']),strings.add(fold(row['recipe_name'])),
+                           strings.add(row['tagline']),np.nan if row['rating'] is None else float(row['rating']),
+                           *[_NO_INT if row[n] is None else row[n] for n in ('preparation_time','cooking_time')],
+                           *[_NO_FLAG if row[n] is None else row[n] for n in _FLAGS],
+                           strings.add(row['cuisine_name']))
+
+    def group(rows,value):
+        groups = [[] for _ in recipes]
+        for row in rows:
+            i = recipe_ids.get(fold(row['recipe_name']))
+            if i is not None:
+                item = value(row)
+                if item is not None:
+                    groups[i].append(item)
+        return groups
+
+    def ingredient_item(row):
+        return (strings.add(row['ingredient_name']),ingredient_ids.get(fold(row['ingredient_name']),NULL),
+                strings.add(row['quantity']))
+
+    sections = {'recipes':recipe_array,'ingredients':ingredient_array}
+    for name,rows,value,dtype in (
+            ('images',images,lambda row: strings.add(row['recipe_image']),'<u4'),
+            ('categories',categories,lambda row: strings.add(row['recipe_category_name']),'<u4'),
+            ('steps',sorted(steps,key=lambda row: row['step_number']),
+             lambda row: (row['step_number'],strings.add(row['instruction'])),STEP),
+            ('recipe_ingredients',recipe_ingredients,ingredient_item,RECIPE_INGREDIENT)):
+        sections[name + '.offsets'],sections[name] = _csr(group(rows,value),dtype)
+    sections.update(strings.sections())
+    return sections
+
+def write_snapshot(path: str,sections: dict,catalog_version: int) -> None:
+    '''
+        Writes the sections to path through a temporary file, so a reader never
+        maps a partly written snapshot
+    '''
+    names = list(sections)
+    offset = _HEADER.size + _SECTION.size*len(names)
+    table = []
+    for name in names:
+        offset += -offset % _ALIGN
+        size = len(sections[name]) if isinstance(sections[name],bytes) else sections[name].nbytes
+        table.append((name,offset,size))
+        offset += size
+
+    temporary = path + '.tmp'
+    with open(temporary,'wb') as f:
+        f.write(_HEADER.pack(MAGIC,FORMAT_VERSION,catalog_version,time.time(),len(names)))
+        for name,offset,size in table:
+            f.write(_SECTION.pack(name.encode('ascii'),offset,size))
+        for name,offset,_ in table:
+            f.write(b'\0'*(offset - f.tell()))
+            data = sections[name]
+            f.write(data if isinstance(data,bytes) else data.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary,path)
+
+def current_version(directory: str) -> int:
+    try:
+        with open(os.path.join(directory,CURRENT)) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return 0
+    return int(name.split('-')[1].split('.')[0])
+
+def publish(directory: str,sections: dict) -> str:
+    '''
+        Writes the next version of the snapshot and points CURRENT at it
+        Returns:
+            the path of the new snapshot
+    '''
+    os.makedirs(directory,exist_ok=True)
+    version = current_version(directory) + 1
+    name = f'catalog-{version:08d}.snap'
+    write_snapshot(os.path.join(directory,name),sections,version)
+
+    temporary = os.path.join(directory,CURRENT + '.tmp')
+    with open(temporary,'w') as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary,os.path.join(directory,CURRENT))
+
+    # mapped files stay readable after unlinking, only the disk space waits for the last worker
+    published = sorted(entry for entry in os.listdir(directory) if entry.startswith('catalog-') and entry.endswith('.snap'))
+    for old in published[:-KEEP_SNAPSHOTS]:
+        os.remove(os.path.join(directory,old))
+    return os.path.join(directory,name)
+
+def export(recipe_db,directory: str) -> str:
+    '''
+        Reads the catalog through recipe_db's connection and publishes it
+    '''
+    query = recipe_db.conn.execute_query
+    sections = build_sections(
+        query('SELECT * FROM recipes;'),
+        query('SELECT * FROM ingredients;'),
+        query('SELECT recipe_name,recipe_image FROM recipe_images;'),
+        query('SELECT recipe_name,recipe_category_name FROM recipes_to_categories;'),
+        query('SELECT recipe_name,step_number,instruction FROM recipe_instructions;'),
+        query('SELECT recipe_name,ingredient_name,quantity FROM recipe_ingredients;'))
+    path = publish(directory,sections)
+    log.info('catalog snapshot published',extra={'path':path,'recipes':len(sections['recipes']),
+                                                 'ingredients':len(sections['ingredients'])})
+    return path
+
+
+class CatalogSnapshot:
+    def __init__(self,path: str):
+        '''
+            Memory-maps a snapshot file. The arrays are views of the mapping,
+            only the strings a lookup returns are decoded.
+        '''
+        self.path = path
+        with open(path,'rb') as f:
+            self._map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        magic,format_version,self.version,self.created,count = _HEADER.unpack_from(self._map,0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f'{path} is not a version {FORMAT_VERSION} catalog snapshot')
+        self._sections = {}
+        for i in range(count):
+            name,offset,size = _SECTION.unpack_from(self._map,_HEADER.size + i*_SECTION.size)
+            self._sections[name.rstrip(b'\0').decode('ascii')] = (offset,size)
+
+        self._string_offsets = self._array('strings.offsets','<u8')
+        self._strings_at = self._sections['strings'][0]
+        self.recipes = self._array('recipes',RECIPE)
+        self.ingredients = self._array('ingredients',INGREDIENT)
+        self._children = {name:(self._array(name + '.offsets','<u4'),self._array(name,dtype)) for name,dtype in (
+            ('images','<u4'),('categories','<u4'),('steps',STEP),('recipe_ingredients',RECIPE_INGREDIENT))}
+
+    def _array(self,name: str,dtype) -> np.ndarray:
+        offset,size = self._sections[name]
+        dtype = np.dtype(dtype)
+        return np.frombuffer(self._map,dtype=dtype,count=size//dtype.itemsize,offset=offset)
+
+    def __len__(self):
+        return len(self.recipes)
+
+    def __contains__(self,recipe_name: str):
+        return self._find(self.recipes,recipe_name) is not None
+
+    def string(self,sid):
+        if sid == NULL:
+            return None
+        start = self._strings_at + int(self._string_offsets[sid])
+        end = self._strings_at + int(self._string_offsets[sid + 1])
+        return self._map[start:end].decode('utf8')
+
+    def _find(self,array: np.ndarray,name: str):
+        '''
+            Row of the name in an array sorted by its folded "key" column, by bisection
+        '''
+        key = fold(name)
+        low,high = 0,len(array)
+        keys = array['key']
+        while low < high:
+            middle = (low + high)//2
+            if self.string(keys[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(array) and self.string(keys[low]) == key:
+            return low
+        return None
+
+    def _child(self,name: str,row: int) -> np.ndarray:
+        offsets,values = self._children[name]
+        return values[offsets[row]:offsets[row + 1]]
+
+    def recipe(self,recipe_name: str) -> dict:
+        '''
+            The recipes row with its images, as RecipeDb caches it, or None
+        '''
+        row = self._find(self.recipes,recipe_name)
+        if row is None:
+            return None
+        record = self.recipes[row]
+        name = self.string(record['recipe_name'])
+        recipe = {
+            'recipe_name':name,
+            'tagline':self.string(record['tagline']),
+            'rating':None if np.isnan(record['rating']) else round(float(record['rating']),1),
+        }
+        for column in ('preparation_time','cooking_time'):
+            recipe[column] = None if record[column] == _NO_INT else int(record[column])
+        for column in _FLAGS:
+            recipe[column] = None if record[column] == _NO_FLAG else int(record[column])
+        recipe['cuisine_name'] = self.string(record['cuisine_name'])
+        recipe['images'] = [{'recipe_name':name,'recipe_image':self.string(sid)} for sid in self._child('images',row)]
+        return recipe
+
+    def recipe_page(self,recipe_name: str) -> dict:
+        '''
+            Categories, steps and ingredients with their nutrition columns,
+            the same dict as RecipeDb's recipe_page cache entries, or None
+        '''
+        row = self._find(self.recipes,recipe_name)
+        if row is None:
+            return None
+        ingredients = []
+        for name,found,quantity in self._child('recipe_ingredients',row):
+            # like the LEFT JOIN of RecipeDb.get_recipe_page, named as the recipe spells it
+            details = None if found == NULL else self._ingredient(int(found))
+            ingredient = {'ingredient_name':self.string(name),'quantity':self.string(quantity)}
+            for column in _NUTRIENTS + ('measurement','image_link'):
+                ingredient[column] = None if details is None else details[column]
+            ingredients.append(ingredient)
+        return {
+            'categories':[{'recipe_category_name':self.string(sid)} for sid in self._child('categories',row)],
+            'steps':[{'step_number':int(step['step_number']),'instruction':self.string(step['instruction'])}
+                     for step in self._child('steps',row)],
+            'ingredients':ingredients,
+            'ingredient_details':{
+                ingredient['ingredient_name']:{k:v for k,v in ingredient.items() if k != 'quantity'}
+                for ingredient in ingredients
+            },
+        }
+
+    def ingredient(self,ingredient_name: str) -> dict:
+        '''
+            The ingredients row, nutrition columns as floats, or None
+        '''
+        row = self._find(self.ingredients,ingredient_name)
+        return None if row is None else self._ingredient(row)
+
+    def _ingredient(self,row: int) -> dict:
+        record = self.ingredients[row]
+        ingredient = {'ingredient_name':self.string(record['ingredient_name'])}
+        for column in _NUTRIENTS:
+            ingredient[column] = None if np.isnan(record[column]) else float(record[column])
+        ingredient['measurement'] = self.string(record['measurement'])
+        ingredient['image_link'] = self.string(record['image_link'])
+        return ingredient
+
+
+class SharedCatalog:
+    def __init__(self,directory: str,check_interval: float = 5.0):
+        '''
+            The snapshot CURRENT points at, re-checked at most every check_interval
+            seconds. A replaced snapshot stays mapped until no lookup uses its arrays.
+        '''
+        self.directory = directory
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._current = None # (mtime_ns, file name) of CURRENT when it was last read
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def snapshot(self) -> CatalogSnapshot:
+        '''
+            The live snapshot, None when none was published yet
+        '''
+        if time.monotonic() - self._checked >= self.check_interval:
+            with self._lock:
+                if time.monotonic() - self._checked >= self.check_interval:
+                    self._refresh()
+                    self._checked = time.monotonic()
+        return self._snapshot
+
+    def _refresh(self) -> None:
+        pointer = os.path.join(self.directory,CURRENT)
+        try:
+            mtime = os.stat(pointer).st_mtime_ns
+            if self._current is not None and self._current[0] == mtime:
+                return
+            with open(pointer) as f:
+                name = f.read().strip()
+            if self._current is None or self._current[1] != name:
+                self._snapshot = CatalogSnapshot(os.path.join(self.directory,name))
+                log.info('catalog snapshot mapped',extra={'path':self._snapshot.path,
+                                                          'snapshot_version':self._snapshot.version})
+            self._current = (mtime,name)
+        except FileNotFoundError:
+            pass
+        except (OSError,ValueError,struct.error):
+            # keeps the mapped snapshot, the next check tries again
+            log.exception('cannot map the catalog snapshot',extra={'directory':self.directory})
+
+
+def main():
+    from instrumentation import setup_logging
+    from db_connections import Connection,RecipeDb
+    from settings import USERNAME,PASSWORD,HOST,DBNAME,LOG_LEVEL,CATALOG_SNAPSHOT_DIR
+
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--directory',default=CATALOG_SNAPSHOT_DIR or 'catalog_snapshots')
+    args = parser.parse_args()
+    setup_logging(LOG_LEVEL)
+
+    conn = Connection(username=USERNAME,password=PASSWORD,host=HOST,min_size=1,max_size=1)
+    recipe_db = RecipeDb(dbname=DBNAME,connection=conn)
+    start = time.perf_counter()
+    try:
+        path = export(recipe_db,args.directory)
+    finally:
+        recipe_db.close_connection()
+    print(f'{path} ({os.path.getsize(path)/2**20:.1f} MiB) in {time.perf_counter() - start:.1f} s')
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,29 @@
+import base64
+import json
+import logging
+import threading
+import time
+from bisect import bisect_right
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+import numpy as np
 import pymysql
 
+from cache import LRUCache, Versions
+from instrumentation import QueryStats
+from search_engine import RecipeSearchIndex, fold
+from dietary import DietaryMasks, preference_mask
+from nutrition import NutritionIndex, NUTRIENTS, MEALS, DEFAULT_QUANTITY, parse_quantity
+from meal_planner import MealPlanner
+from recommender import RecipeRecommender
+from autocomplete import Autocomplete
+from catalog_snapshot import SharedCatalog
 
 
+log = logging.getLogger('recipe_hub.db')
+
 def convert_time(time:int):
     hours = time // 60
 
@@ -15,13 +37,166 @@ def convert_time(time:int):
     else:
         return f'{minutes} {"mins" if minutes>1 else "min"}'
 
+def format_date(date:datetime, now:datetime) -> str:
+    '''
+        Formats a comment timestamp relative to now, e.g. "Yesterday" or "3 hours ago"
+        Args:
+            date: the datetime to format
+            now: the current server time
+    '''
+    if isinstance(date,str):
+        date = datetime.fromisoformat(date)
+
+    year,month,day = date.year,date.month,date.day
+    monthName = date.strftime('%B')
+    yearCurrent,monthCurrent,dayCurrent = now.year,now.month,now.day
+
+    if (yearCurrent - year) > 5:
+        return f"{(yearCurrent - year)} years ago"
+    
+    elif (yearCurrent - year) > 1:
+        return f"{month}/{day}/{year}"
+    
+    elif (yearCurrent - year) == 1:
+        return f"{monthName} {day}"
+    
+    else: #Same Year
+        if monthCurrent > month:
+            return f"{monthName} {day}"
+        
+        else: #Same month
+            if dayCurrent - day > 7:
+                return f"{(dayCurrent - day)} days ago"
+            
+            elif dayCurrent - day > 1:
+                return date.strftime('%A')
+            
+            elif dayCurrent - day == 1:
+                return "Yesterday"
+            
+            else: # Same day
+                hours,mins,secs = date.hour,date.minute,date.second
+                hoursCurrent,minsCurrent,secsCurrent = now.hour,now.minute,now.second
+
+                if hoursCurrent > hours:
+                    return f"{hoursCurrent - hours} hour{'s' if hoursCurrent - hours >1 else ''} ago"
+                
+                elif minsCurrent > mins:
+                    return f"{minsCurrent - mins} min{'s' if minsCurrent - mins >1 else ''} ago"
+                
+                else:
+                    return f"{secsCurrent - secs} second{'s' if secsCurrent - secs >1 else ''} ago"
+
+_MISSING = object()
+
+def columns(rows: list, *fields) -> tuple:
+    '''
+        Turns result rows into one NumPy array per field
+        Args:
+            rows: list of row dicts
+            fields: (column name, dtype) pairs
+    '''
+    arrays = []
+    for name,dtype in fields:
+        values = list(map(itemgetter(name),rows))
+        if dtype is str:
+            arrays.append(np.array(values,dtype=str) if values else np.array([],dtype=str))
+        else:
+            arrays.append(np.fromiter(values,dtype=dtype,count=len(values)))
+    return tuple(arrays)
+
+_LIKE_TABLES = {'like_recipe':'user_liked_recipes','like_meal_plan':'user_favorite_meal_plans'}
+_LIKE_KINDS = {table:kind for kind,table in _LIKE_TABLES.items()}
+
+def _now() -> str:
+    # queued writes are journaled as json, timestamps travel as mysql datetime strings
+    return datetime.now().isoformat(sep=' ',timespec='seconds')
+
+def _queued_review_row(op: dict) -> dict:
+    return {'user_id':op['user_id'],'recipe_name':op['name'],'user_comment':op['comment'],
+            'rating':op['rating'],'commented_datetime':datetime.fromisoformat(op['when'])}
+
+def _pairs_clause(pairs) -> str:
+    '''
+        Placeholder list for a "(a,b) IN ((%s,%s),...)" clause
+    '''
+    return '(' + ','.join(['(%s,%s)']*len(pairs)) + ')'
+
+def in_clause(values) -> str:
+    '''
+        Placeholder list for a prepared "IN (...)" clause with one %s per value
+    '''
+    return '(' + ','.join(['%s']*len(values)) + ')'
+
+def encode_cursor(key: tuple) -> str:
+    '''
+        Opaque url-safe token for the sort key of the last row of a page
+    '''
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode().rstrip('=')
+
+def decode_cursor(token: str):
+    '''
+        Sort key of a cursor token, None for a missing or malformed token
+    '''
+    if not token:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token + '='*(-len(token) % 4)))
+    except ValueError:
+        return None
+    return tuple(key) if isinstance(key,list) else None
+
+class PoolTimeout(pymysql.err.OperationalError):
+    '''
+        Raised when no pooled connection becomes available within the
+        pool timeout
+    '''
+
+
 class Connection:
-    def __init__(self,username: str, password:str , host: str = 'localhost'):
+    def __init__(self,username: str, password:str , host: str = 'localhost',
+                 min_size: int = 1, max_size: int = 10, timeout: float = 10.0,
+                 ping_interval: float = 30.0, stats: QueryStats = None):
+        '''
+            Thread-safe pool of pymysql connections
+            Args:
+                min_size: connections opened eagerly by connect()
+                max_size: upper bound on open connections
+                timeout: seconds to wait for a free connection before raising PoolTimeout
+                ping_interval: idle seconds after which a connection is pinged before reuse
+                stats: records the duration of every query and procedure call
+        '''
         self.username = username
         self.password  = password
         self.host = host
-        self.error = False
-        self.error_message = ''
+        self.min_size = min_size
+        self.max_size = max(max_size,1)
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.stats = stats
+        self.database = None
+
+        self._idle = [] # (connection, last_used) pairs, most recently used last
+        self._size = 0
+        self._available = threading.Condition()
+        self._local = threading.local()
+
+    # error state is kept per thread so concurrent requests do not see each other's errors
+    @property
+    def error(self) -> bool:
+        return getattr(self._local,'error',False)
+
+    @error.setter
+    def error(self,value: bool):
+        self._local.error = value
+
+    @property
+    def error_message(self) -> str:
+        return getattr(self._local,'error_message','')
+
+    @error_message.setter
+    def error_message(self,value: str):
+        self._local.error_message = value
 
     def reset_error(self):
         self.error = False
@@ -30,20 +205,123 @@ class Connection:
     def connect(self,dbname:str):
         self.database = dbname
         try:
-            self.conn = pymysql.connect(
-                host = self.host,
-                user = self.username,
-                password = self.password,
-                database = self.database,
-                cursorclass = pymysql.cursors.SSDictCursor,
-                autocommit=True
-            )
+            opened = [self._open() for _ in range(max(self.min_size - self._size,0))]
+            with self._available:
+                self._size += len(opened)
+                self._idle.extend((db,time.monotonic()) for db in opened)
+                self._available.notify_all()
         
         except pymysql.Error as e:
             self.error = True
             self.error_message = str(e)
             return e
-    
+
+    def _open(self):
+        return pymysql.connect(
+            host = self.host,
+            user = self.username,
+            password = self.password,
+            database = self.database,
+            cursorclass = pymysql.cursors.SSDictCursor,
+            autocommit=True
+        )
+
+    def _discard(self,db):
+        try:
+            db.close()
+        except pymysql.Error:
+            pass
+        with self._available:
+            self._size -= 1
+            self._available.notify()
+
+    def acquire(self):
+        '''
+            Checks a connection out of the pool, opening a new one while the pool
+            is below max_size and waiting up to timeout seconds otherwise.
+            Idle connections are pinged (and reconnected) before being handed out.
+        '''
+        deadline = time.monotonic() + self.timeout
+        with self._available:
+            while not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(2013,f'No database connection available after {self.timeout}s')
+                self._available.wait(remaining)
+
+            if self._idle:
+                db,last_used = self._idle.pop()
+            else:
+                db,last_used = None,None
+                self._size += 1
+
+        if db is None:
+            try:
+                return self._open()
+            except pymysql.Error:
+                with self._available:
+                    self._size -= 1
+                    self._available.notify()
+                raise
+
+        if not db.open or time.monotonic() - last_used > self.ping_interval:
+            try:
+                db.ping(reconnect=True)
+            except pymysql.Error:
+                self._discard(db)
+                return self.acquire()
+        return db
+
+    def release(self,db):
+        '''
+            Returns a connection to the pool. Connections whose socket was lost
+            are closed instead of being reused.
+        '''
+        if not db.open:
+            self._discard(db)
+            return
+        with self._available:
+            self._idle.append((db,time.monotonic()))
+            self._available.notify()
+
+    def begin_request(self):
+        '''
+            Binds one pooled connection to the current thread until end_request,
+            so every query of a request runs on the same connection.
+        '''
+        self.reset_error()
+        if getattr(self._local,'conn',None) is None:
+            self._local.conn = self.acquire()
+
+    def end_request(self):
+        db = getattr(self._local,'conn',None)
+        self._local.conn = None
+        if db is not None:
+            self.release(db)
+
+    @contextmanager
+    def checkout(self):
+        '''
+            Yields the connection bound to the current request, or a connection
+            checked out just for the duration of the block.
+        '''
+        db = getattr(self._local,'conn',None)
+        if db is not None:
+            yield db
+            return
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    @property
+    def conn(self):
+        '''
+            The connection bound to the current request, if any
+        '''
+        return getattr(self._local,'conn',None)
+
     def execute_query(self,query:str, args: tuple = ()) -> list:
         '''
             This method executes the given query with the given args
@@ -53,26 +331,59 @@ class Connection:
             Returns:
                 a list of all the rows returned from the query
         '''
-        cur = self.conn.cursor()
-        cur.execute(query,args)
-        result = cur.fetchall()
-        cur.close()
+        with self.checkout() as db:
+            cur = db.cursor()
+            start = time.perf_counter()
+            try:
+                cur.execute(query,args)
+                result = cur.fetchall()
+            finally:
+                cur.close()
+                self._record(query,start)
         return result
 
+    @contextmanager
+    def transaction(self):
+        '''
+            Yields a cursor whose statements are committed together when the block
+            ends, or rolled back when it raises
+        '''
+        with self.checkout() as db:
+            cur = db.cursor(pymysql.cursors.DictCursor)
+            start = time.perf_counter()
+            db.begin()
+            try:
+                yield cur
+                db.commit()
+            except BaseException:
+                db.rollback()
+                raise
+            finally:
+                cur.close()
+                self._record('TRANSACTION',start)
+
+    def _record(self,statement:str,start:float) -> None:
+        if self.stats is not None:
+            self.stats.record(statement,time.perf_counter() - start)
+
 
     def insert_into_table(self, table:str , fields:str , values:tuple ) -> None:
 
         query = f"INSERT INTO {table} {fields}"+ "\n" +  f"VALUES {values};"
 
-        cur = self.conn.cursor()
         try:
-            cur.execute(query)
+            with self.checkout() as db:
+                cur = db.cursor()
+                start = time.perf_counter()
+                try:
+                    cur.execute(query)
+                finally:
+                    cur.close()
+                    self._record(f'INSERT INTO {table} {fields}',start)
         except pymysql.Error as e:
             self.error = True
             self.error_message = str(e)
             return e
-        finally:
-            cur.close()
         
 
     
@@ -85,103 +396,842 @@ class Connection:
             Returns:
                 a list of all the rows returned from the procedure
         '''
-        cur = self.conn.cursor()
         result = []
         try:
-            cur.callproc(proc,args)
-            result = cur.fetchall()
+            with self.checkout() as db:
+                cur = db.cursor()
+                start = time.perf_counter()
+                try:
+                    cur.callproc(proc,args)
+                    result = cur.fetchall()
+                finally:
+                    cur.close()
+                    self._record(f'CALL {proc}',start)
         except pymysql.Error as e:
             self.error = True
-            self.error_message = e.args[1]
+            self.error_message = e.args[1] if len(e.args) > 1 else str(e)
             result = [] #return empty list if exception occured
-        finally:
-            cur.close()
-            return result
+        return result
+
+    def close(self):
+        '''
+            Closes every idle pooled connection
+        '''
+        with self._available:
+            idle,self._idle = self._idle,[]
+            self._size -= len(idle)
+            self._available.notify_all()
+        for db,_ in idle:
+            try:
+                db.close()
+            except pymysql.Error:
+                pass
     
 
 
 
     
 class RecipeDb:
-    def __init__(self,dbname : str ,connection: Connection):
+    def __init__(self,dbname : str ,connection: Connection, cache_user_likes: bool = False,
+                 cache: LRUCache = None,snapshot: SharedCatalog = None):
+        '''
+            Args:
+                cache_user_likes: keep each user's liked recipes and meal plans in
+                    the cache, invalidated by the toggle methods of this instance.
+                    Other processes see a like once their entry expires.
+                cache: read-through cache for catalog data, a default sized one is
+                    created when not given
+                snapshot: memory-mapped catalog shared by the worker processes, recipe
+                    rows and pages are read from it instead of the database and cache
+        '''
         self.dbname = dbname
         self.conn = connection
+        self.cache = cache if cache is not None else LRUCache()
+        # ("catalog",) for recipes and ingredients, ("activity",) for likes anywhere,
+        # ("recipe", name) for a recipe's likes and reviews, ("user", id) for a user's own data
+        self.versions = Versions(ttl=self.cache.ttl)
+        self.cache_user_likes = cache_user_likes
+        self._search_index = None
+        self._search_index_lock = threading.Lock()
+        self._dietary_masks = None
+        self._nutrition = None
+        self._meal_planner = None
+        self._recommender = None
+        self._autocomplete = None
+        self._built = {} # attribute of an index rebuilt after the ttl -> monotonic time it was built
+        self._rebuilding = set() # attributes of the indexes being rebuilt in the background
+        self.snapshot = snapshot
+        self._snapshot_version = None
+        self._snapshot_stale = set() # folded names of recipes written since the snapshot was mapped
+        self.write_behind = None # a WriteBehind queueing likes and reviews, see apply_writes
         self.conn.connect(dbname)
     
 
+    def _cached(self,key,loader):
+        '''
+            Read-through lookup in the catalog cache. Results of a load that
+            set the connection error are returned but not cached.
+        '''
+        value = self.cache.get(key,_MISSING)
+        if value is _MISSING:
+            had_error = self.conn.error
+            value = loader()
+            if had_error or not self.conn.error:
+                self.cache.set(key,value)
+        return value
+
+    def _catalog_snapshot(self):
+        '''
+            The mapped catalog snapshot, None when there is none. A newly published
+            one means the catalog was changed by another process, so the catalog
+            version is bumped and the indexes built from bulk queries are dropped.
+        '''
+        if self.snapshot is None:
+            return None
+        snapshot = self.snapshot.snapshot
+        if snapshot is not None and snapshot.version != self._snapshot_version:
+            if self._snapshot_version is not None:
+                self._nutrition = None
+                self._meal_planner = None
+                self._autocomplete = None
+                self._search_index = None
+                self._dietary_masks = None
+                self._built.pop('_recommender',None) # rebuilt in the background, see _refresh_index
+                self.versions.bump(('catalog',))
+            self._snapshot_version = snapshot.version
+            self._snapshot_stale = set()
+        return snapshot
+
+    def cache_stats(self) -> dict:
+        return self.cache.stats()
+
     def get_top_recipes(self,limit:int = 8) -> list:
         #rows = self.conn.call_procedure('get_top_rated_recipes',(limit,))
 
-        query = 'SELECT recipe_name FROM recipes ORDER BY rating DESC,recipe_name LIMIT %d;'%limit
-        recipes = []
-        rows = self.conn.execute_query(query)
-        for row in rows:
-            recipes.append(self.get_recipe(row['recipe_name']))
-        
-        return recipes
+        # recipes.rating is only changed by catalog imports, so the ttl bounds staleness here
+        def load():
+            query = 'SELECT recipe_name FROM recipes ORDER BY rating DESC,recipe_name LIMIT %d;'%limit
+            return [row['recipe_name'] for row in self.conn.execute_query(query)]
 
-    def get_images_of_recipes(self,recipes:tuple = []) -> list:
-        
-        query = 'SELECT * FROM recipe_images IF recipe IN %s'%str(recipes);
+        return self.get_recipes(self._cached(('top_recipes',limit),load))
+
+    def get_images_of_recipes(self,recipes:tuple = ()) -> list:
+        if len(recipes) < 1:
+            return []
+        query = f'SELECT * FROM recipe_images WHERE recipe_name IN {in_clause(recipes)};'
+
+        return self.conn.execute_query(query,tuple(recipes))
+
+    def get_like_counts_of_recipes(self,recipes:tuple = ()) -> dict:
+        keys = {name:('like_count',name.casefold()) for name in recipes}
+        cached = self.cache.get_many(keys.values())
+        like_counts = {name:cached[key] for name,key in keys.items() if key in cached}
+
+        missing = tuple(name for name in keys if name not in like_counts)
+        if len(missing) < 1:
+            return like_counts
+        query = f'SELECT recipe_name,like_count FROM recipe_stats WHERE recipe_name IN {in_clause(missing)};'
+        rows = self.conn.execute_query(query,missing)
+        counts = {row['recipe_name'].casefold():row['like_count'] for row in rows}
+        for name in missing:
+            like_counts[name] = counts.get(name.casefold(),0)
+            self.cache.set(keys[name],like_counts[name])
+        return like_counts
+
+    def _get_recipe_rows(self,recipes:tuple) -> dict:
+        '''
+            Returns the recipes rows with their images, keyed by case-folded name
+        '''
+        rows = {}
+        snapshot = self._catalog_snapshot()
+        if snapshot is not None:
+            for name in recipes:
+                row = None if fold(name) in self._snapshot_stale else snapshot.recipe(name)
+                if row is not None:
+                    rows[name.casefold()] = row
+
+        keys = {name.casefold():('recipe',name.casefold()) for name in recipes if name.casefold() not in rows}
+        cached = self.cache.get_many(keys.values())
+        rows.update({folded:cached[key] for folded,key in keys.items() if key in cached})
+
+        missing = tuple(name for name in recipes if name.casefold() not in rows)
+        if len(missing) < 1:
+            return rows
+
+        query = f'SELECT * FROM recipes WHERE recipe_name IN {in_clause(missing)};'
+        loaded = {row['recipe_name']:row for row in self.conn.execute_query(query,missing)}
+
+        for row in loaded.values():
+            row['images'] = []
+            row['rating'] = float(row['rating'])
+        for image in self.get_images_of_recipes(tuple(loaded)):
+            loaded[image['recipe_name']]['images'].append(image)
+
+        # the table collation is case-insensitive, so match names the same way
+        for name,row in loaded.items():
+            rows[name.casefold()] = row
+            self.cache.set(('recipe',name.casefold()),row)
+        return rows
+
+    def get_recipes(self,recipes:list) -> list:
+        '''
+            Loads the card details (row, images and like count) of many recipes
+            with one query each instead of three queries per recipe
+            Args:
+                recipes: list of recipe names
+            Returns:
+                a list of recipe dicts in the same order as the given names,
+                names that are not in the recipes table are skipped
+        '''
+        names = tuple(dict.fromkeys(recipes))
+        if len(names) < 1:
+            return []
 
-        return self.conn.execute_query(query)
+        rows = self._get_recipe_rows(names)
+        like_counts = self.get_like_counts_of_recipes(tuple(row['recipe_name'] for row in rows.values()))
+
+        recipe_details = []
+        for name in recipes:
+            row = rows.get(name.casefold())
+            if row is None:
+                continue
+            recipe = dict(row) # callers add per-request keys, keep the cached row intact
+            recipe['like_count'] = like_counts.get(row['recipe_name'],0)
+            recipe_details.append(recipe)
+        
+        return recipe_details
     
     def get_cuisine_names(self) -> list:
-        return self.conn.call_procedure('get_all_cuisine_names')
+        return self._cached(('cuisines',),lambda: self.conn.call_procedure('get_all_cuisine_names'))
 
     def get_all_recipe_categories(self) -> list:
         query = f'SELECT * FROM recipe_categories;'
-        return self.conn.execute_query(query)
+        return self._cached(('recipe_categories',),lambda: self.conn.execute_query(query))
     
-    def search_recipes(self,query:str,user_id:int = -1):
-        query = f"%{query}%"
-        if user_id == -1:
-            rows = self.conn.call_procedure('search_recipe_without_user',(query,))
-        
+    @property
+    def search_index(self) -> RecipeSearchIndex:
+        '''
+            Inverted index over recipe and ingredient names, built on first use.
+            reindex_recipes updates it for the writes of this process, the writes
+            of other processes and of ingest.py arrive when it is rebuilt after
+            the cache ttl, see _refresh_index.
+        '''
+        self._catalog_snapshot() # drops the index when another process published a new catalog
+        index = self._search_index
+        if index is None:
+            with self._search_index_lock:
+                index = self._search_index
+                if index is None:
+                    index = self._search_index = self._build_search_index()
+                    self._built['_search_index'] = time.monotonic()
+        else:
+            self._refresh_index('_search_index',index,self._build_search_index)
+        return index
+
+    def _build_search_index(self) -> RecipeSearchIndex:
+        recipes = self.conn.execute_query('SELECT recipe_name,rating FROM recipes;')
+        ingredients = self.conn.execute_query('SELECT recipe_name,ingredient_name FROM recipe_ingredients;')
+        return RecipeSearchIndex.build(recipes,ingredients)
+
+    def _refresh_index(self,attribute:str,index,build) -> None:
+        '''
+            Rebuilds the index held in attribute on a background thread once it is
+            older than the cache ttl, readers keep using the stale one meanwhile
+            Args:
+                attribute: name of the attribute holding the index, e.g. "_autocomplete"
+                index: the index the caller got from it
+                build: builds a new index from the database
+        '''
+        if time.monotonic() - self._built.get(attribute,0.0) <= self.cache.ttl:
+            return
+        with self._search_index_lock:
+            if attribute in self._rebuilding or getattr(self,attribute) is not index:
+                return
+            self._rebuilding.add(attribute)
+        threading.Thread(target=self._rebuild_index,args=(attribute,index,build),
+                         name=f'{attribute.strip("_")}-rebuild',daemon=True).start()
+
+    def _rebuild_index(self,attribute:str,stale,build) -> None:
+        try:
+            index = build()
+        except Exception:
+            # the stale index keeps serving, the next lookup tries again
+            log.exception('could not rebuild an in-memory index',extra={'index':attribute})
+            index = None
+        with self._search_index_lock:
+            self._rebuilding.discard(attribute)
+            # readers keep whichever index they got, the new one is swapped in whole,
+            # unless a catalog change dropped the stale one while this was built
+            if index is not None and getattr(self,attribute) is stale:
+                setattr(self,attribute,index)
+                self._built[attribute] = time.monotonic()
+
+    @property
+    def autocomplete(self) -> Autocomplete:
+        '''
+            Prefix index over recipe and ingredient names, built on first use and
+            rebuilt when the catalog changes. Once its popularity is older than
+            the cache ttl it is rebuilt in the background, see _refresh_index.
+        '''
+        index = self._autocomplete
+        if index is None:
+            with self._search_index_lock:
+                index = self._autocomplete
+                if index is None:
+                    index = self._autocomplete = self._build_autocomplete()
+                    self._built['_autocomplete'] = time.monotonic()
+        else:
+            self._refresh_index('_autocomplete',index,self._build_autocomplete)
+        return index
+
+    def _build_autocomplete(self) -> Autocomplete:
+        recipes = self.conn.execute_query(
+            'SELECT r.recipe_name,COALESCE(s.like_count + s.review_count,0) AS popularity FROM recipes r\n'+\
+            'LEFT JOIN recipe_stats s ON s.recipe_name = r.recipe_name;')
+        ingredients = self.conn.execute_query(
+            'SELECT i.ingredient_name,COUNT(ri.recipe_name) AS popularity FROM ingredients i\n'+\
+            'LEFT JOIN recipe_ingredients ri ON ri.ingredient_name = i.ingredient_name\n'+\
+            'GROUP BY i.ingredient_name;')
+        return Autocomplete.build(recipes,ingredients)
+
+    def suggest(self,prefix:str,limit:int = 8,kind:str = None) -> list:
+        '''
+            Recipe and ingredient names matching what the user typed so far
+            Returns:
+                (name, kind) tuples, kind is "recipe" or "ingredient"
+        '''
+        return self.autocomplete.suggest(prefix,limit,kind)
+
+    @property
+    def dietary_masks(self) -> DietaryMasks:
+        '''
+            Dietary bitmask of every recipe, built on first use and kept up to
+            date like search_index
+        '''
+        self._catalog_snapshot()
+        masks = self._dietary_masks
+        if masks is None:
+            with self._search_index_lock:
+                masks = self._dietary_masks
+                if masks is None:
+                    masks = self._dietary_masks = self._build_dietary_masks()
+                    self._built['_dietary_masks'] = time.monotonic()
         else:
-            rows = self.conn.call_procedure('search_recipe_with_user',(query,user_id))
+            self._refresh_index('_dietary_masks',masks,self._build_dietary_masks)
+        return masks
 
-        recipes = []
+    def _build_dietary_masks(self) -> DietaryMasks:
+        query = 'SELECT recipe_name,vegan,vegetarian,gluten_free,eggetarian FROM recipes;'
+        return DietaryMasks.build(self.conn.execute_query(query))
+
+    def get_user_preference_mask(self,user_id:int):
+        '''
+            Bitmask of the recipe flags the user accepts, None when the user has no preferences
+        '''
+        return self._cached(('preference_mask',user_id),lambda: preference_mask(
+            [row['preference'] for row in self.get_user_preferences(user_id)]))
+
+    def filter_by_preferences(self,recipes:list,user_id:int = -1) -> list:
+        '''
+            Keeps the recipe names matching the user's dietary preferences, in order
+        '''
+        if user_id == -1:
+            return list(recipes)
+        return self.dietary_masks.filter(list(recipes),self.get_user_preference_mask(user_id))
+
+    def reindex_recipes(self,recipes:list) -> None:
+        '''
+            Re-reads the given recipes and their ingredients into the search index
+            and the dietary masks, recipes no longer in the catalog are dropped
+        '''
+        names = tuple(dict.fromkeys(recipes))
+        if len(names) < 1:
+            return
+        query = 'SELECT recipe_name,rating,vegan,vegetarian,gluten_free,eggetarian FROM recipes\n'+\
+            f'WHERE recipe_name IN {in_clause(names)};'
+        rows = self.conn.execute_query(query,names)
+        # rebuilt on next use, they are a few bulk queries
+        self._nutrition = None
+        self._meal_planner = None
+        self._autocomplete = None
+        if self._dietary_masks is not None:
+            for row in rows:
+                self._dietary_masks.set_recipe(row)
+            found = {row['recipe_name'].casefold() for row in rows}
+            for name in names:
+                if name.casefold() not in found:
+                    self._dietary_masks.remove_recipe(name)
+        if self._search_index is None and self._recommender is None:
+            return
+        query = f'SELECT recipe_name,ingredient_name FROM recipe_ingredients WHERE recipe_name IN {in_clause(names)};'
+        ingredients = {}
+        for row in self.conn.execute_query(query,names):
+            ingredients.setdefault(row['recipe_name'],[]).append(row['ingredient_name'])
+        if self._recommender is not None:
+            for name in names:
+                self._recommender.set_recipe(name,ingredients.get(name,[]))
+        if self._search_index is None:
+            return
+
+        found = set()
         for row in rows:
-            recipes.append(self.get_recipe(row['recipe_name']))
-        
+            found.add(row['recipe_name'])
+            self._search_index.add_recipe(row['recipe_name'],row['rating'],ingredients.get(row['recipe_name'],[]))
+        for name in names:
+            if name not in found:
+                self._search_index.remove_recipe(name)
+
+    def upsert_recipes(self,recipes:list) -> dict:
+        '''
+            Inserts or replaces scraped recipes with their ingredients, steps, images
+            and categories in one transaction, a few multi-row statements per table.
+            Likes, reviews and the dietary flags of existing recipes are kept. New
+            recipes get NULL dietary flags, unknown rather than "not vegan", so
+            they are not offered to users with dietary preferences until classified.
+            Args:
+                recipes: dicts with recipe_name, tagline, rating, preparation_time,
+                    cooking_time, cuisine_name (None keeps the cuisine of an existing
+                    recipe), ingredients ((ingredient_name, quantity)
+                    pairs), instructions, images and categories
+            Returns:
+                the number of recipes written and of the cuisines, categories and
+                ingredients they added (new ingredients have no nutrition yet)
+        '''
+        counts = {'recipes':0,'new_cuisines':0,'new_categories':0,'new_ingredients':0}
+        if len(recipes) < 1:
+            return counts
+        names = tuple(recipe['recipe_name'] for recipe in recipes)
+        # a page saved outside a cuisine folder has no cuisine, recipes.cuisine_name is nullable
+        cuisines = sorted({recipe['cuisine_name'] for recipe in recipes if recipe['cuisine_name']})
+        categories = sorted({category for recipe in recipes for category in recipe['categories']})
+        ingredients = sorted({name for recipe in recipes for name,_ in recipe['ingredients']})
+
+        with self.conn.transaction() as cur:
+            # executemany folds "INSERT ... VALUES (%s,...)" into multi-row inserts
+            counts['new_cuisines'] = cur.executemany('INSERT IGNORE INTO cuisines (cuisine_name) VALUES (%s);',
+                                                     cuisines) or 0
+            counts['new_categories'] = cur.executemany(
+                'INSERT IGNORE INTO recipe_categories (recipe_category_name) VALUES (%s);',categories) or 0
+            counts['new_ingredients'] = cur.executemany(
+                'INSERT IGNORE INTO ingredients (ingredient_name) VALUES (%s);',ingredients) or 0
+
+            query = 'INSERT INTO recipes (recipe_name,tagline,rating,preparation_time,cooking_time,vegan,gluten_free,\n'+\
+                'vegetarian,eggetarian,cuisine_name) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)\n'+\
+                'ON DUPLICATE KEY UPDATE tagline = VALUES(tagline),rating = VALUES(rating),\n'+\
+                'preparation_time = VALUES(preparation_time),cooking_time = VALUES(cooking_time),\n'+\
+                'cuisine_name = COALESCE(VALUES(cuisine_name),cuisine_name);'
+            cur.executemany(query,[(recipe['recipe_name'],recipe['tagline'],recipe['rating'],
+                                    recipe['preparation_time'],recipe['cooking_time'],None,None,None,None,
+                                    recipe['cuisine_name']) for recipe in recipes])
+
+            for table in ('recipe_ingredients','recipe_instructions','recipe_images','recipes_to_categories'):
+                cur.execute(f'DELETE FROM {table} WHERE recipe_name IN {in_clause(names)};',names)
+            # IGNORE: the collation is accent and case insensitive, two scraped spellings can be one key
+            cur.executemany('INSERT IGNORE INTO recipe_ingredients (recipe_name,ingredient_name,quantity) VALUES (%s,%s,%s);',
+                            [(recipe['recipe_name'],name,quantity) for recipe in recipes
+                             for name,quantity in recipe['ingredients']])
+            cur.executemany('INSERT IGNORE INTO recipe_instructions (step_number,recipe_name,instruction) VALUES (%s,%s,%s);',
+                            [(step,recipe['recipe_name'],instruction) for recipe in recipes
+                             for step,instruction in enumerate(recipe['instructions'],1)])
+            cur.executemany('INSERT IGNORE INTO recipe_images (recipe_name,recipe_image) VALUES (%s,%s);',
+                            [(recipe['recipe_name'],image) for recipe in recipes for image in recipe['images']])
+            cur.executemany('INSERT IGNORE INTO recipes_to_categories (recipe_name,recipe_category_name) VALUES (%s,%s);',
+                            [(recipe['recipe_name'],category) for recipe in recipes
+                             for category in recipe['categories']])
+        counts['recipes'] = len(names)
+
+        # top_recipes is left to its ttl, see get_top_recipes
+        keys = [('cuisines',),('recipe_categories',)]
+        keys += [(kind,name.casefold()) for name in names for kind in ('recipe','recipe_page')]
+        keys += [('shopping_list',fold(name)) for name in names]
+        keys += [('cuisine_recipes',cuisine.casefold()) for cuisine in cuisines]
+        keys += [('category_recipes',category.casefold()) for category in categories]
+        self.cache.invalidate(*keys)
+        self._snapshot_stale.update(fold(name) for name in names)
+        self.reindex_recipes(list(names))
+        self.versions.bump(('catalog',))
+        return counts
 
-        return recipes
+    def search_recipes(self,query:str,user_id:int = -1):
+        names = self.search_index.search(query)
+        return self.get_recipes(self.filter_by_preferences(names,user_id))
 
     def get_recipes_by_category(self,category:str):
-        rows = self.conn.call_procedure('get_recipes_by_category',(category,))
-        recipes = []
-        for row in rows:
-            recipes.append(self.get_recipe(row['recipe_name']))
-        
-        return recipes
+        return self.get_recipes(self._category_recipe_names(category))
+
+    def _category_recipe_names(self,category:str) -> list:
+        return self._cached(('category_recipes',category.casefold()),lambda: [
+            row['recipe_name'] for row in self.conn.call_procedure('get_recipes_by_category',(category,))])
+
+    def _cuisine_recipe_names(self,cuisine_name:str) -> list:
+        return self._cached(('cuisine_recipes',cuisine_name.casefold()),lambda: [
+            row['recipe_name'] for row in
+            self.conn.call_procedure('search_recipe_with_cuisine_without_user',(cuisine_name,))])
+
+    def _rank_by_rating(self,names:list) -> list:
+        ratings = self.search_index.ratings_of(names)
+        return sorted(((-rating,name),name) for name,rating in zip(names,ratings))
+
+    def rank_search(self,query:str,user_id:int = -1) -> list:
+        '''
+            Search matches of the user's preferences as (sort key, recipe_name)
+            pairs, best match first, for get_recipes_page and iter_recipes
+        '''
+        matches = self.search_index.search_scored(query)
+        keep = set(self.filter_by_preferences([name for name,_,_ in matches],user_id))
+        return [((-score,-rating,name),name) for name,score,rating in matches if name in keep]
+
+    def rank_cuisine(self,cuisine_name:str,user_id:int = -1) -> list:
+        '''
+            Recipes of a cuisine matching the user's preferences, by rating then name
+        '''
+        return self._rank_by_rating(self.filter_by_preferences(self._cuisine_recipe_names(cuisine_name),user_id))
+
+    def rank_category(self,category:str) -> list:
+        '''
+            Recipes of a category, by rating then name
+        '''
+        return self._rank_by_rating(self._category_recipe_names(category))
+
+    def get_recipes_page(self,ranked:list,cursor:str = None,page_size:int = 24) -> dict:
+        '''
+            One page of a ranked list of recipes. Only the page is loaded, the
+            cursor is the sort key of the last recipe of the previous page, so
+            pages stay stable when recipes are added before the cursor.
+            Args:
+                ranked: (sort key, recipe_name) pairs in sort key order, from the rank_ methods
+                cursor: next_cursor of the previous page, None for the first page
+            Returns:
+                a dict with recipes (the page), total (matches over all pages) and
+                next_cursor (None on the last page)
+        '''
+        start = 0
+        after = decode_cursor(cursor)
+        # a cursor of another kind of list starts over
+        if after is not None and len(ranked) > 0 and len(after) == len(ranked[0][0]):
+            try:
+                start = bisect_right(ranked,after,key=itemgetter(0))
+            except TypeError:
+                start = 0
+        page = ranked[start:start + page_size]
+        return {
+            'recipes':self.get_recipes([name for _,name in page]),
+            'total':len(ranked),
+            'next_cursor':encode_cursor(page[-1][0]) if start + page_size < len(ranked) else None,
+        }
+
+    def iter_recipes(self,ranked:list,batch_size:int = 50):
+        '''
+            Yields the recipes of a ranked list in order, loading batch_size
+            recipes at a time, for streamed responses
+        '''
+        for start in range(0,len(ranked),batch_size):
+            yield from self.get_recipes([name for _,name in ranked[start:start + batch_size]])
 
     def get_meal_plans(self):
         query = 'SELECT * FROM meal_plans;'
-        return self.conn.execute_query(query)
+        meal_plans = self._cached(('meal_plans',),lambda: self.conn.execute_query(query))
+        return [dict(plan) for plan in meal_plans]
+
+    def get_meal_plan(self,meal_plan:str) -> dict:
+        for plan in self.get_meal_plans():
+            if plan['meal_plan_name'].casefold() == meal_plan.casefold():
+                return plan
+        return None
+
+    @property
+    def nutrition(self) -> NutritionIndex:
+        '''
+            Nutrition totals of every recipe, built on first use
+        '''
+        nutrition = self._nutrition
+        if nutrition is None:
+            with self._search_index_lock:
+                nutrition = self._nutrition
+                if nutrition is None:
+                    recipe_ingredients = self.conn.execute_query(
+                        'SELECT recipe_name,ingredient_name,quantity FROM recipe_ingredients;')
+                    ingredients = self.conn.execute_query(
+                        f'SELECT ingredient_name,{",".join(NUTRIENTS)} FROM ingredients;')
+                    nutrition = self._nutrition = NutritionIndex.build(recipe_ingredients,ingredients)
+        return nutrition
+
+    def get_recipe_nutrition(self,recipe:str) -> dict:
+        '''
+            Total calories, protein, fats, carbs and sugar of a recipe
+        '''
+        return self.nutrition.recipe_totals(recipe)
+
+    def get_basket_nutrition(self,recipes:list,servings:list = None) -> dict:
+        '''
+            Nutrition totals of a list of recipes, optionally with a serving count per recipe
+        '''
+        return self.nutrition.basket_totals(recipes,servings)
+
+    @property
+    def meal_planner(self) -> MealPlanner:
+        '''
+            Meal plan generator over the whole catalog, built on first use
+        '''
+        planner = self._meal_planner
+        if planner is None:
+            nutrition = self.nutrition
+            with self._search_index_lock:
+                planner = self._meal_planner
+                if planner is None:
+                    recipes = self.conn.execute_query(
+                        'SELECT recipe_name,rating,vegan,vegetarian,gluten_free,eggetarian FROM recipes;')
+                    ingredients = self.conn.execute_query('SELECT recipe_name,ingredient_name FROM recipe_ingredients;')
+                    categories = self.conn.execute_query('SELECT recipe_name,recipe_category_name FROM recipes_to_categories;')
+                    planner = self._meal_planner = MealPlanner.build(recipes,ingredients,categories,nutrition)
+        return planner
+
+    def generate_meal_plans(self,user_id:int = -1,allergies:list = (),targets:dict = None,count:int = 5) -> list:
+        '''
+            Daily meal plans closest to the nutrition targets, made of recipes matching
+            the user's preferences and free of the user's allergies and the given ones
+            Args:
+                targets: nutrient -> daily amount, e.g. {'calories': 2000, 'protein': 80}
+            Returns:
+                plans shaped like meal_plans rows, with their nutrition totals
+        '''
+        user_mask = None
+        allergies = list(allergies)
+        if user_id != -1:
+            user_mask = self.get_user_preference_mask(user_id)
+            try:
+                allergies += self.get_user_allergies(user_id)
+            except pymysql.Error as e: # migrations/001_user_allergies.sql not applied
+                log.warning('could not read allergies',extra={'user_id':user_id,'error':str(e)})
+        return self.meal_planner.generate(user_mask,allergies,targets,count)
+
+    @property
+    def recommender(self) -> RecipeRecommender:
+        '''
+            Item similarity index over ingredients and likes, built on first use.
+            Toggles of this process update it in place, the likes of other
+            processes arrive when it is rebuilt after the cache ttl or a new
+            catalog snapshot, see _refresh_index.
+        '''
+        recommender = self._recommender
+        if recommender is None:
+            with self._search_index_lock:
+                recommender = self._recommender
+                if recommender is None:
+                    recommender = self._recommender = self._build_recommender()
+                    self._built['_recommender'] = time.monotonic()
+        else:
+            self._refresh_index('_recommender',recommender,self._build_recommender)
+        return recommender
+
+    def _build_recommender(self) -> RecipeRecommender:
+        meal_plans = self.get_meal_plans()
+        ingredients = self.conn.execute_query('SELECT recipe_name,ingredient_name FROM recipe_ingredients;')
+        liked = self.conn.execute_query('SELECT user_id,recipe_name FROM user_liked_recipes;')
+        favorites = self.conn.execute_query('SELECT user_id,meal_plan_name FROM user_favorite_meal_plans;')
+        recommender = RecipeRecommender.build(ingredients,liked,favorites,meal_plans)
+        if self.write_behind is not None:
+            # likes still queued are not in the tables yet
+            plans = {plan['meal_plan_name'].casefold():plan for plan in meal_plans}
+            for op in self.write_behind.ops('like_recipe').values():
+                recommender.set_liked(op['user_id'],[op['name']],op['liked'])
+            for op in self.write_behind.ops('like_meal_plan').values():
+                plan = plans.get(op['name'].casefold())
+                if plan is not None:
+                    recipes = [plan[f'{meal}_name'] for meal in ('breakfast','lunch','snack','dinner')]
+                    recommender.set_liked(op['user_id'],recipes,op['liked'],plan['meal_plan_name'])
+        return recommender
+
+    def get_recommended_recipes(self,user_id:int,limit:int = 8) -> list:
+        '''
+            Recipes similar to the ones the user liked, matching their preferences.
+            Empty for users who have not liked anything yet.
+        '''
+        names = self.recommender.recommend(user_id,2*limit)
+        return self.get_recipes(self.filter_by_preferences(names,user_id)[:limit])
+
+    def get_meal_plan_nutrition(self,meal_plan:str) -> dict:
+        '''
+            Nutrition totals of each meal of a meal plan and of the whole plan,
+            None when there is no such meal plan
+        '''
+        plan = self.get_meal_plan(meal_plan)
+        if plan is None:
+            return None
+        return self.nutrition.meal_plan_totals(plan)
+
+    def get_shopping_list(self,recipes:list,servings:list = None) -> dict:
+        '''
+            Everything to buy for a set of recipes, with one query joining their
+            ingredients to the ingredients and ingredients_in_stores tables
+            Args:
+                recipes: recipe names, a recipe listed twice is cooked twice
+                servings: optional multiplier per recipe, 1 by default
+            Returns:
+                a dict with recipes (the names found), items (one per ingredient,
+                by name: ingredient_name, quantity summed in the ingredient's
+                measurement, measurement, approximate (some quantity could not
+                be read), recipes, image_link, store_name, store_link and the
+                NUTRIENTS for that quantity) and totals (NUTRIENTS of all items)
+        '''
+        weights = {}
+        for i,name in enumerate(recipes):
+            weight = 1.0 if servings is None else float(servings[i])
+            weights[fold(name)] = weights.get(fold(name),0.0) + weight
+        names = {}
+        for name in recipes:
+            names.setdefault(fold(name),name)
+        names = tuple(names.values())
+        if len(names) < 1:
+            return {'recipes':[],'items':[],'totals':dict.fromkeys(NUTRIENTS,0.0)}
+
+        # catalog data, left to the ttl like top_recipes. Cached per recipe, so
+        # lists of any combination of recipes share the entries of their recipes.
+        keys = {fold(name):('shopping_list',fold(name)) for name in names}
+        cached = self.cache.get_many(keys.values())
+        rows = [row for key in keys.values() if key in cached for row in cached[key]]
+
+        missing = tuple(name for name in names if keys[fold(name)] not in cached)
+        if len(missing) > 0:
+            query = 'SELECT ri.recipe_name,ri.ingredient_name,ri.quantity,i.calories,i.protein,i.fats,i.carbs,i.sugar,\n'+\
+                'i.measurement,i.image_link,s.store_name,s.store_link FROM recipe_ingredients ri\n'+\
+                'LEFT JOIN ingredients i ON i.ingredient_name = ri.ingredient_name\n'+\
+                'LEFT JOIN ingredients_in_stores s ON s.ingredient_name = ri.ingredient_name\n'+\
+                f'WHERE ri.recipe_name IN {in_clause(missing)};'
+            loaded = {}
+            for row in self.conn.execute_query(query,missing):
+                loaded.setdefault(fold(row['recipe_name']),[]).append(row)
+            # names without ingredients are not cached, they may be anything a user typed
+            for folded,recipe_rows in loaded.items():
+                if folded in keys:
+                    self.cache.set(keys[folded],recipe_rows)
+                rows += recipe_rows
+
+        items = {}
+        found = {}
+        for row in rows:
+            weight = weights.get(fold(row['recipe_name']),0.0)
+            found[fold(row['recipe_name'])] = row['recipe_name']
+            key = fold(row['ingredient_name'])
+            item = items.get(key)
+            if item is None:
+                item = items[key] = {
+                    'ingredient_name':row['ingredient_name'],'quantity':0.0,'measurement':row['measurement'],
+                    'approximate':False,'recipes':[],'image_link':row['image_link'],
+                    'store_name':row['store_name'],'store_link':row['store_link'],
+                    'per_unit':[float(row[n] or 0) for n in NUTRIENTS],
+                }
+            quantity = parse_quantity(row['quantity'])
+            if quantity is None:
+                # counted like the nutrition totals count it
+                item['approximate'] = True
+                quantity = DEFAULT_QUANTITY
+            item['quantity'] += quantity*weight
+            if row['recipe_name'] not in item['recipes']:
+                item['recipes'].append(row['recipe_name'])
+
+        totals = dict.fromkeys(NUTRIENTS,0.0)
+        for item in items.values():
+            item['quantity'] = round(item['quantity'],2)
+            for nutrient,per_unit in zip(NUTRIENTS,item.pop('per_unit')):
+                item[nutrient] = round(per_unit*item['quantity'],2)
+                totals[nutrient] += item[nutrient]
+        return {
+            'recipes':[found[fold(name)] for name in names if fold(name) in found],
+            'items':sorted(items.values(),key=lambda item: fold(item['ingredient_name'])),
+            'totals':{nutrient:round(value,2) for nutrient,value in totals.items()},
+        }
+
+    def get_meal_plan_shopping_list(self,meal_plan:str,days:int = 1) -> dict:
+        '''
+            Shopping list of a meal plan cooked for the given number of days,
+            None when there is no such meal plan
+        '''
+        plan = self.get_meal_plan(meal_plan)
+        if plan is None:
+            return None
+        recipes = [plan[f'{meal}_name'] for meal in MEALS if plan.get(f'{meal}_name')]
+        shopping_list = self.get_shopping_list(recipes,[days]*len(recipes))
+        shopping_list['meal_plan_name'] = plan['meal_plan_name']
+        return shopping_list
 
     def toggle_like_meal_plan(self,user_id:int,meal_plan:str):
-        self.conn.call_procedure('toggle_like_meal_plan',(user_id,meal_plan))
+        liked = None
+        if self.write_behind is not None:
+            liked = not self.did_user_like_meal_plan(user_id,meal_plan)
+            if self._queue_like('like_meal_plan',user_id,meal_plan,liked):
+                self.versions.bump(('user',user_id))
+            else:
+                liked = None
+        if liked is None:
+            self.conn.call_procedure('toggle_like_meal_plan',(user_id,meal_plan))
+            self.invalidate_user_likes(user_id,'user_favorite_meal_plans')
+        plan = self.get_meal_plan(meal_plan) if self._recommender is not None else None
+        if plan is not None:
+            if liked is None:
+                liked = self.did_user_like_meal_plan(user_id,plan['meal_plan_name'])
+            recipes = [plan[f'{meal}_name'] for meal in ('breakfast','lunch','snack','dinner')]
+            self._recommender.set_liked(user_id,recipes,liked,plan['meal_plan_name'])
     
     def did_user_like_meal_plan(self,user_id:int,meal_plan:str):
-        query=f'SELECT user_favorited_mealplan({user_id},"{meal_plan}") AS liked_count;'
-        liked = self.conn.execute_query(query)
-        liked = liked[0]['liked_count']
+        return len(self.get_liked_meal_plans(user_id,[meal_plan])) > 0
+
+    def get_liked_meal_plans(self,user_id:int,meal_plans) -> set:
+        '''
+            Returns the subset of the given meal plan names favorited by the user
+        '''
+        return self._get_liked(user_id,'user_favorite_meal_plans','meal_plan_name',meal_plans)
+
+    def get_liked_recipes(self,user_id:int,recipes) -> set:
+        '''
+            Returns the subset of the given recipe names liked by the user
+        '''
+        return self._get_liked(user_id,'user_liked_recipes','recipe_name',recipes)
+
+    def _get_liked(self,user_id:int,table:str,column:str,names) -> set:
+        names = set(names)
+        if len(names) < 1:
+            return set()
+
+        if self.cache_user_likes:
+            # in the bounded ttl cache, so it neither grows with every user nor stays stale
+            query = f'SELECT {column} FROM {table} WHERE user_id = %s;'
+            liked = self._cached(('liked',table,user_id),lambda: frozenset(
+                row[column] for row in self.conn.execute_query(query,(user_id,))))
+            return self._with_queued_likes(user_id,table,names,names & liked)
+
+        query = f'SELECT {column} FROM {table} WHERE user_id = %s AND {column} IN {in_clause(names)};'
+        rows = self.conn.execute_query(query,(user_id,*names))
+        return self._with_queued_likes(user_id,table,names,{row[column] for row in rows})
+
+    def _with_queued_likes(self,user_id:int,table:str,names:set,liked:set) -> set:
+        '''
+            Applies the user's likes still waiting in the write-behind queue, so
+            they read their own toggles before they reach the database
+        '''
+        if self.write_behind is None:
+            return liked
+        queued = self.write_behind.ops(_LIKE_KINDS[table],user_id)
+        if not queued:
+            return liked
+        liked = set(liked)
+        folded = {name.casefold():name for name in names}
+        for (_,_,item),op in queued.items():
+            if item in folded:
+                if op['liked']:
+                    liked.add(folded[item])
+                else:
+                    liked.discard(folded[item])
         return liked
 
-    def get_recipes_by_cuisine(self,cuisine_name:str,user_id:int = -1):
-        if user_id == -1:
-            rows = self.conn.call_procedure('search_recipe_with_cuisine_without_user',(cuisine_name,))
-        
-        else:
-            rows = self.conn.call_procedure('search_recipe_with_cuisine_with_user',(cuisine_name,user_id))
-        
+    def invalidate_user_likes(self,user_id:int,table:str = None):
+        tables = ('user_liked_recipes','user_favorite_meal_plans') if table is None else (table,)
+        self.cache.invalidate(*[('liked',table,user_id) for table in tables])
+        self.versions.bump(('user',user_id))
 
-        recipes = []
-        for row in rows:
-            recipes.append(self.get_recipe(row['recipe_name']))
-        
-        return recipes
+    def get_recipes_by_cuisine(self,cuisine_name:str,user_id:int = -1):
+        names = self._cuisine_recipe_names(cuisine_name)
+        return self.get_recipes(self.filter_by_preferences(names,user_id))
     
     def add_user(self,user : dict) -> None:
         try:
@@ -193,27 +1243,54 @@ class RecipeDb:
             user_id = self.get_user_by_email(user["email"],user["password"])
 
             self.add_user_preferences(user_id['user_id'],user['preferences'])
+            self.add_user_allergies(user_id['user_id'],user.get('allergies',[]))
         
         except pymysql.Error as e:
-            print(e)
+            log.warning('could not add user',extra={'error':str(e)})
             return e
         
         except Exception as e:
-            print(e)
+            log.exception('could not add user')
             return e
         
     
     def add_user_preferences(self,user_id: int , preferences:list) -> None:
         for preference in set(preferences):
-            print(user_id,preference)
+            log.debug('adding preference',extra={'user_id':user_id,'preference':preference})
             try:
                 self.conn.call_procedure('add_user_preference',(user_id,preference))
             except pymysql.Error as e:
-                print(e)
+                log.warning('could not add preference',extra={'user_id':user_id,'preference':preference,
+                                                              'error':str(e)})
+        self._invalidate_user(user_id)
+
+
+    def add_user_allergies(self,user_id: int,allergies: list) -> None:
+        allergies = {allergy.strip().lower() for allergy in allergies if allergy.strip()}
+        if len(allergies) < 1:
+            return
+        rows = tuple(value for allergy in sorted(allergies) for value in (user_id,allergy))
+        query = 'INSERT IGNORE INTO user_allergies (user_id,allergy) VALUES '+\
+            ','.join(['(%s,%s)']*len(allergies))+';'
+        try:
+            self.conn.execute_query(query,rows)
+        except pymysql.Error as e:
+            log.warning('could not add allergies',extra={'user_id':user_id,'error':str(e)})
+        self._invalidate_user(user_id)
 
+    def get_user_allergies(self,user_id: int) -> list:
+        query = 'SELECT allergy FROM user_allergies WHERE user_id = %s;'
+        return self._cached(('allergies',user_id),
+                            lambda: [row['allergy'] for row in self.conn.execute_query(query,(user_id,))])
 
     def delete_user(self,user_id:int):
         self.conn.call_procedure('delete_user_by_id',(user_id,))
+        self.invalidate_user_likes(user_id)
+        if self._recommender is not None:
+            self._recommender.remove_user(user_id)
+        self._invalidate_user(user_id)
+        # their likes and reviews are gone from the counters of every recipe
+        self.versions.bump(('catalog',))
 
     
 
@@ -233,40 +1310,108 @@ class RecipeDb:
     def get_user_preferences(self,user_id:int)->list:
         return self.conn.call_procedure('get_user_preferences',(user_id,))
 
+    def get_user(self,user_id:int) -> dict:
+        '''
+            Returns the user row without the password, with the user's preferences,
+            None when there is no such user
+        '''
+        def load():
+            query = 'SELECT user_id,first_name,last_name,email,avatar FROM users WHERE user_id = %s;'
+            rows = self.conn.execute_query(query,(user_id,))
+            if len(rows) < 1:
+                return None
+            user = rows[0]
+            user['preferences'] = self.get_user_preferences(user_id)
+            return user
+
+        return self._cached(('user',user_id),load)
+
+    def _invalidate_user(self,user_id:int):
+        self.cache.invalidate(('user',user_id),('preference_mask',user_id),('allergies',user_id))
+        self.versions.bump(('user',user_id))
+
     def get_recipe(self,recipe: str) -> dict:
-        query = f'SELECT * FROM recipes WHERE recipe_name = "{recipe}";'
-        result = self.conn.execute_query(query)
-        if len(result) < 0:
+        recipes = self.get_recipes([recipe])
+        if len(recipes) < 1:
             return []
         
-        recipe_details = result[0]
-    
-        query = f'SELECT * FROM recipe_images WHERE recipe_name = "{recipe}";'
-        recipe_details['images'] = self.conn.execute_query(query)
-        
-        recipe_details['rating'] = float(recipe_details['rating'])
-
-        query = 'SELECT COUNT(DISTINCT(user_id))AS like_count FROM user_liked_recipes WHERE\n' + 'recipe_name = "%s";'%(recipe)
-        
-        
-        like_count = self.conn.call_procedure('get_like_count_of_recipe',(recipe,))[0]['like_count']
-
-        recipe_details['like_count'] = like_count
-        return recipe_details
+        return recipes[0]
     
     def get_recipe_page_details(self,recipe:str)->dict:
-        recipe_details = self.get_recipe(recipe)
-
-        query = f'SELECT recipe_category_name FROM recipes_to_categories WHERE\n'+ 'recipe_name = "%s";'%(recipe)
-        recipe_details['categories'] = self.conn.execute_query(query)
-
-        query = f'SELECT ingredient_name,quantity FROM recipe_ingredients WHERE\n'+ 'recipe_name = "%s";'%(recipe)
-        recipe_details['ingredients'] = self.conn.execute_query(query)
+        return self.get_recipe_page(recipe)
 
-        query = 'SELECT step_number,instruction FROM recipe_instructions WHERE\n' +'recipe_name = "%s";'%(recipe)
-        recipe_details['steps'] = self.conn.execute_query(query)
-
-        
+    def get_recipe_page(self,recipe:str) -> dict:
+        '''
+            Loads everything the recipe page shows in at most three queries,
+            no matter how many ingredients the recipe has
+            Returns:
+                the recipe dict with images, like_count, categories, steps,
+                ingredients (each with its nutrition columns), ingredient_details
+                (ingredient name -> nutrition row) and formatted times,
+                an empty list when there is no such recipe
+        '''
+        snapshot = self._catalog_snapshot()
+        if snapshot is not None and fold(recipe) not in self._snapshot_stale:
+            row = snapshot.recipe(recipe)
+            if row is not None:
+                like_count = self.get_like_counts_of_recipes((row['recipe_name'],))[row['recipe_name']]
+                return self._recipe_page(row,snapshot.recipe_page(recipe),like_count)
+
+        key = recipe.casefold()
+        row = self.cache.get(('recipe',key))
+        page = self.cache.get(('recipe_page',key))
+        like_count = self.cache.get(('like_count',key))
+
+        if row is None or like_count is None:
+            query = 'SELECT r.*,COALESCE(s.like_count,0) AS like_count FROM recipes r\n'+\
+                'LEFT JOIN recipe_stats s ON s.recipe_name = r.recipe_name WHERE r.recipe_name = %s;'
+            rows = self.conn.execute_query(query,(recipe,))
+            if len(rows) < 1:
+                return []
+            loaded = rows[0]
+            like_count = loaded.pop('like_count')
+            self.cache.set(('like_count',key),like_count)
+            if row is None:
+                row = loaded
+                row['rating'] = float(row['rating'])
+
+        if page is None or 'images' not in row:
+            # images, categories and steps are small lists, fetch them as one result set
+            query = 'SELECT \'image\' AS kind,NULL AS step_number,recipe_image AS value FROM recipe_images WHERE recipe_name = %s\n'+\
+                'UNION ALL SELECT \'category\',NULL,recipe_category_name FROM recipes_to_categories WHERE recipe_name = %s\n'+\
+                'UNION ALL SELECT \'step\',step_number,instruction FROM recipe_instructions WHERE recipe_name = %s\n'+\
+                'ORDER BY kind,step_number;'
+            name = row['recipe_name']
+            parts = {'image':[],'category':[],'step':[]}
+            for part in self.conn.execute_query(query,(name,name,name)):
+                parts[part['kind']].append(part)
+
+            if 'images' not in row:
+                row['images'] = [{'recipe_name':name,'recipe_image':part['value']} for part in parts['image']]
+                self.cache.set(('recipe',key),row)
+
+            if page is None:
+                query = 'SELECT ri.ingredient_name,ri.quantity,i.calories,i.protein,i.fats,i.carbs,i.sugar,\n'+\
+                    'i.measurement,i.image_link FROM recipe_ingredients ri\n'+\
+                    'LEFT JOIN ingredients i ON i.ingredient_name = ri.ingredient_name WHERE ri.recipe_name = %s;'
+                ingredients = self.conn.execute_query(query,(name,))
+                page = {
+                    'categories':[{'recipe_category_name':part['value']} for part in parts['category']],
+                    'steps':[{'step_number':part['step_number'],'instruction':part['value']} for part in parts['step']],
+                    'ingredients':ingredients,
+                    'ingredient_details':{
+                        ingredient['ingredient_name']:{k:v for k,v in ingredient.items() if k != 'quantity'}
+                        for ingredient in ingredients
+                    },
+                }
+                self.cache.set(('recipe_page',key),page)
+
+        return self._recipe_page(row,page,like_count)
+
+    def _recipe_page(self,row:dict,page:dict,like_count:int) -> dict:
+        recipe_details = dict(row)
+        recipe_details['like_count'] = like_count
+        recipe_details.update(page)
 
         p = recipe_details['preparation_time']
         c = recipe_details['cooking_time']
@@ -278,41 +1423,83 @@ class RecipeDb:
         return recipe_details
     
     def toggle_like_recipe(self,user_id:int,recipe_name:str):
+        if self.write_behind is not None:
+            liked = not self.did_user_liked_recipe(user_id,recipe_name)
+            if self._queue_like('like_recipe',user_id,recipe_name,liked):
+                # the like count follows when the queue is written, see apply_writes
+                self.versions.bump(('user',user_id),('recipe',recipe_name.casefold()))
+                if self._recommender is not None:
+                    self._recommender.set_liked(user_id,[recipe_name],liked)
+                return
         self.conn.call_procedure('toggle_like_recipe',(user_id,recipe_name))
+        self.invalidate_user_likes(user_id,'user_liked_recipes')
+        self.cache.invalidate(('like_count',recipe_name.casefold()))
+        self.versions.bump(('recipe',recipe_name.casefold()),('activity',))
+        if self._recommender is not None:
+            # the procedure toggles, so the new state is read back rather than
+            # flipped, which would drift from other processes' toggles
+            liked = self.did_user_liked_recipe(user_id,recipe_name)
+            self._recommender.set_liked(user_id,[recipe_name],liked)
+
+    def _queue_like(self,kind:str,user_id:int,name:str,liked:bool) -> bool:
+        '''
+            Queues the like state of a recipe or meal plan, False when the
+            write-behind queue is full and the caller writes it itself
+        '''
+        op = {'kind':kind,'user_id':user_id,'name':name,'liked':liked,'when':_now()}
+        return self.write_behind.submit((kind,user_id,name.casefold()),op)
 
     def get_ingredient_details(self,ing:str):
 
-        query = f'SELECT * FROM ingredients WHERE ingredient_name = "%s";' %ing
+        query = 'SELECT * FROM ingredients WHERE ingredient_name = %s;'
         try:
-            return self.conn.execute_query(query)[0]
+            return self._cached(('ingredient',ing.casefold()),
+                                lambda: self.conn.execute_query(query,(ing,))[0])
         except Exception as e:
-            print(e) 
+            log.warning('could not load ingredient',extra={'ingredient':ing,'error':str(e)})
     
     def get_ingredient(self,ing:str):
-        ingr = self.conn.call_procedure('get_ingredient',(ing,))[0]
-        ingr['store_links'] = self.conn.call_procedure('get_store_links',(ing,))
-        return ingr
+        '''
+            The ingredients row with its store_links, None when there is no such ingredient
+        '''
+        def load():
+            query = 'SELECT i.*,s.store_name,s.store_link FROM ingredients i\n'+\
+                'LEFT JOIN ingredients_in_stores s ON s.ingredient_name = i.ingredient_name\n'+\
+                'WHERE i.ingredient_name = %s;'
+            rows = self.conn.execute_query(query,(ing,))
+            if len(rows) < 1:
+                return None
+            ingr = rows[0]
+            store = {'ingredient_name':ingr['ingredient_name'],'store_link':ingr.pop('store_link'),
+                     'store_name':ingr.pop('store_name')}
+            ingr['store_links'] = [store] if store['store_link'] is not None else []
+            return ingr
+
+        ingr = self._cached(('ingredient_page',ing.casefold()),load)
+        return None if ingr is None else dict(ingr)
 
     def get_user_review_of_recipe(self,user_id:int,recipe:str):
+        queued = self.write_behind.get(('review',user_id,recipe.casefold())) if self.write_behind else None
+        if queued is not None:
+            return [] if queued['deleted'] else [_queued_review_row(queued)]
         try:
-            query = f'SELECT * FROM user_comments WHERE user_id = {user_id} AND recipe_name = "{recipe}";'
-            return self.conn.execute_query(query)
+            query = 'SELECT * FROM user_comments WHERE user_id = %s AND recipe_name = %s;'
+            return self._cached(('user_review',user_id,recipe.casefold()),
+                                lambda: self.conn.execute_query(query,(user_id,recipe)))
             
         except Exception as e:
-            print(e)
+            log.warning('could not load review',extra={'user_id':user_id,'recipe':recipe,'error':str(e)})
             return e
 
     def did_user_liked_recipe(self,user_id:int,recipe:str):
-        query = f'SELECT user_liked_recipe({user_id},"{recipe}") AS liked;'
-        result = self.conn.execute_query(query)
-        print(result)
-        return result[0]['liked']
+        return len(self.get_liked_recipes(user_id,[recipe])) > 0
 
     def edit_preferences(self,user_id:int,preferences:list):
         self.conn.call_procedure('delete_user_preferences',(user_id,))
-        print(preferences)
+        log.debug('editing preferences',extra={'user_id':user_id,'preferences':preferences})
         for preference in set(preferences):
             self.conn.call_procedure('add_user_preference',(user_id,preference))
+        self._invalidate_user(user_id)
 
     def get_user_names(self,user_id:int):
         try:
@@ -321,148 +1508,303 @@ class RecipeDb:
             return row['first_name'],row['last_name']
             
         except Exception as e:
-            print(e)
+            log.warning('could not load user names',extra={'user_id':user_id,'error':str(e)})
             return "",""
 
     def get_all_reviews_of_recipe(self,recipe:str):
         try:
-            query = f'SELECT * FROM user_comments WHERE recipe_name = "{recipe}";'
-            rows = self.conn.execute_query(query)
+            def load():
+                query = 'SELECT uc.*,u.first_name,u.last_name,a.avatar_link AS avatar,NOW() AS server_time\n'+\
+                    'FROM user_comments uc JOIN users u ON u.user_id = uc.user_id\n'+\
+                    'LEFT JOIN avatars a ON a.avatar_id = u.avatar WHERE uc.recipe_name = %s;'
+                rows = self.conn.execute_query(query,(recipe,))
+                # remember the server clock offset so cached reviews keep formatting against server time
+                offset = rows[0].pop('server_time') - datetime.now() if rows else timedelta()
+                for row in rows:
+                    row.pop('server_time',None)
+                return rows,offset
+
+            rows,offset = self._cached(('reviews',recipe.casefold()),load)
+            now = datetime.now() + offset
+            rows = [dict(row) for row in rows]
+            if self.write_behind is not None:
+                rows = self._with_queued_reviews(recipe,rows)
             for row in rows:
-                row['date'] = self.format_date(row['commented_datetime'])
-                row['first_name'],row['last_name'] = self.get_user_names(row['user_id'])
-                row['avatar'] = self.get_avatar_link(row['user_id'])
+                row['date'] = format_date(row['commented_datetime'],now)
             
             return rows
             
         except Exception as e:
-            print(e)
+            log.warning('could not load reviews',extra={'recipe':recipe,'error':str(e)})
             return []
     
 
+    def _with_queued_reviews(self,recipe:str,rows:list) -> list:
+        '''
+            Replaces the reviews with the posts and deletes still waiting in the
+            write-behind queue
+        '''
+        queued = self.write_behind.ops('review',item=recipe.casefold())
+        if not queued:
+            return rows
+        users = {user_id for _,user_id,_ in queued}
+        rows = [row for row in rows if row['user_id'] not in users]
+        # users and avatars are cached, a queued review costs no query of its own
+        avatars = {avatar['avatar_id']:avatar['avatar_link'] for avatar in self.get_all_avatars()}
+        for (_,user_id,_),op in queued.items():
+            user = self.get_user(user_id)
+            if op['deleted'] or user is None:
+                continue
+            row = _queued_review_row(op)
+            row['first_name'],row['last_name'] = user['first_name'],user['last_name']
+            row['avatar'] = avatars.get(user['avatar'])
+            rows.append(row)
+        return rows
+
     def get_all_avatars(self) -> list:
         try:
             query = f'SELECT * FROM avatars;'
-            rows = self.conn.execute_query(query)
+            rows = self._cached(('avatars',),lambda: self.conn.execute_query(query))
             return rows
             
         except Exception as e:
-            print(e)
+            log.warning('could not load avatars',extra={'error':str(e)})
             return []
         
     
-    def get_most_liked_cuisines(self):
-        cuisines = []
-        liked_counts = []
-        for cuisine in self.get_cuisine_names():
-            cuisine = cuisine['cuisine_name']
-            cuisines.append(cuisine)
-            liked_count = self.conn.call_procedure('get_liked_recipe_count_by_cuisine',(cuisine,))
-            print(cuisine,liked_count)
-            liked_counts.append(liked_count[0]['liked_recipe_count'])
-        
-        return cuisines,liked_counts
+    def get_trend_statistics(self) -> dict:
+        '''
+            Computes the /trends aggregates with one GROUP BY query each
+            Returns:
+                a dict of columnar NumPy arrays:
+                    preferences, preference_user_counts: distinct users per preference
+                    cuisines, cuisine_liked_counts: distinct liked recipes per cuisine
+                    ratings, rating_recipe_counts: recipes per rating, by rating
+        '''
+        stats = {}
+
+        query = 'SELECT preference,COUNT(DISTINCT user_id) AS user_count FROM user_preferences GROUP BY preference;'
+        rows = self.conn.execute_query(query)
+        stats['preferences'],stats['preference_user_counts'] = columns(rows,('preference',str),('user_count',np.int64))
+
+        query = 'SELECT c.cuisine_name,COUNT(s.recipe_name) AS liked_recipe_count FROM cuisines c\n'+\
+            'LEFT JOIN recipes r ON r.cuisine_name = c.cuisine_name\n'+\
+            'LEFT JOIN recipe_stats s ON s.recipe_name = r.recipe_name AND s.like_count > 0\n'+\
+            'GROUP BY c.cuisine_name ORDER BY c.cuisine_name;'
+        rows = self.conn.execute_query(query)
+        stats['cuisines'],stats['cuisine_liked_counts'] = columns(rows,('cuisine_name',str),('liked_recipe_count',np.int64))
+
+        query = 'SELECT rating,COUNT(*) AS recipe_count FROM recipes WHERE rating IS NOT NULL\n'+\
+            'GROUP BY rating ORDER BY rating;'
+        rows = self.conn.execute_query(query)
+        stats['ratings'],stats['rating_recipe_counts'] = columns(rows,('rating',np.float64),('recipe_count',np.int64))
+
+        return stats
+
+    def get_most_liked_cuisines(self,stats: dict = None):
+        stats = stats if stats is not None else self.get_trend_statistics()
+        return stats['cuisines'],stats['cuisine_liked_counts']
+
+    def get_rating_distribution(self,stats: dict = None):
+        stats = stats if stats is not None else self.get_trend_statistics()
+        return stats['ratings'],stats['rating_recipe_counts']
 
     def get_top_rated_recipes(self,limit=300):
-        recipes = []
-        ratings = []
-        rows = self.conn.call_procedure('get_top_rated_recipes',(1300,))
-        for row in rows:
-            recipes.append(row['recipe_name'])
-            ratings.append(row['rating'])
-        
-        return recipes,ratings
+        rows = self.conn.call_procedure('get_top_rated_recipes',(limit,))
+        return columns(rows,('recipe_name',str),('rating',np.float64))
     
-    def get_user_count_by_preference(self):
-        preferences = ['vegan','vegetarian','egg','gluten-free','meat']
-        user_counts = []
-        
+    def get_user_count_by_preference(self,stats: dict = None):
+        preferences = np.array(['vegan','vegetarian','egg','gluten-free','meat'])
+        stats = stats if stats is not None else self.get_trend_statistics()
 
-        for preference in preferences:
-            count = self.conn.call_procedure('get_user_count_by_preference',(preference,))
-            if len(count) > 0:
-                count = count[0]['user_count']
-            else:
-                count = 0
-            
-            user_counts.append(count)
-        
+        counts = dict(zip(stats['preferences'].tolist(),stats['preference_user_counts'].tolist()))
+        user_counts = np.array([counts.get(preference,0) for preference in preferences],dtype=np.int64)
         return preferences,user_counts
 
         
     def post_user_review(self,user_id:int,recipe:str,comment:str,rating:float):
+        if self._queue_review(user_id,recipe,{'comment':comment,'rating':rating,'deleted':False}):
+            return None
         try:
             args = (user_id,recipe,rating,comment)
             self.conn.call_procedure('rate_recipe',args)
+            self._invalidate_reviews(user_id,recipe)
         
         except Exception as e:
-            print(e)
+            log.warning('could not post review',extra={'user_id':user_id,'recipe':recipe,'error':str(e)})
             return e
     
 
     def delete_review(self,user_id:int,recipe:str):
+        if self._queue_review(user_id,recipe,{'deleted':True}):
+            return None
         try:
             args = (user_id,recipe)
             self.conn.call_procedure('delete_comment',args)
+            self._invalidate_reviews(user_id,recipe)
         
         except Exception as e:
-            print(e)
+            log.warning('could not delete review',extra={'user_id':user_id,'recipe':recipe,'error':str(e)})
             return e
     
 
-    def format_date(self,date):
-        year = self.conn.execute_query(f'SELECT YEAR(CONVERT("{date}",DATETIME)) AS year;')[0]['year']
-        day = self.conn.execute_query(f'SELECT DAY(CONVERT("{date}",DATETIME)) AS day;')[0]['day']
-        month = self.conn.execute_query(f'SELECT MONTH(CONVERT("{date}",DATETIME)) AS month;')[0]['month']
-
-        monthName = self.conn.execute_query(f'SELECT MONTHNAME(CONVERT("{date}",DATETIME)) AS month;')[0]['month']
-          
-
-        yearCurrent = self.conn.execute_query(f'SELECT YEAR(NOW()) AS year;')[0]['year']
-        dayCurrent = self.conn.execute_query(f'SELECT DAY(NOW()) AS day;')[0]['day']
-        monthCurrent = self.conn.execute_query(f'SELECT MONTH(NOW()) AS month;')[0]['month']
-
-        if (yearCurrent - year) > 5:
-            return f"{(yearCurrent - year)} years ago"
-        
-        elif (yearCurrent - year) > 1:
-            return f"{month}/{day}/{year}"
-        
-        elif (yearCurrent - year) == 1:
-            return f"{monthName} {day}"
-        
-        else: #Same Year
-            if monthCurrent > month:
-                return f"{monthName} {day}"
-            
-            else: #Same month
-                if dayCurrent - day > 7:
-                    return f"{(dayCurrent - day)} days ago"
-                
-                elif dayCurrent - day > 1:
-                    dayName = self.conn.execute_query(f'SELECT DAYNAME(CONVERT("{date}",DATETIME)) AS day;')[0]['day']
-                    return f"{dayName}"
-                
-                elif dayCurrent - day == 1:
-                    return "Yesterday"
-                
-                else: # Same day
-                    hours = self.conn.execute_query(f'SELECT HOUR(CONVERT("{date}",DATETIME)) AS hours;')[0]['hours']
-                    mins = self.conn.execute_query(f'SELECT MINUTE(CONVERT("{date}",DATETIME)) AS mins;')[0]['mins']
-                    secs = self.conn.execute_query(f'SELECT SECOND(CONVERT("{date}",DATETIME)) AS secs;')[0]['secs']
+    def _queue_review(self,user_id:int,recipe:str,change:dict) -> bool:
+        '''
+            Queues a review post or delete, False without a write-behind queue
+            or when it is full
+        '''
+        if self.write_behind is None:
+            return False
+        op = {'kind':'review','user_id':user_id,'name':recipe,'when':_now(),**change}
+        if not self.write_behind.submit(('review',user_id,recipe.casefold()),op):
+            return False
+        self.versions.bump(('recipe',recipe.casefold()),('user',user_id))
+        return True
+
+    def apply_writes(self,ops:list) -> None:
+        '''
+            Writes a batch of the write-behind queue in one transaction: likes
+            and reviews as a few multi-row statements, then the recipe_stats
+            counters of the recipes they touched recomputed
+            Args:
+                ops: dicts with kind ("like_recipe", "like_meal_plan" or "review"),
+                    user_id, name, when and liked, or comment, rating and deleted
+        '''
+        touched = {op['name'].casefold():op['name'] for op in ops if op['kind'] != 'like_meal_plan'}
+        with self.conn.transaction() as cur:
+            for kind,table,column,date_column in (('like_recipe','user_liked_recipes','recipe_name','liked_date'),
+                                                  ('like_meal_plan','user_favorite_meal_plans','meal_plan_name','favorited_date')):
+                likes = [op for op in ops if op['kind'] == kind]
+                unliked = [(op['user_id'],op['name']) for op in likes if not op['liked']]
+                if unliked:
+                    cur.execute(f'DELETE FROM {table} WHERE (user_id,{column}) IN {_pairs_clause(unliked)};',
+                                [value for pair in unliked for value in pair])
+                # IGNORE: already liked, or the recipe or user is gone since
+                cur.executemany(f'INSERT IGNORE INTO {table} (user_id,{column},{date_column}) VALUES (%s,%s,%s);',
+                                [(op['user_id'],op['name'],op['when']) for op in likes if op['liked']])
+
+            reviews = [op for op in ops if op['kind'] == 'review']
+            if reviews:
+                # a review is replaced as a whole, like rate_recipe does
+                pairs = [(op['user_id'],op['name']) for op in reviews]
+                cur.execute(f'DELETE FROM user_comments WHERE (user_id,recipe_name) IN {_pairs_clause(pairs)};',
+                            [value for pair in pairs for value in pair])
+                posted = [op for op in reviews if not op['deleted']]
+                if posted:
+                    cur.executemany('INSERT INTO user_comments (user_id,recipe_name,user_comment,rating,commented_datetime)\n'+\
+                                    'VALUES (%s,%s,%s,%s,%s);',
+                                    self._review_rows(cur,posted))
+
+            if touched:
+                names = tuple(touched.values())
+                cur.execute('INSERT INTO recipe_stats (recipe_name,like_count,review_count,rating_sum)\n'+\
+                            'SELECT r.recipe_name,\n'+\
+                            '(SELECT COUNT(*) FROM user_liked_recipes l WHERE l.recipe_name = r.recipe_name),\n'+\
+                            '(SELECT COUNT(*) FROM user_comments c WHERE c.recipe_name = r.recipe_name),\n'+\
+                            '(SELECT COALESCE(SUM(c.rating),0) FROM user_comments c WHERE c.recipe_name = r.recipe_name)\n'+\
+                            f'FROM recipes r WHERE r.recipe_name IN {in_clause(names)}\n'+\
+                            'ON DUPLICATE KEY UPDATE like_count = VALUES(like_count),review_count = VALUES(review_count),\n'+\
+                            'rating_sum = VALUES(rating_sum);',names)
+
+        for op in ops:
+            key = op['name'].casefold()
+            if op['kind'] == 'review':
+                self.cache.invalidate(('reviews',key),('user_review',op['user_id'],key),('recipe',key))
+            else:
+                self.invalidate_user_likes(op['user_id'],_LIKE_TABLES[op['kind']])
+        self.cache.invalidate(*[('like_count',key) for key in touched])
+        self.versions.bump(('activity',),*[('recipe',key) for key in touched])
 
-                    hoursCurrent = self.conn.execute_query(f'SELECT HOUR(NOW()) AS hours;')[0]['hours']
-                    minsCurrent = self.conn.execute_query(f'SELECT MINUTE(NOW()) AS mins;')[0]['mins']
-                    secsCurrent = self.conn.execute_query(f'SELECT SECOND(NOW()) AS secs;')[0]['secs']
+    @staticmethod
+    def _review_rows(cur,reviews:list) -> list:
+        '''
+            Rows for the queued reviews, without those of users or recipes
+            deleted since they were queued. The primary key of user_comments is
+            (user_id, commented_datetime), so a review timestamped in the same
+            second as another review of its user is moved to the next free second.
+            Args:
+                cur: cursor of the apply_writes transaction, after the replaced
+                    reviews were deleted
+                reviews: review ops that post a review
+            Returns:
+                (user_id, recipe_name, user_comment, rating, commented_datetime) tuples
+        '''
+        user_ids = tuple({op['user_id'] for op in reviews})
+        names = tuple({op['name'] for op in reviews})
+        cur.execute(f'SELECT user_id FROM users WHERE user_id IN {in_clause(user_ids)};',user_ids)
+        users = {row['user_id'] for row in cur.fetchall()}
+        cur.execute(f'SELECT recipe_name FROM recipes WHERE recipe_name IN {in_clause(names)};',names)
+        recipes = {row['recipe_name'].casefold() for row in cur.fetchall()}
+        reviews = [op for op in reviews if op['user_id'] in users and op['name'].casefold() in recipes]
+        if not reviews:
+            return []
 
-                    if hoursCurrent > hours:
-                        return f"{hoursCurrent - hours} hour{'s' if hoursCurrent - hours >1 else ''} ago"
-                    
-                    elif minsCurrent > mins:
-                        return f"{minsCurrent - mins} min{'s' if minsCurrent - mins >1 else ''} ago"
-                    
-                    else:
-                        return f"{secsCurrent - secs} second{'s' if secsCurrent - secs >1 else ''} ago"
+        earliest = min(op['when'] for op in reviews)
+        user_ids = tuple({op['user_id'] for op in reviews})
+        # FOR UPDATE: a review posted synchronously meanwhile cannot take a second picked here
+        cur.execute('SELECT user_id,commented_datetime FROM user_comments\n'+\
+                    f'WHERE user_id IN {in_clause(user_ids)} AND commented_datetime >= %s FOR UPDATE;',
+                    (*user_ids,earliest))
+        taken = {(row['user_id'],row['commented_datetime']) for row in cur.fetchall()}
+        rows = []
+        for op in reviews:
+            when = datetime.fromisoformat(op['when'])
+            while (op['user_id'],when) in taken:
+                when += timedelta(seconds=1)
+            taken.add((op['user_id'],when))
+            rows.append((op['user_id'],op['name'],op['comment'],op['rating'],when))
+        return rows
+
+    def _invalidate_reviews(self,user_id:int,recipe:str):
+        self.cache.invalidate(('reviews',recipe.casefold()),
+                              ('user_review',user_id,recipe.casefold()),
+                              ('recipe',recipe.casefold()))
+        self.versions.bump(('recipe',recipe.casefold()),('user',user_id))
+
+    def reconcile_recipe_stats(self,fix:bool = True) -> list:
+        '''
+            Recomputes the recipe_stats counters from user_liked_recipes and
+            user_comments and reports the recipes whose counters drifted
+            Args:
+                fix: also overwrite the drifted counters with the recomputed values
+            Returns:
+                a list of dicts with recipe_name, the stored like_count, review_count
+                and rating_sum, and the recomputed actual_like_count,
+                actual_review_count and actual_rating_sum
+        '''
+        actual = 'SELECT r.recipe_name,COALESCE(l.like_count,0) AS actual_like_count,\n'+\
+            'COALESCE(c.review_count,0) AS actual_review_count,COALESCE(c.rating_sum,0) AS actual_rating_sum\n'+\
+            'FROM recipes r\n'+\
+            'LEFT JOIN (SELECT recipe_name,COUNT(*) AS like_count FROM user_liked_recipes GROUP BY recipe_name) l\n'+\
+            'ON l.recipe_name = r.recipe_name\n'+\
+            'LEFT JOIN (SELECT recipe_name,COUNT(*) AS review_count,SUM(rating) AS rating_sum FROM user_comments\n'+\
+            'GROUP BY recipe_name) c ON c.recipe_name = r.recipe_name'
+        query = 'SELECT a.*,COALESCE(s.like_count,0) AS like_count,COALESCE(s.review_count,0) AS review_count,\n'+\
+            f'COALESCE(s.rating_sum,0) AS rating_sum FROM ({actual}) a\n'+\
+            'LEFT JOIN recipe_stats s ON s.recipe_name = a.recipe_name\n'+\
+            'WHERE COALESCE(s.like_count,0) <> a.actual_like_count OR COALESCE(s.review_count,0) <> a.actual_review_count\n'+\
+            'OR COALESCE(s.rating_sum,0) <> a.actual_rating_sum ORDER BY a.recipe_name;'
+        drifted = self.conn.execute_query(query)
+        if fix and len(drifted) > 0:
+            names = tuple(row['recipe_name'] for row in drifted)
+            # recomputed inside the upsert, so writes made since the report are not lost
+            query = 'INSERT INTO recipe_stats (recipe_name,like_count,review_count,rating_sum)\n'+\
+                f'SELECT recipe_name,actual_like_count,actual_review_count,actual_rating_sum FROM ({actual}) a\n'+\
+                f'WHERE a.recipe_name IN {in_clause(names)}\n'+\
+                'ON DUPLICATE KEY UPDATE like_count = VALUES(like_count),review_count = VALUES(review_count),\n'+\
+                'rating_sum = VALUES(rating_sum);'
+            self.conn.execute_query(query,names)
+            self.cache.invalidate(*[('like_count',name.casefold()) for name in names])
+            self.versions.bump(('catalog',))
+        return drifted
+
+    def get_server_time(self):
+        return self.conn.execute_query('SELECT NOW() AS now;')[0]['now']
+
+    def format_date(self,date,now = None):
+        if now is None:
+            now = self.get_server_time()
+        return format_date(date,now)
 
 
 
@@ -474,5 +1816,5 @@ class RecipeDb:
         
     
     def close_connection(self):
-        self.conn.conn.close()
+        self.conn.close()
     
\ No newline at end of file
@@ -0,0 +1,130 @@
+import threading
+
+import numpy as np
+
+
+VEGAN = 1
+VEGETARIAN = 2
+GLUTEN_FREE = 4
+EGG = 8
+MEAT = 16
+
+# user_preferences.preference value -> recipe flag it asks for
+PREFERENCE_BITS = {
+    'vegan': VEGAN,
+    'vegetarian': VEGETARIAN,
+    'gluten-free': GLUTEN_FREE,
+    'egg': EGG,
+    'meat': MEAT,
+}
+
+def recipe_mask(recipe: dict) -> int:
+    '''
+        Packs the dietary columns of a recipes row into a bitmask,
+        "meat" is any recipe that is neither vegan nor vegetarian.
+        A NULL column is unknown and sets no bit, like "= TRUE" and "= FALSE"
+        in the procedures, so an unclassified recipe only reaches users
+        without preferences.
+    '''
+    mask = 0
+    if recipe['vegan']:
+        mask |= VEGAN
+    if recipe['vegetarian']:
+        mask |= VEGETARIAN
+    if recipe['gluten_free']:
+        mask |= GLUTEN_FREE
+    if recipe['eggetarian']:
+        mask |= EGG
+    if recipe['vegan'] is not None and recipe['vegetarian'] is not None \
+            and not recipe['vegan'] and not recipe['vegetarian']:
+        mask |= MEAT
+    return mask
+
+def preference_mask(preferences: list):
+    '''
+        Bitmask of the recipe flags accepted by a user, None for users without
+        preferences (they see every recipe). Preferences with no recipe flag,
+        like seafood, add nothing.
+    '''
+    if len(preferences) < 1:
+        return None
+    mask = 0
+    for preference in preferences:
+        mask |= PREFERENCE_BITS.get(preference,0)
+    return mask
+
+
+class DietaryMasks:
+    def __init__(self):
+        '''
+            Dietary bitmask of every recipe in a NumPy array indexed by recipe id,
+            ids are assigned densely in the order recipes are added
+        '''
+        self._ids = {} # case-folded recipe_name -> id
+        self._masks = np.zeros(0,dtype=np.uint8)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    @classmethod
+    def build(cls,recipes: list):
+        '''
+            Args:
+                recipes: rows with recipe_name, vegan, vegetarian, gluten_free and eggetarian
+        '''
+        masks = cls()
+        masks._ids = {row['recipe_name'].casefold():i for i,row in enumerate(recipes)}
+        masks._masks = np.fromiter((recipe_mask(row) for row in recipes),dtype=np.uint8,count=len(recipes))
+        masks._size = len(recipes)
+        return masks
+
+    def set_recipe(self,recipe: dict) -> None:
+        '''
+            Adds or updates the mask of one recipes row
+        '''
+        key = recipe['recipe_name'].casefold()
+        with self._lock:
+            recipe_id = self._ids.get(key)
+            if recipe_id is None:
+                recipe_id = self._size
+                if recipe_id >= len(self._masks):
+                    grown = np.zeros(max(16,2*len(self._masks)),dtype=np.uint8)
+                    grown[:self._size] = self._masks[:self._size]
+                    self._masks = grown
+                self._ids[key] = recipe_id
+                self._size += 1
+            self._masks[recipe_id] = recipe_mask(recipe)
+
+    def remove_recipe(self,recipe_name: str) -> None:
+        # the id stays allocated, a zero mask never matches a preference
+        with self._lock:
+            recipe_id = self._ids.get(recipe_name.casefold())
+            if recipe_id is not None:
+                self._masks[recipe_id] = 0
+
+    def mask_of(self,recipe_name: str) -> int:
+        recipe_id = self._ids.get(recipe_name.casefold())
+        return 0 if recipe_id is None else int(self._masks[recipe_id])
+
+    def ids_of(self,recipe_names: list) -> np.ndarray:
+        '''
+            Recipe ids of the given names, -1 for names that are not indexed
+        '''
+        ids = self._ids
+        return np.fromiter((ids.get(name.casefold(),-1) for name in recipe_names),
+                           dtype=np.int64,count=len(recipe_names))
+
+    def filter(self,recipe_names: list,user_mask) -> list:
+        '''
+            Keeps the recipes matching at least one bit of user_mask, in order.
+            A None mask keeps every recipe.
+        '''
+        if user_mask is None or len(recipe_names) < 1:
+            return list(recipe_names)
+        ids = self.ids_of(recipe_names)
+        known = ids >= 0
+        keep = np.zeros(len(ids),dtype=bool)
+        keep[known] = (self._masks[ids[known]] & np.uint8(user_mask)) != 0
+        return [recipe_names[i] for i in np.flatnonzero(keep)]
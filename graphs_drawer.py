@@ -4,11 +4,13 @@ matplotlib.use('Agg')  # Use a non-interactive backend
 import seaborn as sns
 import matplotlib.pyplot as plt
 import pandas as pd
+import numpy as np
 import os
 
-def save_user_counts_plot_as_image(preferences, user_counts,  filename='user_counts_per_preference.png',dpi=300):
-    preferences = [pref for pref, count in zip(preferences, user_counts) if count > 0]
-    user_counts = [count for count in user_counts if count > 0]
+def save_user_counts_plot_as_image(preferences, user_counts,  filename='user_counts_per_preference.png',dpi=300,directory='static'):
+    user_counts = np.asarray(user_counts)
+    preferences = np.asarray(preferences)[user_counts > 0]
+    user_counts = user_counts[user_counts > 0]
     # Set the overall aesthetics
     sns.set_theme(style="whitegrid")
     sns.set_palette("tab10")
@@ -23,12 +25,12 @@ def save_user_counts_plot_as_image(preferences, user_counts,  filename='user_cou
     #plt.title('User Preferences Distribution', fontsize=16)
 
     # Save the plot as an image file with higher DPI
-    plt.savefig(os.path.join('static', filename), bbox_inches='tight', dpi=dpi)
+    plt.savefig(os.path.join(directory, filename), bbox_inches='tight', dpi=dpi)
     plt.close() # Close the figure to free memory
 
 
 
-def plot_top_rated_recipes(recipe_names, ratings,dpi=300):
+def plot_top_rated_recipes(recipe_names, ratings,dpi=300,filename='top_rated_recipes.png',directory='static'):
 
 
     # Set the overall aesthetics
@@ -64,13 +66,39 @@ def plot_top_rated_recipes(recipe_names, ratings,dpi=300):
     plt.tight_layout()
 
     # Save the plot as an image file
-    plt.savefig(os.path.join('static', 'top_rated_recipes.png'), bbox_inches='tight', dpi=dpi)
+    plt.savefig(os.path.join(directory, filename), bbox_inches='tight', dpi=dpi)
     plt.close()
 
 
-def plot_most_liked_cuisines(cuisines, liked_counts,dpi=300):
-    cuisines = [cus for cus, count in zip(cuisines, liked_counts) if count > 0]
-    liked_counts = [count for count in liked_counts if count > 0]
+def plot_rating_distribution(ratings, recipe_counts,dpi=300,filename='top_rated_recipes.png',directory='static'):
+    # the catalog's recipes from the best rated down, drawn from the rating counts
+    ratings = np.asarray(ratings)[::-1]
+    recipe_counts = np.asarray(recipe_counts)[::-1]
+
+    # Set the overall aesthetics
+    sns.set_theme(style="whitegrid")
+    sns.set_palette("flare")
+
+    plt.figure(figsize=(3,3))
+    plt.step(np.cumsum(recipe_counts), ratings, where='pre', linestyle='-', color='b')
+    plt.ylim(0, 5.2)
+
+    plt.ylabel('Rating', fontsize=12)
+    plt.xlabel('Recipes', fontsize=12)
+    plt.xticks(fontsize=6)
+
+    # Improve layout
+    plt.tight_layout()
+
+    # Save the plot as an image file
+    plt.savefig(os.path.join(directory, filename), bbox_inches='tight', dpi=dpi)
+    plt.close()
+
+
+def plot_most_liked_cuisines(cuisines, liked_counts,dpi=300,filename='most_liked_cuisines.png',directory='static'):
+    liked_counts = np.asarray(liked_counts)
+    cuisines = np.asarray(cuisines)[liked_counts > 0]
+    liked_counts = liked_counts[liked_counts > 0]
 
     # Set the overall aesthetics
     sns.set_theme(style="whitegrid")
@@ -89,5 +117,5 @@ def plot_most_liked_cuisines(cuisines, liked_counts,dpi=300):
 
 
     # Save the plot as an image file
-    plt.savefig(os.path.join('static', 'most_liked_cuisines.png'), bbox_inches='tight', dpi=dpi)
+    plt.savefig(os.path.join(directory, filename), bbox_inches='tight', dpi=dpi)
     plt.close()
\ No newline at end of file
@@ -0,0 +1,604 @@
+'''
+    Scrapes recipes from allrecipes.com listing pages, or reads saved recipe
+    pages from a directory, cleans them the way the notebooks in
+    "web scraping code" did and upserts them in batches. A manifest keeps a
+    hash of every page's cleaned recipe, so a re-run only writes the recipes
+    that changed. Ingredient nutrition still comes from ingredients_scrapper.ipynb,
+    new ingredients are added without it.
+
+    Saved pages are laid out like the listing urls they came from, e.g.
+    DIR/indian/main-dishes/rice/butter-chicken.html for a recipe listed on
+    https://www.allrecipes.com/recipes/15973/world-cuisine/asian/indian/main-dishes/rice/
+
+    Usage:
+        python ingest.py --listing URL [URL ...]
+        python ingest.py --pages DIR
+        options: [--workers 8] [--processes N] [--batch-size 200] [--manifest ingest_manifest.json] [--force] [--dry-run]
+'''
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from html.parser import HTMLParser
+
+from settings import *
+
+
+log = logging.getLogger('recipe_hub.ingest')
+
+USER_AGENT = 'Mozilla/5.0 (compatible; RecipeHubIngest/1.0)'
+RETRIES = 2
+
+# the cleaning rules of clean_recipes.ipynb and clean_recipe_ingredients.ipynb
+CUISINE_FIXES = {'main-dish':'italian','250':'italian'} # lasagna and pizza listings sit outside world-cuisine
+CATEGORY_FIXES = {'Main Dish':'Main Course'}
+INGREDIENT_FIXES = {
+    'kosher salt and pepper':'salt',
+    'freshly grated ginger':'ginger',
+    'minced fresh ginger':'ginger',
+    'fresh ginger':'ginger',
+    'finely grated ginger root':'ginger root',
+    'fresh ginger root':'ginger root',
+    'minced fresh ginger root':'ginger root',
+    'skinless boneless chicken breast':'chicken breast',
+    'boneless skinless chicken breast':'chicken breast',
+    'skinless':'chicken breast',
+    'boneless':'chicken thighs',
+    'flaked sea salt':'sea salt',
+    'salt and ground black pepper to taste':'salt and ground black pepper',
+    'cold water':'water',
+}
+
+# column sizes of the schema
+RECIPE_NAME_LENGTH = 180
+INGREDIENT_NAME_LENGTH = 255
+QUANTITY_LENGTH = 10
+IMAGE_LENGTH = 512
+
+
+_VOID_TAGS = frozenset(('area','base','br','col','embed','hr','img','input','link','meta','source','track','wbr'))
+
+class _Element:
+    __slots__ = ('tag','attrs','children')
+
+    def __init__(self,tag: str,attrs: dict):
+        self.tag = tag
+        self.attrs = attrs
+        self.children = [] # elements and text
+
+    def find(self,tag: str):
+        '''
+            First descendant element with the given tag, in document order
+        '''
+        stack = list(reversed(self.children))
+        while stack:
+            element = stack.pop()
+            if isinstance(element,_Element):
+                if element.tag == tag:
+                    return element
+                stack.extend(reversed(element.children))
+        return None
+
+    def child_elements(self,tag: str) -> list:
+        return [child for child in self.children if isinstance(child,_Element) and child.tag == tag]
+
+    def text(self) -> str:
+        parts = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node,str):
+                parts.append(node)
+            else:
+                stack.extend(reversed(node.children))
+        return ' '.join(''.join(parts).split())
+
+
+class _TreeBuilder(HTMLParser):
+    def __init__(self,stop_after: str = None):
+        super().__init__(convert_charrefs=True)
+        self.root = _Element('document',{})
+        self.ids = {} # id -> first element with it
+        self.tags = {} # tag -> elements in document order
+        self.stop_after = stop_after
+        self.finished = False # the stop_after element was closed
+        self._open = [self.root]
+
+    def handle_starttag(self,tag,attrs):
+        element = _Element(tag,dict(attrs))
+        self._open[-1].children.append(element)
+        self.tags.setdefault(tag,[]).append(element)
+        if 'id' in element.attrs:
+            self.ids.setdefault(element.attrs['id'],element)
+        if tag == 'br':
+            self._open[-1].children.append(' ')
+        elif tag not in _VOID_TAGS:
+            self._open.append(element)
+
+    def handle_startendtag(self,tag,attrs):
+        self.handle_starttag(tag,attrs)
+        if tag not in _VOID_TAGS:
+            self._open.pop()
+
+    def handle_endtag(self,tag):
+        # closes the innermost open element with this tag and whatever was left open inside it
+        for i in range(len(self._open) - 1,0,-1):
+            if self._open[i].tag == tag:
+                stop = self.ids.get(self.stop_after)
+                if stop is not None and stop in self._open[i:]:
+                    self.finished = True
+                del self._open[i:]
+                return
+
+    def handle_data(self,data):
+        if self._open[-1].tag not in ('script','style'):
+            self._open[-1].children.append(data)
+
+    def by_id(self,tag: str,id: str):
+        element = self.ids.get(id)
+        return element if element is not None and element.tag == tag else None
+
+    def by_class(self,tag: str,cls: str) -> list:
+        return [element for element in self.tags.get(tag,[]) if cls in (element.attrs.get('class') or '').split()]
+
+def parse_html(text: str,stop_after: str = None,chunk_size: int = 16384) -> _TreeBuilder:
+    '''
+        Parses a page into a tree of elements, indexed by id and by tag since
+        pages are searched a few times each
+        Args:
+            stop_after: id of the element after which the rest of the page is
+                not needed, parsing stops at the chunk where it closes
+    '''
+    builder = _TreeBuilder(stop_after)
+    for start in range(0,len(text),chunk_size):
+        builder.feed(text[start:start + chunk_size])
+        if builder.finished:
+            break
+    builder.close()
+    return builder
+
+
+def parse_listing(text: str) -> list:
+    '''
+        Recipe urls of the cards on a listing page
+    '''
+    doc = parse_html(text)
+    urls = []
+    for card in doc.by_class('a','mntl-card-list-items'):
+        url = card.attrs.get('href') or ''
+        if '/recipe/' in url and url not in urls:
+            urls.append(url)
+    return urls
+
+def parse_recipe(text: str):
+    '''
+        The fields of a recipe page as scraped, before cleaning. None for pages
+        without a recipe name.
+        Returns:
+            a dict with name, rating, tagline, details (the prep, cook, total time
+            and servings texts), ingredients ((quantity, unit, name) texts),
+            instructions and images
+    '''
+    # reviews, related recipes and the footer follow the steps
+    doc = parse_html(text,stop_after='recipe__steps-content_1-0')
+    heading = doc.by_id('h1','article-heading_1-0')
+    if heading is None or not heading.text():
+        return None
+    rating = doc.by_id('div','mntl-recipe-review-bar__rating_1-0')
+    tagline = doc.by_id('p','article-subheading_1-0')
+
+    ingredients = []
+    lists = doc.by_class('ul','mntl-structured-ingredients__list')
+    for item in lists[0].child_elements('li') if lists else []:
+        paragraph = item.find('p')
+        spans = [span.text() for span in paragraph.child_elements('span')] if paragraph is not None else []
+        if len(spans) > 2:
+            ingredients.append((spans[0],spans[1],spans[2]))
+        elif len(spans) == 2:
+            ingredients.append((spans[0],'',spans[1]))
+
+    instructions = []
+    steps = doc.by_id('div','recipe__steps-content_1-0')
+    ordered = steps.find('ol') if steps is not None else None
+    for item in ordered.child_elements('li') if ordered is not None else []:
+        paragraph = item.find('p')
+        if paragraph is not None and paragraph.text():
+            instructions.append(paragraph.text())
+
+    # the second image is the recipe photo, the next four are thumbnails of user photos
+    images = []
+    img = doc.tags.get('img',[])
+    if len(img) > 1 and img[1].attrs.get('src'):
+        images.append(img[1].attrs['src'].strip())
+    for element in img[2:6]:
+        src = (element.attrs.get('data-src') or '').strip()
+        if src:
+            images.append(src.split('&w=160')[0])
+
+    return {
+        'name':heading.text(),
+        'rating':rating.text() if rating is not None else '',
+        'tagline':tagline.text() if tagline is not None else '',
+        'details':[value.text() for value in doc.by_class('div','mntl-recipe-details__value')],
+        'ingredients':ingredients,
+        'instructions':instructions,
+        'images':images,
+    }
+
+
+_DURATION_RE = re.compile(r'(\d+)\s*(day|hr|hour|min)',re.IGNORECASE)
+_MINUTES = {'day':24*60,'hr':60,'hour':60,'min':1}
+
+def minutes(text: str):
+    '''
+        Minutes of a duration like "15 mins", "1 hr 10 mins" or "2 hrs", a bare
+        number is minutes. None when the text is not a duration.
+    '''
+    text = (text or '').strip()
+    if text.isdigit():
+        return int(text)
+    parts = _DURATION_RE.findall(text)
+    if len(parts) < 1:
+        return None
+    return sum(int(value)*_MINUTES[unit.lower()] for value,unit in parts)
+
+def clean_category(category: str) -> str:
+    # "main-dishes" -> "Main Course", "soups-and-stews" -> "Soups And Stews"
+    if category in ('main-dishes','side-dishes'):
+        category = category[:-2]
+    category = ' '.join(word[0].upper() + word[1:] for word in category.replace('-',' ').split())
+    return CATEGORY_FIXES.get(category,category)
+
+def page_context(listing_path: tuple):
+    '''
+        Cuisine and categories of a recipe from the last three path segments of
+        the listing it was found on, e.g. ("indian", "main-dishes", "rice")
+    '''
+    cuisine,*categories = [part for part in listing_path if part][-3:] or ['']
+    return CUISINE_FIXES.get(cuisine,cuisine),[clean_category(category) for category in categories]
+
+def clean_quantity(quantity: str,unit: str) -> str:
+    # "1" "(15 ounce) can" is 15 ounces, the size in the unit wins over the count
+    size = unit.replace('(','').replace(')','').split()
+    if len(size) > 1:
+        try:
+            return ('%g' % float(size[0]))[:QUANTITY_LENGTH]
+        except ValueError:
+            pass
+    return quantity.strip()[:QUANTITY_LENGTH]
+
+def clean_ingredient(name: str) -> str:
+    name = name.split(', ')[0].strip() # "onion, chopped" -> the rest is the preparation
+    return INGREDIENT_FIXES.get(name.lower(),name)[:INGREDIENT_NAME_LENGTH]
+
+def clean_recipe(raw: dict,contexts: list):
+    '''
+        The recipe in the shape RecipeDb.upsert_recipes takes, None for pages that
+        are not really recipes (no preparation time)
+        Args:
+            contexts: listing paths the page was found on, see page_context
+    '''
+    details = raw['details'] + ['']*(2 - len(raw['details']))
+    preparation_time = minutes(details[0])
+    if not preparation_time:
+        return None
+    cooking_time = minutes(details[1])
+    try:
+        rating = round(float(raw['rating']),1)
+    except ValueError:
+        rating = 0.0
+
+    cuisine,categories = None,[]
+    for context in sorted(contexts):
+        context_cuisine,context_categories = page_context(context)
+        cuisine = cuisine or context_cuisine
+        categories += [category for category in context_categories if category not in categories]
+
+    ingredients = {}
+    for quantity,unit,name in raw['ingredients']:
+        name = clean_ingredient(name)
+        if name and name.casefold() not in ingredients:
+            ingredients[name.casefold()] = (name,clean_quantity(quantity,unit))
+
+    return {
+        'recipe_name':raw['name'][:RECIPE_NAME_LENGTH],
+        'tagline':raw['tagline'],
+        'rating':rating,
+        'preparation_time':preparation_time,
+        'cooking_time':preparation_time if cooking_time is None else cooking_time,
+        'cuisine_name':cuisine or None,
+        'categories':categories,
+        'ingredients':list(ingredients.values()),
+        'instructions':raw['instructions'],
+        'images':list(dict.fromkeys(image[:IMAGE_LENGTH] for image in raw['images'])),
+    }
+
+def scrape(text: str,contexts: list):
+    '''
+        Parses and cleans a recipe page, None when it holds no recipe
+    '''
+    raw = parse_recipe(text)
+    return clean_recipe(raw,contexts) if raw is not None else None
+
+def content_hash(recipe: dict) -> str:
+    return hashlib.sha256(json.dumps(recipe,sort_keys=True).encode()).hexdigest()
+
+
+def fetch(url: str,etag: str = None,last_modified: str = None,timeout: float = 30.0):
+    '''
+        Downloads a page, retrying failed connections and server errors
+        Returns:
+            (text, etag, last_modified), text is None when the server answered
+            304 Not Modified to the conditional request
+    '''
+    headers = {'User-Agent':USER_AGENT}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    for attempt in range(RETRIES + 1):
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url,headers=headers),timeout=timeout) as response:
+                charset = response.headers.get_content_charset() or 'utf-8'
+                text = response.read().decode(charset,errors='replace')
+                return text,response.headers.get('ETag'),response.headers.get('Last-Modified')
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None,etag,last_modified
+            if e.code < 500 or attempt == RETRIES:
+                raise
+        except urllib.error.URLError:
+            if attempt == RETRIES:
+                raise
+        time.sleep(2**attempt)
+
+def bounded_map(function,items,workers: int):
+    '''
+        Calls function on every item from a pool of worker threads, with at most
+        2*workers calls queued so a long input is never submitted at once.
+        Yields the results as they complete, not in input order.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for item in items:
+            pending.add(pool.submit(function,item))
+            if len(pending) >= 2*workers:
+                done,pending = wait(pending,return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done,pending = wait(pending,return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+@contextmanager
+def parser_pool(processes: int = INGEST_PROCESSES):
+    '''
+        Yields a function like scrape that runs it on a pool of processes, the
+        html parser is pure python and holds the GIL so threads parse one page
+        at a time. With processes=0 pages are parsed on the calling thread.
+    '''
+    if processes == 0:
+        yield scrape
+        return
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        yield lambda text,contexts: pool.submit(scrape,text,contexts).result()
+
+
+class Manifest:
+    def __init__(self,path: str = None):
+        '''
+            Page key (url or saved file) -> hash of its cleaned recipe, the
+            validators of the last response and the listings it was found on.
+            Without a path nothing is remembered between runs.
+        '''
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            with open(path,encoding='utf8') as f:
+                self.entries = json.load(f)
+
+    def get(self,key: str) -> dict:
+        return self.entries.get(key,{})
+
+    def update(self,key: str,entry: dict) -> None:
+        self.entries[key] = entry
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        # written next to the old one and swapped in, an interrupted run leaves a valid manifest
+        temporary = self.path + '.tmp'
+        with open(temporary,'w',encoding='utf8') as f:
+            json.dump(self.entries,f)
+        os.replace(temporary,self.path)
+
+
+def _read_page(key: str,contexts: list,manifest: Manifest,force: bool,load,parse) -> dict:
+    '''
+        Loads, parses and cleans one page. Runs on the worker threads, so errors
+        are returned as a status instead of raised.
+        Args:
+            load: function of the previous manifest entry returning (text, etag, last_modified)
+            parse: scrape, or the function of a parser_pool
+    '''
+    contexts = sorted(tuple(context) for context in contexts)
+    previous = manifest.get(key)
+    # a page found on other listings than last time changes categories even if the page did not
+    if force or [tuple(context) for context in previous.get('contexts',[])] != contexts:
+        previous = {}
+    page = {'key':key,'status':'failed','recipe':None,'entry':None}
+    try:
+        text,etag,last_modified = load(previous)
+        if text is None:
+            page['status'] = 'not_modified'
+            return page
+        recipe = parse(text,contexts)
+    except Exception as e:
+        log.warning('page failed',extra={'page':key,'error':str(e)})
+        return page
+    if recipe is None:
+        page['status'] = 'dropped'
+        return page
+
+    digest = content_hash(recipe)
+    page['entry'] = {'hash':digest,'etag':etag,'last_modified':last_modified,
+                     'recipe_name':recipe['recipe_name'],'contexts':contexts}
+    page['status'] = 'unchanged' if previous.get('hash') == digest else 'changed'
+    page['recipe'] = recipe
+    return page
+
+def http_pages(listing_urls: list,manifest: Manifest,workers: int = INGEST_WORKERS,force: bool = False,
+               processes: int = INGEST_PROCESSES):
+    '''
+        Fetches the listings, then every recipe on them, from `workers` threads
+        and parses the recipes on `processes` processes
+    '''
+    def listing(url):
+        try:
+            return url,parse_listing(fetch(url)[0] or '')
+        except Exception as e:
+            log.warning('listing failed',extra={'page':url,'error':str(e)})
+            return url,[]
+
+    # a recipe on several listings is fetched once with the categories of all of them
+    contexts = {}
+    for listing_url,recipe_urls in bounded_map(listing,listing_urls,workers):
+        path = tuple(listing_url.rstrip('/').split('/')[-3:])
+        for url in recipe_urls:
+            contexts.setdefault(url,[]).append(path)
+
+    with parser_pool(processes) as parse:
+        def page(url):
+            load = lambda previous: fetch(url,previous.get('etag'),previous.get('last_modified'))
+            return _read_page(url,contexts[url],manifest,force,load,parse)
+        yield from bounded_map(page,sorted(contexts),workers)
+
+def directory_pages(directory: str,manifest: Manifest,workers: int = INGEST_WORKERS,force: bool = False,
+                    processes: int = INGEST_PROCESSES):
+    '''
+        Reads the saved pages under directory, the folders a page is in stand
+        for the listing it was on. Copies of a page in several folders are one
+        recipe with the categories of all of them.
+    '''
+    files = {}
+    for folder,_,names in os.walk(directory):
+        for name in names:
+            if name.endswith(('.html','.htm')):
+                path = os.path.relpath(os.path.join(folder,name),directory)
+                files.setdefault(name,[]).append(path)
+
+    with parser_pool(processes) as parse:
+        def page(name):
+            paths = sorted(files[name])
+            def load(previous):
+                with open(os.path.join(directory,paths[0]),encoding='utf8',errors='replace') as f:
+                    return f.read(),None,None
+            contexts = [tuple(os.path.dirname(path).split(os.sep)) for path in paths]
+            return _read_page(paths[0],contexts,manifest,force,load,parse)
+        yield from bounded_map(page,sorted(files),workers)
+
+
+def ingest(pages,recipe_db = None,manifest: Manifest = None,batch_size: int = INGEST_BATCH_SIZE) -> dict:
+    '''
+        Upserts the changed recipes of a stream of pages (http_pages or
+        directory_pages) in batches. The manifest is saved after every batch,
+        so an interrupted run resumes where it stopped.
+        Args:
+            recipe_db: RecipeDb to write to, None for a dry run
+        Returns:
+            how many pages were changed, unchanged, not_modified, dropped, failed
+            or duplicate, plus the counts of RecipeDb.upsert_recipes
+    '''
+    manifest = manifest or Manifest()
+    stats = dict.fromkeys(('pages','changed','unchanged','not_modified','dropped','failed','duplicate',
+                           'recipes','new_cuisines','new_categories','new_ingredients'),0)
+    seen = set()
+    batch = []
+
+    def flush():
+        if recipe_db is not None and len(batch) > 0:
+            for key,count in recipe_db.upsert_recipes([page['recipe'] for page in batch]).items():
+                stats[key] += count
+            for page in batch:
+                manifest.update(page['key'],page['entry'])
+            manifest.save()
+            log.info('batch upserted',extra={'recipes':len(batch),'pages':stats['pages']})
+        batch.clear()
+
+    for page in pages:
+        stats['pages'] += 1
+        status = page['status']
+        if page['recipe'] is not None:
+            # the same recipe can be published under several urls, the first one wins
+            name = page['recipe']['recipe_name'].casefold()
+            if name in seen:
+                status = 'duplicate'
+            seen.add(name)
+        stats[status] += 1
+        if status in ('unchanged','duplicate') and recipe_db is not None:
+            manifest.update(page['key'],page['entry']) # keeps fresh validators
+        elif status == 'changed':
+            batch.append(page)
+            if len(batch) >= batch_size:
+                flush()
+    flush()
+    if recipe_db is not None:
+        manifest.save()
+    return stats
+
+
+def main():
+    from instrumentation import setup_logging
+    from db_connections import Connection,RecipeDb
+    import catalog_snapshot
+
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--listing',nargs='+',help='allrecipes.com listing urls')
+    source.add_argument('--pages',help='directory of saved recipe pages')
+    parser.add_argument('--workers',type=int,default=INGEST_WORKERS,help='concurrent downloads or file reads')
+    parser.add_argument('--processes',type=int,default=INGEST_PROCESSES,help='parsing processes, 0 parses on the workers')
+    parser.add_argument('--batch-size',type=int,default=INGEST_BATCH_SIZE)
+    parser.add_argument('--manifest',default=INGEST_MANIFEST)
+    parser.add_argument('--force',action='store_true',help='upsert every recipe, changed or not')
+    parser.add_argument('--dry-run',action='store_true',help='scrape and clean only, write nothing')
+    args = parser.parse_args()
+    setup_logging(LOG_LEVEL)
+
+    manifest = Manifest(args.manifest)
+    if args.listing:
+        pages = http_pages(args.listing,manifest,args.workers,args.force,args.processes)
+    else:
+        pages = directory_pages(args.pages,manifest,args.workers,args.force,args.processes)
+
+    recipe_db = None
+    if not args.dry_run:
+        conn = Connection(username=USERNAME,password=PASSWORD,host=HOST,min_size=1,max_size=1)
+        recipe_db = RecipeDb(dbname=DBNAME,connection=conn)
+    start = time.perf_counter()
+    try:
+        stats = ingest(pages,recipe_db,manifest,args.batch_size)
+        if recipe_db is not None and stats['recipes'] and CATALOG_SNAPSHOT_DIR:
+            # the workers map the published catalog, not the database
+            catalog_snapshot.export(recipe_db,CATALOG_SNAPSHOT_DIR)
+    finally:
+        if recipe_db is not None:
+            recipe_db.close_connection()
+
+    print(f'{stats["pages"]} page(s) in {time.perf_counter() - start:.1f} s')
+    for key,count in stats.items():
+        if key != 'pages':
+            print(f'  {key:<16} {count:>8}')
+    sys.exit(1 if stats['failed'] else 0)
+
+if __name__ == '__main__':
+    main()
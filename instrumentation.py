@@ -0,0 +1,182 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import threading
+import time
+from bisect import bisect_left
+
+
+# upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS_MS = (0.5,1,2,5,10,25,50,100,250,500,1000,2500,float('inf'))
+
+_LITERAL_RE = re.compile(r"'(?:[^'\\]|\\.)*'|\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r'\bIN\s*\((?:\s*(?:%s|\?)\s*,?)+\)',re.IGNORECASE)
+_SPACE_RE = re.compile(r'\s+')
+
+def normalize(query: str) -> str:
+    '''
+        Groups statements that only differ by their literals or IN list length,
+        e.g. "SELECT * FROM recipes WHERE recipe_name IN (%s,%s)" and the same
+        with three placeholders are one histogram
+    '''
+    query = _LITERAL_RE.sub('?',query)
+    query = _IN_LIST_RE.sub('IN (...)',query)
+    return _SPACE_RE.sub(' ',query).strip()[:200]
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+        One json object per line, with the `extra` fields of the record
+    '''
+    _RESERVED = set(vars(logging.makeLogRecord({}))) | {'message','asctime'}
+
+    def format(self,record: logging.LogRecord) -> str:
+        entry = {
+            'time':self.formatTime(record),
+            'level':record.levelname,
+            'logger':record.name,
+            'message':record.getMessage(),
+        }
+        entry.update({key:value for key,value in vars(record).items() if key not in self._RESERVED})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry,default=str)
+
+def setup_logging(level: int = logging.INFO,handler: logging.Handler = None) -> logging.handlers.QueueListener:
+    '''
+        Routes the app's loggers through a queue, so request threads only enqueue
+        records and a background thread formats and writes them
+        Args:
+            handler: where records end up, json lines on stderr by default
+    '''
+    if handler is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter())
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records,handler,respect_handler_level=True)
+    logger = logging.getLogger('recipe_hub')
+    logger.setLevel(level)
+    logger.handlers[:] = [logging.handlers.QueueHandler(records)]
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0]*len(BUCKETS_MS)
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self,ms: float) -> None:
+        self.counts[bisect_left(BUCKETS_MS,ms)] += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def percentile(self,p: float) -> float:
+        '''
+            Upper bound of the bucket holding the p-th percentile
+        '''
+        count = sum(self.counts)
+        if count < 1:
+            return 0.0
+        rank = p/100*count
+        seen = 0
+        for bound,n in zip(BUCKETS_MS,self.counts):
+            seen += n
+            if seen >= rank:
+                return round(min(bound,self.max_ms),3)
+        return round(self.max_ms,3)
+
+    def as_dict(self) -> dict:
+        count = sum(self.counts)
+        return {
+            'count':count,
+            'total_ms':round(self.total_ms,3),
+            'mean_ms':round(self.total_ms/count,3) if count else 0.0,
+            'max_ms':round(self.max_ms,3),
+            'p50_ms':self.percentile(50),
+            'p95_ms':self.percentile(95),
+            'p99_ms':self.percentile(99),
+            'buckets':{('inf' if bound == float('inf') else str(bound)):n
+                       for bound,n in zip(BUCKETS_MS,self.counts) if n},
+        }
+
+
+class QueryStats:
+    def __init__(self,slow_query_ms: float = 100.0,logger: logging.Logger = None):
+        '''
+            Latency histograms per normalized query or procedure and per route,
+            plus the query count and database time of the current request
+            Args:
+                slow_query_ms: queries taking longer are logged, without their arguments
+                    since those include passwords
+        '''
+        self.slow_query_ms = slow_query_ms
+        self.logger = logger or logging.getLogger('recipe_hub.queries')
+        self._queries = {} # normalized statement -> Histogram
+        self._routes = {} # endpoint -> Histogram
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def begin_request(self) -> None:
+        self._local.count = 0
+        self._local.db_ms = 0.0
+        self._local.started = time.perf_counter()
+
+    def request_totals(self):
+        '''
+            (queries, database ms, elapsed ms) of the current request so far
+        '''
+        started = getattr(self._local,'started',None)
+        if started is None:
+            return 0,0.0,0.0
+        return self._local.count,self._local.db_ms,(time.perf_counter() - started)*1000
+
+    def end_request(self,endpoint: str) -> None:
+        if getattr(self._local,'started',None) is None:
+            return
+        _,_,elapsed_ms = self.request_totals()
+        self._local.started = None
+        with self._lock:
+            histogram = self._routes.get(endpoint)
+            if histogram is None:
+                histogram = self._routes[endpoint] = Histogram()
+            histogram.add(elapsed_ms)
+
+    def record(self,statement: str,seconds: float) -> None:
+        '''
+            Records one query or procedure call, statement is the sql or "CALL name"
+        '''
+        ms = seconds*1000
+        if getattr(self._local,'started',None) is not None:
+            self._local.count += 1
+            self._local.db_ms += ms
+        name = normalize(statement)
+        with self._lock:
+            histogram = self._queries.get(name)
+            if histogram is None:
+                histogram = self._queries[name] = Histogram()
+            histogram.add(ms)
+        if ms >= self.slow_query_ms:
+            self.logger.warning('slow query',extra={'statement':name,'duration_ms':round(ms,3)})
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            queries = {name:histogram.as_dict() for name,histogram in self._queries.items()}
+            routes = {name:histogram.as_dict() for name,histogram in self._routes.items()}
+        return {
+            'slow_query_ms':self.slow_query_ms,
+            'queries':dict(sorted(queries.items(),key=lambda item: -item[1]['total_ms'])),
+            'routes':dict(sorted(routes.items(),key=lambda item: -item[1]['total_ms'])),
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._queries.clear()
+            self._routes.clear()
@@ -0,0 +1,204 @@
+import numpy as np
+
+from dietary import recipe_mask
+from nutrition import NUTRIENTS, MEALS, as_dict
+from search_engine import tokenize
+
+
+# categories of recipes light enough to be the snack of a plan, every other
+# category (or no category at all) makes a recipe a breakfast, lunch or dinner
+SNACK_CATEGORIES = ('Appetizers','Bread','Desserts','Drinks','Salads','Side Dish')
+
+# share of the daily targets each meal is expected to cover
+MEAL_SHARES = {'breakfast':0.25,'lunch':0.35,'snack':0.10,'dinner':0.30}
+
+DEFAULT_TARGETS = {'calories':2000.0}
+
+# how much a full 5 star rating lowers the deviation score of a recipe
+RATING_WEIGHT = 0.1
+
+def _singular(token: str) -> str:
+    return token[:-1] if len(token) > 3 and token.endswith('s') else token
+
+
+class MealPlanner:
+    def __init__(self,recipe_names: list,totals: np.ndarray,masks: np.ndarray,
+                 ratings: np.ndarray,slots: np.ndarray,ingredient_recipes: dict):
+        '''
+            Builds daily meal plans out of the catalog. Every recipe gets a dense id,
+            its nutrients, dietary mask, rating and the meals it can be served as are
+            kept in NumPy arrays indexed by that id.
+            Args:
+                totals: recipes x NUTRIENTS matrix
+                slots: recipes x MEALS boolean matrix
+                ingredient_recipes: singular ingredient token -> ids of the recipes using
+                    an ingredient with that token, the allergy exclusion index
+        '''
+        self.recipe_names = recipe_names
+        self.totals = totals
+        self.masks = masks
+        self.ratings = ratings
+        self.slots = slots
+        self._ingredient_recipes = ingredient_recipes
+
+    def __len__(self):
+        return len(self.recipe_names)
+
+    @classmethod
+    def build(cls,recipes: list,recipe_ingredients: list,categories: list,nutrition):
+        '''
+            Args:
+                recipes: rows with recipe_name, rating, vegan, vegetarian, gluten_free and eggetarian
+                recipe_ingredients: rows with recipe_name and ingredient_name
+                categories: rows with recipe_name and recipe_category_name
+                nutrition: NutritionIndex, recipes without nutrition data are left out
+        '''
+        recipes = [row for row,known in zip(recipes,nutrition.ids_of([row['recipe_name'] for row in recipes]) >= 0)
+                   if known]
+        names = [row['recipe_name'] for row in recipes]
+        ids = {name.casefold():i for i,name in enumerate(names)}
+
+        totals = nutrition.totals[nutrition.ids_of(names)].reshape(len(names),len(NUTRIENTS))
+        masks = np.fromiter((recipe_mask(row) for row in recipes),dtype=np.uint8,count=len(recipes))
+        ratings = np.fromiter((float(row['rating'] or 0) for row in recipes),dtype=np.float64,count=len(recipes))
+
+        snack = np.zeros(len(names),dtype=bool)
+        categorized = np.zeros(len(names),dtype=bool)
+        other = np.zeros(len(names),dtype=bool)
+        for row in categories:
+            recipe_id = ids.get(row['recipe_name'].casefold())
+            if recipe_id is None:
+                continue
+            categorized[recipe_id] = True
+            if row['recipe_category_name'] in SNACK_CATEGORIES:
+                snack[recipe_id] = True
+            else:
+                other[recipe_id] = True
+        # a dessert or a drink is not a lunch, unless it is also filed under a main category
+        main = other | ~categorized
+        slots = np.column_stack([snack if meal == 'snack' else main for meal in MEALS]) \
+            if len(names) > 0 else np.zeros((0,len(MEALS)),dtype=bool)
+
+        ingredient_recipes = {}
+        for row in recipe_ingredients:
+            recipe_id = ids.get(row['recipe_name'].casefold())
+            if recipe_id is None:
+                continue
+            for token in tokenize(row['ingredient_name']):
+                ingredient_recipes.setdefault(_singular(token),set()).add(recipe_id)
+        ingredient_recipes = {token:np.fromiter(recipe_ids,dtype=np.int64,count=len(recipe_ids))
+                              for token,recipe_ids in ingredient_recipes.items()}
+        return cls(names,totals,masks,ratings,slots,ingredient_recipes)
+
+    def excluded(self,allergies: list) -> np.ndarray:
+        '''
+            Boolean mask of the recipes using an ingredient the user is allergic to.
+            An allergy matches ingredients containing all of its words, so "peanut"
+            excludes "peanut butter" and "roasted peanuts".
+        '''
+        excluded = np.zeros(len(self.recipe_names),dtype=bool)
+        for allergy in allergies:
+            tokens = [_singular(token) for token in tokenize(allergy)]
+            if len(tokens) < 1:
+                continue
+            # recipes having every word somewhere in their ingredients, close enough
+            # to "an ingredient with every word" for the short names allergies use
+            matched = None
+            for token in tokens:
+                recipe_ids = self._ingredient_recipes.get(token)
+                if recipe_ids is None:
+                    matched = None
+                    break
+                matched = recipe_ids if matched is None else np.intersect1d(matched,recipe_ids)
+            if matched is not None:
+                excluded[matched] = True
+        return excluded
+
+    def _deviation(self,totals: np.ndarray,targets: dict,share: float = 1.0) -> np.ndarray:
+        # sum of the relative distances to the targets, the last axis of totals is NUTRIENTS
+        deviation = np.zeros(totals.shape[:-1])
+        for nutrient,target in targets.items():
+            target = share*float(target)
+            deviation += np.abs(totals[...,NUTRIENTS.index(nutrient)] - target)/target
+        return deviation
+
+    def generate(self,user_mask=None,allergies: list = (),targets: dict = None,
+                 count: int = 5,candidates: int = 24) -> list:
+        '''
+            Returns up to count plans, best first, as dicts with the meal_plans
+            columns (breakfast_name, lunch_name, snack_name, dinner_name) plus
+            their nutrition and score, lower scores are closer to the targets.
+
+            Each meal keeps its best `candidates` recipes for its share of the
+            targets, then every combination of those is scored at once: breakfast
+            and lunch pairs against snack and dinner pairs, a candidates**2 square
+            matrix instead of a loop over candidates**4 plans.
+            Args:
+                user_mask: dietary bitmask of the user, None accepts every recipe
+                allergies: ingredient names to keep out of the plans
+                targets: nutrient -> daily amount, DEFAULT_TARGETS when not given
+        '''
+        targets = {nutrient:value for nutrient,value in (targets or DEFAULT_TARGETS).items()
+                   if nutrient in NUTRIENTS and value and float(value) > 0}
+        if len(targets) < 1:
+            targets = DEFAULT_TARGETS
+
+        allowed = ~self.excluded(allergies)
+        if user_mask is not None:
+            allowed &= (self.masks & np.uint8(user_mask)) != 0
+
+        bonus = RATING_WEIGHT*self.ratings/5
+        picks = []
+        for i,meal in enumerate(MEALS):
+            recipe_ids = np.flatnonzero(allowed & self.slots[:,i])
+            if len(recipe_ids) < 1:
+                return []
+            score = self._deviation(self.totals[recipe_ids],targets,MEAL_SHARES[meal]) - bonus[recipe_ids]
+            if len(recipe_ids) > candidates:
+                best = np.argpartition(score,candidates - 1)[:candidates]
+                recipe_ids = recipe_ids[best]
+            picks.append(recipe_ids)
+
+        def pairs(first,second):
+            ids = np.stack(np.meshgrid(first,second,indexing='ij'),axis=-1).reshape(-1,2)
+            return ids,self.totals[ids[:,0]] + self.totals[ids[:,1]],bonus[ids[:,0]] + bonus[ids[:,1]]
+
+        breakfast,lunch,snack,dinner = picks # in MEALS order
+        left_ids,left_totals,left_bonus = pairs(breakfast,lunch)
+        right_ids,right_totals,right_bonus = pairs(snack,dinner)
+
+        plan_totals = left_totals[:,None,:] + right_totals[None,:,:]
+        scores = self._deviation(plan_totals,targets) - left_bonus[:,None] - right_bonus[None,:]
+        # a recipe is served once a day
+        repeated = (left_ids[:,0] == left_ids[:,1])[:,None] | (right_ids[:,0] == right_ids[:,1])[None,:]
+        for a in range(2):
+            for b in range(2):
+                repeated |= left_ids[:,a,None] == right_ids[None,:,b]
+        scores[repeated] = np.inf
+
+        flat = scores.ravel()
+        # the same four recipes in other meals score alike, so more plans are
+        # ranked than asked for and only one order of each set of recipes is kept
+        ranked = min(4*count,int(np.isfinite(flat).sum()))
+        if ranked < 1:
+            return []
+        best = np.argpartition(flat,ranked - 1)[:ranked]
+        best = best[np.argsort(flat[best],kind='stable')]
+
+        plans = []
+        seen = set()
+        for index in best:
+            if len(plans) >= count:
+                break
+            left,right = np.unravel_index(index,scores.shape)
+            recipe_ids = {'breakfast':left_ids[left,0],'lunch':left_ids[left,1],
+                          'snack':right_ids[right,0],'dinner':right_ids[right,1]}
+            key = frozenset(int(recipe_id) for recipe_id in recipe_ids.values())
+            if key in seen:
+                continue
+            seen.add(key)
+            plan = {f'{meal}_name':self.recipe_names[recipe_ids[meal]] for meal in MEALS}
+            plan['nutrition'] = as_dict(plan_totals[left,right])
+            plan['score'] = round(float(flat[index]),4)
+            plans.append(plan)
+        return plans
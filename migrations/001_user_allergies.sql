@@ -0,0 +1,9 @@
+-- Ingredients each user is allergic to, collected by the register form.
+-- Apply after projedt_dump.sql: mysql recipe_management < migrations/001_user_allergies.sql
+
+CREATE TABLE IF NOT EXISTS `user_allergies` (
+  `user_id` int NOT NULL,
+  `allergy` varchar(255) NOT NULL,
+  PRIMARY KEY (`user_id`,`allergy`),
+  CONSTRAINT `user_allergies_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `users` (`user_id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
@@ -0,0 +1,149 @@
+-- Like count, review count and rating sum of every recipe, kept up to date by
+-- the procedures below so reads do not aggregate user_liked_recipes and
+-- user_comments. A missing row means all three are zero.
+-- Apply after 001: mysql recipe_management < migrations/002_recipe_stats.sql
+-- RecipeDb.reconcile_recipe_stats() (python reconcile_stats.py) reports and fixes drift.
+
+CREATE TABLE IF NOT EXISTS `recipe_stats` (
+  `recipe_name` varchar(180) NOT NULL,
+  `like_count` int NOT NULL DEFAULT '0',
+  `review_count` int NOT NULL DEFAULT '0',
+  `rating_sum` decimal(12,1) NOT NULL DEFAULT '0.0',
+  PRIMARY KEY (`recipe_name`),
+  CONSTRAINT `recipe_stats_ibfk_1` FOREIGN KEY (`recipe_name`) REFERENCES `recipes` (`recipe_name`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+INSERT INTO recipe_stats (recipe_name,like_count,review_count,rating_sum)
+SELECT r.recipe_name,
+    (SELECT COUNT(*) FROM user_liked_recipes l WHERE l.recipe_name = r.recipe_name),
+    (SELECT COUNT(*) FROM user_comments c WHERE c.recipe_name = r.recipe_name),
+    (SELECT COALESCE(SUM(c.rating),0) FROM user_comments c WHERE c.recipe_name = r.recipe_name)
+FROM recipes r
+ON DUPLICATE KEY UPDATE like_count = VALUES(like_count),review_count = VALUES(review_count),
+    rating_sum = VALUES(rating_sum);
+
+DROP PROCEDURE IF EXISTS `toggle_like_recipe`;
+DROP PROCEDURE IF EXISTS `rate_recipe`;
+DROP PROCEDURE IF EXISTS `delete_comment`;
+DROP PROCEDURE IF EXISTS `delete_user_by_id`;
+
+DELIMITER ;;
+CREATE PROCEDURE `toggle_like_recipe`(
+    IN user_id_param INT,
+    IN recipe_name_param VARCHAR(180)
+)
+BEGIN
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+    -- deleting first makes the check and the change one atomic step
+    DELETE FROM user_liked_recipes
+    WHERE user_id = user_id_param AND recipe_name = recipe_name_param;
+
+    IF ROW_COUNT() > 0 THEN
+        UPDATE recipe_stats SET like_count = like_count - 1
+        WHERE recipe_name = recipe_name_param;
+    ELSE
+        INSERT INTO user_liked_recipes (user_id, recipe_name, liked_date)
+        VALUES (user_id_param, recipe_name_param, NOW());
+        INSERT INTO recipe_stats (recipe_name, like_count) VALUES (recipe_name_param, 1)
+        ON DUPLICATE KEY UPDATE like_count = like_count + 1;
+    END IF;
+    COMMIT;
+END ;;
+
+CREATE PROCEDURE `rate_recipe`(
+    IN p_user_id INT,
+    IN p_recipe_name VARCHAR(180),
+    IN p_rating DECIMAL(3, 1),
+    IN p_user_comment TEXT
+)
+BEGIN
+    DECLARE old_rating DECIMAL(3, 1) DEFAULT NULL;
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+    SELECT rating INTO old_rating FROM user_comments
+    WHERE user_id = p_user_id AND recipe_name = p_recipe_name
+    LIMIT 1 FOR UPDATE;
+
+    IF old_rating IS NOT NULL THEN
+        -- Update the existing rating
+        UPDATE user_comments
+        SET rating = p_rating,
+        user_comment = p_user_comment,
+        commented_datetime = NOW()
+        WHERE user_id = p_user_id AND recipe_name = p_recipe_name;
+        UPDATE recipe_stats SET rating_sum = rating_sum - old_rating + p_rating
+        WHERE recipe_name = p_recipe_name;
+    ELSE
+        -- Insert a new rating
+        INSERT INTO
+        user_comments(user_id, recipe_name, user_comment,rating,commented_datetime)
+        VALUES (p_user_id, p_recipe_name,p_user_comment,p_rating,NOW());
+        INSERT INTO recipe_stats (recipe_name, review_count, rating_sum) VALUES (p_recipe_name, 1, p_rating)
+        ON DUPLICATE KEY UPDATE review_count = review_count + 1, rating_sum = rating_sum + p_rating;
+    END IF;
+    COMMIT;
+END ;;
+
+CREATE PROCEDURE `delete_comment`(
+    IN p_user_id INT,
+    IN p_recipe_name VARCHAR(180)
+)
+BEGIN
+    DECLARE removed INT;
+    DECLARE removed_rating DECIMAL(12, 1);
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+    SELECT COUNT(*), COALESCE(SUM(rating), 0) INTO removed, removed_rating FROM user_comments
+    WHERE recipe_name = p_recipe_name AND user_id = p_user_id
+    FOR UPDATE;
+
+    DELETE FROM user_comments
+    WHERE recipe_name = p_recipe_name AND user_id = p_user_id;
+
+    UPDATE recipe_stats SET review_count = review_count - removed, rating_sum = rating_sum - removed_rating
+    WHERE recipe_name = p_recipe_name AND removed > 0;
+    COMMIT;
+END ;;
+
+CREATE PROCEDURE `delete_user_by_id`(
+    IN user_id_param INT
+)
+BEGIN
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+    -- the user's likes and reviews go with the user (ON DELETE CASCADE), take them out of the counters first
+    UPDATE recipe_stats s
+    JOIN (SELECT recipe_name, COUNT(*) AS removed FROM user_liked_recipes
+          WHERE user_id = user_id_param GROUP BY recipe_name) l ON l.recipe_name = s.recipe_name
+    SET s.like_count = s.like_count - l.removed;
+
+    UPDATE recipe_stats s
+    JOIN (SELECT recipe_name, COUNT(*) AS removed, SUM(rating) AS removed_rating FROM user_comments
+          WHERE user_id = user_id_param GROUP BY recipe_name) c ON c.recipe_name = s.recipe_name
+    SET s.review_count = s.review_count - c.removed, s.rating_sum = s.rating_sum - c.removed_rating;
+
+    DELETE FROM users WHERE user_id = user_id_param;
+    COMMIT;
+END ;;
+DELIMITER ;
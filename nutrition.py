@@ -0,0 +1,119 @@
+import re
+import unicodedata
+
+import numpy as np
+
+
+NUTRIENTS = ('calories','protein','fats','carbs','sugar')
+
+MEALS = ('breakfast','lunch','snack','dinner')
+
+# quantity used for recipe_ingredients rows whose quantity is empty or unreadable
+DEFAULT_QUANTITY = 1.0
+
+_NUMBER_RE = re.compile(r'(\d+(?:\.\d+)?)(?:\s*/\s*(\d+))?')
+
+def parse_quantity(text):
+    '''
+        Parses a recipe_ingredients.quantity into a number of measurement units,
+        e.g. "2", "½", "1 ½", "1/2", "1 1/2" or "0.2". Ranges like "1-2" take the
+        lower bound. Returns None when no number can be read.
+    '''
+    if text is None:
+        return None
+    # NFKC turns vulgar fractions into "1⁄2" with a fraction slash
+    text = unicodedata.normalize('NFKC',str(text)).replace('⁄','/')
+    text = re.sub(r'(\d)(\d/\d)',r'\1 \2',text) # "1½" normalizes to "11/2"
+    text = text.split('-')[0]
+    total = None
+    for whole,denominator in _NUMBER_RE.findall(text):
+        if denominator and float(denominator) == 0:
+            return None # "1/0" is a typo, not a number
+        value = float(whole)/float(denominator) if denominator else float(whole)
+        total = value if total is None else total + value
+    return total
+
+
+class NutritionIndex:
+    def __init__(self,recipe_names: list,totals: np.ndarray):
+        '''
+            Nutrition totals of every recipe as a recipes x NUTRIENTS matrix
+        '''
+        self.recipe_names = recipe_names
+        self.totals = totals
+        self._ids = {name.casefold():i for i,name in enumerate(recipe_names)}
+
+    def __len__(self):
+        return len(self.recipe_names)
+
+    @classmethod
+    def build(cls,recipe_ingredients: list,ingredients: list):
+        '''
+            Args:
+                recipe_ingredients: rows with recipe_name, ingredient_name and quantity
+                ingredients: rows with ingredient_name and the NUTRIENTS columns,
+                    given per one measurement unit
+        '''
+        ingredient_ids = {row['ingredient_name'].casefold():i for i,row in enumerate(ingredients)}
+        per_unit = np.array([[float(row[n] or 0) for n in NUTRIENTS] for row in ingredients],
+                            dtype=np.float64).reshape(len(ingredients),len(NUTRIENTS))
+
+        recipe_ids = {}
+        rows,cols,quantities = [],[],[]
+        for row in recipe_ingredients:
+            ingredient = ingredient_ids.get(row['ingredient_name'].casefold())
+            recipe = recipe_ids.setdefault(row['recipe_name'],len(recipe_ids))
+            if ingredient is None:
+                continue
+            quantity = parse_quantity(row['quantity'])
+            rows.append(recipe)
+            cols.append(ingredient)
+            quantities.append(DEFAULT_QUANTITY if quantity is None else quantity)
+
+        # totals[r] = sum over the recipe's ingredients of quantity * nutrients per unit
+        totals = np.zeros((len(recipe_ids),len(NUTRIENTS)),dtype=np.float64)
+        np.add.at(totals,np.array(rows,dtype=np.int64),
+                  np.array(quantities,dtype=np.float64)[:,None]*per_unit[np.array(cols,dtype=np.int64)])
+        return cls(list(recipe_ids),totals)
+
+    def ids_of(self,recipe_names: list) -> np.ndarray:
+        '''
+            Recipe ids of the given names, -1 for recipes without ingredients
+        '''
+        ids = self._ids
+        return np.fromiter((ids.get(name.casefold(),-1) for name in recipe_names),
+                           dtype=np.int64,count=len(recipe_names))
+
+    def basket_vector(self,recipe_names: list,servings: list = None) -> np.ndarray:
+        '''
+            Nutrient totals of a basket of recipes, a recipe listed twice counts twice
+            Args:
+                servings: optional multiplier per recipe, 1 by default
+        '''
+        ids = self.ids_of(recipe_names)
+        weights = np.ones(len(ids)) if servings is None else np.asarray(servings,dtype=np.float64)
+        known = ids >= 0
+        return weights[known] @ self.totals[ids[known]] if known.any() else np.zeros(len(NUTRIENTS))
+
+    def recipe_totals(self,recipe_name: str) -> dict:
+        return as_dict(self.basket_vector([recipe_name]))
+
+    def basket_totals(self,recipe_names: list,servings: list = None) -> dict:
+        return as_dict(self.basket_vector(recipe_names,servings))
+
+    def meal_plan_totals(self,meal_plan: dict) -> dict:
+        '''
+            Per-meal and total nutrients of a meal_plans row
+        '''
+        names = [meal_plan.get(f'{meal}_name') or '' for meal in MEALS]
+        ids = self.ids_of(names)
+        known = ids >= 0
+        per_meal = np.zeros((len(MEALS),len(NUTRIENTS)))
+        per_meal[known] = self.totals[ids[known]]
+        totals = {meal:as_dict(per_meal[i]) for i,meal in enumerate(MEALS)}
+        totals['total'] = as_dict(per_meal.sum(axis=0))
+        return totals
+
+
+def as_dict(vector: np.ndarray) -> dict:
+    return {nutrient:round(float(value),2) for nutrient,value in zip(NUTRIENTS,vector)}
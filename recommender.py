@@ -0,0 +1,247 @@
+import threading
+
+import numpy as np
+
+
+# weight of each signal in the similarity of two recipes, both are cosines in [0, 1]
+INGREDIENT_WEIGHT = 0.4
+CO_LIKE_WEIGHT = 0.6
+
+NEIGHBORS = 20
+
+# ingredients in more than this share of the recipes (salt, water, oil) say little
+# about two recipes being alike and have the longest postings, so they are skipped
+COMMON_INGREDIENT_SHARE = 0.1
+
+def _top(ids: np.ndarray,scores: np.ndarray,k: int):
+    # the k best (id, score) pairs, best first, zero scores dropped
+    keep = scores > 0
+    ids,scores = ids[keep],scores[keep]
+    if len(ids) > k:
+        best = np.argpartition(-scores,k - 1)[:k]
+        ids,scores = ids[best],scores[best]
+    order = np.argsort(-scores,kind='stable')
+    return ids[order],scores[order]
+
+
+class RecipeRecommender:
+    def __init__(self,neighbors: int = NEIGHBORS):
+        '''
+            Item to item recommendations. Two recipes are similar when they share
+            ingredients (cosine of their sparse ingredient vectors) and when the
+            same users like them (cosine of their sparse liker vectors, a favorite
+            meal plan counts as a like of its four recipes). The best `neighbors`
+            of every recipe are precomputed, a user's recommendations are the
+            neighbors of their liked recipes summed.
+        '''
+        self.k = neighbors
+        self.recipe_names = []
+        self._ids = {} # case-folded recipe_name -> id
+        self._ingredients = [] # id -> ids of its ingredients
+        self._postings = {} # ingredient id -> ids of the recipes using it
+        self._ingredient_ids = {}
+        self._likes = {} # user_id -> {recipe id: sources, the recipe itself or favorite meal plans}
+        self._like_counts = np.zeros(0,dtype=np.float64) # id -> users liking the recipe
+        self._sizes = np.zeros(0,dtype=np.float64) # id -> number of ingredients
+        self._co_likes = [] # id -> {other id: users liking both}
+        self._neighbors = [] # id -> (ids, scores)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.recipe_names)
+
+    @classmethod
+    def build(cls,recipe_ingredients: list,liked_recipes: list,favorite_plans: list,
+              meal_plans: list,neighbors: int = NEIGHBORS):
+        '''
+            Args:
+                recipe_ingredients: rows with recipe_name and ingredient_name
+                liked_recipes: user_liked_recipes rows with user_id and recipe_name
+                favorite_plans: user_favorite_meal_plans rows with user_id and meal_plan_name
+                meal_plans: meal_plans rows
+        '''
+        recommender = cls(neighbors)
+        for row in recipe_ingredients:
+            recommender._add_ingredient(recommender._id(row['recipe_name']),row['ingredient_name'])
+        recommender._postings = {ingredient:np.array(sorted(ids),dtype=np.int64)
+                                 for ingredient,ids in recommender._postings.items()}
+
+        for row in liked_recipes:
+            recommender._signal(row['user_id'],recommender._id(row['recipe_name']),None,True)
+        plans = {plan['meal_plan_name'].casefold():plan for plan in meal_plans}
+        for row in favorite_plans:
+            plan = plans.get(row['meal_plan_name'].casefold())
+            for name in _plan_recipes(plan):
+                recommender._signal(row['user_id'],recommender._id(name),plan['meal_plan_name'],True)
+
+        recommender._neighbors = [recommender._rank(recipe_id) for recipe_id in range(len(recommender))]
+        return recommender
+
+    def _id(self,recipe_name: str) -> int:
+        key = recipe_name.casefold()
+        recipe_id = self._ids.get(key)
+        if recipe_id is None:
+            recipe_id = self._ids[key] = len(self.recipe_names)
+            self.recipe_names.append(recipe_name)
+            self._ingredients.append(set())
+            self._co_likes.append({})
+            self._neighbors.append((np.zeros(0,dtype=np.int64),np.zeros(0)))
+            if recipe_id >= len(self._like_counts):
+                size = max(16,2*len(self._like_counts))
+                self._like_counts = np.resize(self._like_counts,size)
+                self._like_counts[recipe_id:] = 0
+                self._sizes = np.resize(self._sizes,size)
+                self._sizes[recipe_id:] = 0
+        return recipe_id
+
+    def _add_ingredient(self,recipe_id: int,ingredient_name: str) -> None:
+        ingredient = self._ingredient_ids.setdefault(ingredient_name.casefold(),len(self._ingredient_ids))
+        if ingredient not in self._ingredients[recipe_id]:
+            self._ingredients[recipe_id].add(ingredient)
+            self._sizes[recipe_id] += 1
+        self._postings.setdefault(ingredient,set()).add(recipe_id)
+
+    def _signal(self,user_id: int,recipe_id: int,source,liked: bool) -> list:
+        '''
+            Records a like of the user, source is None for the recipe itself or the
+            name of a favorite meal plan. Returns the recipes whose co-likes with
+            recipe_id changed, empty when the recipe stays liked or not liked.
+        '''
+        likes = self._likes.setdefault(user_id,{})
+        sources = likes.get(recipe_id,set())
+        was_liked = len(sources) > 0
+        sources = sources | {source} if liked else sources - {source}
+        if len(sources) > 0:
+            likes[recipe_id] = sources
+        else:
+            likes.pop(recipe_id,None)
+        if was_liked == (len(sources) > 0):
+            return []
+
+        others = [other for other in likes if other != recipe_id]
+        self._like_counts[recipe_id] += 1 if liked else -1
+        co_likes = self._co_likes[recipe_id]
+        for other in others:
+            together = co_likes.get(other,0) + (1 if liked else -1)
+            if together > 0:
+                co_likes[other] = together
+                self._co_likes[other][recipe_id] = together
+            else:
+                co_likes.pop(other,None)
+                self._co_likes[other].pop(recipe_id,None)
+        return others
+
+    def _similarities(self,recipe_id: int):
+        # similarity of recipe_id with every recipe sharing an ingredient or a liker
+        size = len(self.recipe_names)
+        ingredient_score = np.zeros(size)
+        ingredients = self._ingredients[recipe_id]
+        common = max(50,COMMON_INGREDIENT_SHARE*size)
+        postings = [self._postings[i] for i in ingredients if len(self._postings[i]) <= common]
+        if len(postings) > 0:
+            shared = np.bincount(np.concatenate(postings),minlength=size)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                ingredient_score = np.nan_to_num(shared/np.sqrt(self._sizes[:size]*len(ingredients)))
+
+        like_score = np.zeros(size)
+        co_likes = self._co_likes[recipe_id]
+        if len(co_likes) > 0:
+            others = np.fromiter(co_likes.keys(),dtype=np.int64,count=len(co_likes))
+            together = np.fromiter(co_likes.values(),dtype=np.float64,count=len(co_likes))
+            like_score[others] = together/np.sqrt(self._like_counts[others]*self._like_counts[recipe_id])
+
+        scores = INGREDIENT_WEIGHT*ingredient_score + CO_LIKE_WEIGHT*like_score
+        scores[recipe_id] = 0
+        return scores
+
+    def _rank(self,recipe_id: int):
+        return _top(np.arange(len(self.recipe_names)),self._similarities(recipe_id),self.k)
+
+    def _patch(self,recipe_id: int,other: int,score: float) -> None:
+        # moves other in or out of the neighbors of recipe_id after its score changed,
+        # a recipe dropping out is not replaced until the next full rank of recipe_id
+        ids,scores = self._neighbors[recipe_id]
+        keep = ids != other
+        ids,scores = ids[keep],scores[keep]
+        if score > 0 and (len(ids) < self.k or score > scores[-1]):
+            ids,scores = np.append(ids,other),np.append(scores,score)
+        self._neighbors[recipe_id] = _top(ids,scores,self.k)
+
+    def set_liked(self,user_id: int,recipe_names: list,liked: bool,meal_plan: str = None) -> None:
+        '''
+            Records that the user liked (or no longer likes) the recipes, or the
+            meal plan made of them, and updates the affected neighbors. Setting
+            the state a like already has changes nothing.
+        '''
+        with self._lock:
+            for name in recipe_names:
+                recipe_id = self._id(name)
+                changed = self._signal(user_id,recipe_id,meal_plan,liked)
+                if len(changed) < 1:
+                    continue
+                scores = self._similarities(recipe_id)
+                self._neighbors[recipe_id] = _top(np.arange(len(scores)),scores,self.k)
+                for other in changed:
+                    self._patch(other,recipe_id,scores[other])
+
+    def remove_user(self,user_id: int) -> None:
+        with self._lock:
+            likes = self._likes.get(user_id,{})
+            for recipe_id,sources in list(likes.items()):
+                for source in list(sources):
+                    self.set_liked(user_id,[self.recipe_names[recipe_id]],False,source)
+            self._likes.pop(user_id,None)
+
+    def set_recipe(self,recipe_name: str,ingredient_names: list) -> None:
+        '''
+            Adds a recipe or replaces its ingredients
+        '''
+        with self._lock:
+            recipe_id = self._id(recipe_name)
+            for ingredient in self._ingredients[recipe_id]:
+                self._postings[ingredient] = self._postings[ingredient][self._postings[ingredient] != recipe_id]
+            self._ingredients[recipe_id] = set()
+            for name in ingredient_names:
+                ingredient = self._ingredient_ids.setdefault(name.casefold(),len(self._ingredient_ids))
+                self._ingredients[recipe_id].add(ingredient)
+            self._sizes[recipe_id] = len(self._ingredients[recipe_id])
+            for ingredient in self._ingredients[recipe_id]:
+                postings = self._postings.get(ingredient,np.zeros(0,dtype=np.int64))
+                self._postings[ingredient] = np.union1d(postings,[recipe_id]).astype(np.int64)
+            scores = self._similarities(recipe_id)
+            self._neighbors[recipe_id] = _top(np.arange(len(scores)),scores,self.k)
+            for other in np.flatnonzero(scores):
+                self._patch(int(other),recipe_id,scores[other])
+
+    def similar(self,recipe_name: str,limit: int = 8) -> list:
+        recipe_id = self._ids.get(recipe_name.casefold())
+        if recipe_id is None:
+            return []
+        ids,_ = self._neighbors[recipe_id]
+        return [self.recipe_names[i] for i in ids[:limit]]
+
+    def recommend(self,user_id: int,limit: int = 8) -> list:
+        '''
+            Recipe names the user has not liked yet, most similar to the ones they
+            liked first. Empty for users without likes.
+        '''
+        with self._lock:
+            liked = list(self._likes.get(user_id,{}))
+            if len(liked) < 1:
+                return []
+            neighbors = [self._neighbors[recipe_id] for recipe_id in liked]
+        ids = np.concatenate([ids for ids,_ in neighbors])
+        scores = np.concatenate([scores for _,scores in neighbors])
+        if len(ids) < 1:
+            return []
+        totals = np.bincount(ids,weights=scores,minlength=len(self.recipe_names))
+        totals[liked] = 0
+        ids,_ = _top(np.arange(len(totals)),totals,limit)
+        return [self.recipe_names[i] for i in ids]
+
+
+def _plan_recipes(meal_plan: dict) -> list:
+    if meal_plan is None:
+        return []
+    return [meal_plan[column] for column in ('breakfast_name','lunch_name','snack_name','dinner_name')
+            if meal_plan.get(column)]
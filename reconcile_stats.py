@@ -0,0 +1,37 @@
+'''
+    Recomputes the recipe_stats counters (migrations/002_recipe_stats.sql) and
+    prints the recipes whose stored counts drifted from user_liked_recipes and
+    user_comments. Meant to run from cron next to the app.
+
+    Usage:
+        python reconcile_stats.py [--dry-run]
+'''
+import argparse
+import sys
+
+from settings import *
+from db_connections import Connection,RecipeDb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run',action='store_true',help='only report the drift, do not fix it')
+    args = parser.parse_args()
+
+    conn = Connection(username=USERNAME,password=PASSWORD,host=HOST,min_size=1,max_size=1)
+    recipe_db = RecipeDb(dbname=DBNAME,connection=conn)
+    try:
+        drifted = recipe_db.reconcile_recipe_stats(fix=not args.dry_run)
+    finally:
+        recipe_db.close_connection()
+
+    for row in drifted:
+        print(f"{row['recipe_name']}: likes {row['like_count']} -> {row['actual_like_count']}, "
+              f"reviews {row['review_count']} -> {row['actual_review_count']}, "
+              f"rating sum {row['rating_sum']} -> {row['actual_rating_sum']}")
+    print(f"{len(drifted)} recipe(s) drifted{'' if args.dry_run or not drifted else ', fixed'}")
+    # non-zero exit so cron mails the report when counters drift
+    sys.exit(1 if drifted else 0)
+
+if __name__ == '__main__':
+    main()
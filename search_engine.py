@@ -0,0 +1,150 @@
+import re
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+
+
+NAME_WEIGHT = 3.0
+INGREDIENT_WEIGHT = 1.0
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+def fold(text: str) -> str:
+    '''
+        Lower-cases text and strips accents, e.g. "Crème Brûlée" -> "creme brulee"
+    '''
+    text = unicodedata.normalize('NFKD',text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return text.casefold()
+
+def tokenize(text: str) -> list:
+    return _TOKEN_RE.findall(fold(text or ''))
+
+
+class RecipeSearchIndex:
+    def __init__(self):
+        '''
+            In-memory inverted index over recipe names and their ingredient names.
+            Query tokens are prefix-matched against the vocabulary, every query
+            token has to match and results are ranked by relevance, then rating.
+        '''
+        self._postings = {} # token -> {recipe_name: weight}
+        self._vocabulary = [] # sorted tokens, for prefix lookups
+        self._documents = {} # recipe_name -> {token: weight}
+        self._ratings = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __contains__(self,recipe_name: str):
+        return recipe_name in self._documents
+
+    @classmethod
+    def build(cls,recipes: list,recipe_ingredients: list):
+        '''
+            Args:
+                recipes: rows with recipe_name and rating
+                recipe_ingredients: rows with recipe_name and ingredient_name
+        '''
+        ingredients = {}
+        for row in recipe_ingredients:
+            ingredients.setdefault(row['recipe_name'],[]).append(row['ingredient_name'])
+
+        index = cls()
+        for row in recipes:
+            name = row['recipe_name']
+            index.add_recipe(name,row['rating'],ingredients.get(name,[]))
+        return index
+
+    def add_recipe(self,recipe_name: str,rating,ingredients: list = ()) -> None:
+        '''
+            Indexes a recipe, replacing what was indexed for it before
+        '''
+        weights = {}
+        for token in tokenize(recipe_name):
+            weights[token] = max(weights.get(token,0),NAME_WEIGHT)
+        for ingredient in ingredients:
+            for token in tokenize(ingredient):
+                weights[token] = max(weights.get(token,0),INGREDIENT_WEIGHT)
+
+        with self._lock:
+            self._remove(recipe_name)
+            self._documents[recipe_name] = weights
+            self._ratings[recipe_name] = float(rating or 0)
+            for token,weight in weights.items():
+                posting = self._postings.get(token)
+                if posting is None:
+                    posting = self._postings[token] = {}
+                    insort(self._vocabulary,token)
+                posting[recipe_name] = weight
+
+    def remove_recipe(self,recipe_name: str) -> None:
+        with self._lock:
+            self._remove(recipe_name)
+
+    def _remove(self,recipe_name: str) -> None:
+        weights = self._documents.pop(recipe_name,None)
+        self._ratings.pop(recipe_name,None)
+        if weights is None:
+            return
+        for token in weights:
+            posting = self._postings[token]
+            del posting[recipe_name]
+            if not posting:
+                del self._postings[token]
+                del self._vocabulary[bisect_left(self._vocabulary,token)]
+
+    def update_rating(self,recipe_name: str,rating) -> None:
+        with self._lock:
+            if recipe_name in self._ratings:
+                self._ratings[recipe_name] = float(rating or 0)
+
+    def _expand(self,prefix: str) -> list:
+        start = bisect_left(self._vocabulary,prefix)
+        end = bisect_left(self._vocabulary,prefix + '\uffff')
+        return self._vocabulary[start:end]
+
+    def ratings_of(self,recipe_names: list) -> list:
+        '''
+            Indexed ratings of the given recipes, 0 for recipes that are not indexed
+        '''
+        ratings = self._ratings
+        return [ratings.get(name,0.0) for name in recipe_names]
+
+    def search(self,query: str,limit: int = None) -> list:
+        '''
+            Returns the names of the recipes matching every token of the query,
+            best matches first. An empty query returns every recipe by rating.
+        '''
+        ranked = [name for name,_,_ in self.search_scored(query)]
+        return ranked if limit is None else ranked[:limit]
+
+    def search_scored(self,query: str) -> list:
+        '''
+            Same ranking as search, as (recipe_name, score, rating) tuples
+        '''
+        tokens = tokenize(query)
+        with self._lock:
+            if not tokens:
+                scores = dict.fromkeys(self._documents,0.0)
+            else:
+                scores = None
+                for token in dict.fromkeys(tokens):
+                    matches = {}
+                    for term in self._expand(token):
+                        # exact token matches rank above prefix matches
+                        bonus = 1.0 if term == token else 0.5
+                        for recipe_name,weight in self._postings[term].items():
+                            score = weight*bonus
+                            if score > matches.get(recipe_name,0):
+                                matches[recipe_name] = score
+                    if scores is None:
+                        scores = matches
+                    else:
+                        scores = {name:score + matches[name] for name,score in scores.items() if name in matches}
+                    if not scores:
+                        return []
+            ratings = self._ratings
+            ranked = sorted(scores,key=lambda name: (-scores[name],-ratings[name],name))
+            return [(name,scores[name],ratings[name]) for name in ranked]
@@ -0,0 +1,166 @@
+import json
+import os
+import re
+import secrets
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+_SID_RE = re.compile(r'[A-Za-z0-9_-]{32,64}')
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self,initial: dict = None,sid: str = None,new: bool = False,expires_at: float = None):
+        def on_update(session):
+            session.modified = True
+        super().__init__(initial,on_update)
+        self.sid = sid
+        self.new = new
+        self.expires_at = expires_at # when the stored session expires, None until it is stored
+        self.modified = False
+        # what the store holds, to skip writes of unchanged sessions
+        self.stored = json.loads(json.dumps(initial or {}))
+
+
+class MemorySessionStore:
+    def __init__(self):
+        '''
+            Sessions kept in process memory, only suitable for a single process
+        '''
+        self._sessions = {} # sid -> (expires_at, data)
+        self._lock = threading.Lock()
+
+    def load(self,sid: str):
+        '''
+            Returns:
+                (data, expires_at), None when there is no such live session
+        '''
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._sessions[sid]
+                return None
+            return json.loads(entry[1]),entry[0]
+
+    def save(self,sid: str,data: dict,lifetime: float) -> None:
+        with self._lock:
+            self._sessions[sid] = (time.time() + lifetime,json.dumps(data))
+            # expired sessions are dropped on writes so memory stays bounded by live sessions
+            if len(self._sessions) % 256 == 0:
+                now = time.time()
+                for key in [key for key,(expires_at,_) in self._sessions.items() if expires_at < now]:
+                    del self._sessions[key]
+
+    def delete(self,sid: str) -> None:
+        with self._lock:
+            self._sessions.pop(sid,None)
+
+
+class FileSessionStore:
+    def __init__(self,directory: str):
+        '''
+            One json file per session, shared by every worker process on the host.
+            Expired files are dropped when read or by purge_expired().
+        '''
+        self.directory = directory
+        os.makedirs(directory,exist_ok=True)
+
+    def _path(self,sid: str) -> str:
+        return os.path.join(self.directory,sid)
+
+    def load(self,sid: str):
+        '''
+            Returns:
+                (data, expires_at), None when there is no such live session
+        '''
+        path = self._path(sid)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError,ValueError):
+            return None
+        if entry['expires_at'] < time.time():
+            self.delete(sid)
+            return None
+        return entry['data'],entry['expires_at']
+
+    def save(self,sid: str,data: dict,lifetime: float) -> None:
+        path = self._path(sid)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp,'w') as f:
+            json.dump({'expires_at':time.time() + lifetime,'data':data},f)
+        os.replace(tmp,path)
+
+    def delete(self,sid: str) -> None:
+        try:
+            os.remove(self._path(sid))
+        except OSError:
+            pass
+
+    def purge_expired(self) -> None:
+        now = time.time()
+        for sid in os.listdir(self.directory):
+            if sid.endswith('.tmp'):
+                continue
+            try:
+                with open(self._path(sid)) as f:
+                    expired = json.load(f)['expires_at'] < now
+            except (OSError,ValueError,KeyError):
+                expired = True
+            if expired:
+                self.delete(sid)
+
+
+class ServerSideSessionInterface(SessionInterface):
+    def __init__(self,store,lifetime: float = 7*24*3600):
+        '''
+            Keeps session data in the given store, the cookie only carries a random session id
+            Args:
+                store: MemorySessionStore or FileSessionStore
+                lifetime: seconds a session lives after its last write. A session
+                    read in the second half of its lifetime is written again, so
+                    active users are not logged out.
+        '''
+        self.store = store
+        self.lifetime = lifetime
+
+    def open_session(self,app,request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        # the id is used as a file name by FileSessionStore, so only accept ids we could have issued
+        if sid and _SID_RE.fullmatch(sid):
+            entry = self.store.load(sid)
+            if entry is not None:
+                data,expires_at = entry
+                return ServerSideSession(data,sid=sid,expires_at=expires_at)
+        return ServerSideSession(sid=secrets.token_urlsafe(32),new=True)
+
+    def save_session(self,app,session,response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name,domain=domain,path=path)
+            return
+
+        if not session.new and session.get('user_id') != session.stored.get('user_id'):
+            # logging in or out gets a new id, so an id planted before login is of no use
+            self.store.delete(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+        elif not session.new and dict(session) == session.stored \
+                and session.expires_at - time.time() > self.lifetime/2:
+            return
+
+        self.store.save(session.sid,dict(session),self.lifetime)
+        response.set_cookie(name,session.sid,
+                            max_age=int(self.lifetime),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain,path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
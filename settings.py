@@ -1,4 +1,48 @@
 USERNAME = 'root'
 PASSWORD = 'Shy@m1234'
 DBNAME = 'recipe_management'
-HOST = 'localhost'
\ No newline at end of file
+HOST = 'localhost'
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 16
+POOL_TIMEOUT = 10
+
+# keep each user's liked recipes/meal plans in the catalog cache; invalidation is
+# not shared across workers, so with several processes a like shows up in the
+# others only after CACHE_TTL. Only enable it when a single process serves the site
+CACHE_USER_LIKES = False
+
+CACHE_MAX_ENTRIES = 4096
+CACHE_TTL = 600 # seconds
+FRAGMENT_CACHE_ENTRIES = 8192 # rendered recipe cards, ingredient lists, steps and reviews
+
+TRENDS_REFRESH_INTERVAL = 300 # seconds between checks for changed trend data
+
+SESSION_STORE = 'file' # shared by the worker processes of a host, 'memory' only works with a single process
+SESSION_DIR = 'flask_session'
+SESSION_LIFETIME = 7*24*3600 # seconds
+
+PAGE_SIZE = 24 # recipes per page of search, cuisine and category results
+MAX_PAGE_SIZE = 96
+AUTOCOMPLETE_LIMIT = 8 # suggestions per keystroke
+MAX_AUTOCOMPLETE_LIMIT = 20
+MAX_SHOPPING_LIST_RECIPES = 100 # recipes one shopping list can combine, a week of meal plans is 28
+MAX_SHOPPING_LIST_DAYS = 31
+
+LOG_LEVEL = 'INFO'
+SLOW_QUERY_MS = 100 # queries slower than this are logged
+DEBUG_QUERIES_ENDPOINT = False # serve query and route latency histograms at /debug/queries
+
+INGEST_WORKERS = 8 # concurrent page downloads of ingest.py
+INGEST_PROCESSES = None # processes parsing pages, None for one per cpu
+INGEST_BATCH_SIZE = 200 # recipes per upsert transaction
+INGEST_MANIFEST = 'ingest_manifest.json' # page hashes of the last ingest, for incremental runs
+
+CATALOG_SNAPSHOT_DIR = None # directory of catalog_snapshot.py exports the workers map, None reads the database
+SNAPSHOT_CHECK_INTERVAL = 5 # seconds between checks for a newly published snapshot
+
+WRITE_BEHIND = False # queue likes and reviews and write them in batches from a background thread
+WRITE_BEHIND_MAX_PENDING = 1000 # queued writes before likes and reviews block, then write synchronously
+WRITE_BEHIND_BATCH_SIZE = 200
+WRITE_BEHIND_INTERVAL = 0.5 # seconds a queued write waits at most
+WRITE_BEHIND_JOURNAL_DIR = 'write_behind' # queued writes are journaled here until written
+WRITE_BEHIND_FSYNC = False # fsync the journal on every write
@@ -0,0 +1,73 @@
+import catalog_snapshot
+from catalog_snapshot import SharedCatalog, build_sections, publish
+from db_connections import RecipeDb
+
+
+def recipe(name: str,vegan: int,ingredients: list) -> dict:
+    return {'recipe_name':name,'tagline':f'{name} tagline','rating':4.0,'preparation_time':10,
+            'cooking_time':20,'vegan':vegan,'gluten_free':0,'vegetarian':vegan,'eggetarian':0,
+            'cuisine_name':'italian','ingredients':ingredients}
+
+def ingredient(name: str) -> dict:
+    return {'ingredient_name':name,'calories':10.0,'protein':1.0,'fats':1.0,'carbs':1.0,'sugar':0.0,
+            'measurement':'cup','image_link':None}
+
+
+class Catalog:
+    '''
+        Stands in for Connection over an in-memory catalog, and publishes it as
+        a snapshot like ingest.py does
+    '''
+    def __init__(self,directory: str):
+        self.error = False
+        self.directory = directory
+        self.recipes = []
+        self.queries = []
+
+    def connect(self,dbname):
+        pass
+
+    def execute_query(self,query,args=()):
+        self.queries.append(query)
+        if query.startswith('SELECT recipe_name,ingredient_name FROM recipe_ingredients'):
+            return [{'recipe_name':row['recipe_name'],'ingredient_name':name}
+                    for row in self.recipes for name in row['ingredients']]
+        if 'FROM recipes' in query:
+            rows = [{k:v for k,v in row.items() if k != 'ingredients'} for row in self.recipes]
+            if 'WHERE r.recipe_name = %s' in query: # the recipe page of a recipe not in the snapshot
+                rows = [{**row,'like_count':0} for row in rows if row['recipe_name'].casefold() == args[0].casefold()]
+            return rows
+        return []
+
+    def publish(self) -> None:
+        rows = [{k:v for k,v in row.items() if k != 'ingredients'} for row in self.recipes]
+        names = sorted({name for row in self.recipes for name in row['ingredients']})
+        publish(self.directory,build_sections(
+            rows,[ingredient(name) for name in names],[],[],[],
+            [{'recipe_name':row['recipe_name'],'ingredient_name':name,'quantity':'1'}
+             for row in self.recipes for name in row['ingredients']]))
+
+
+def test_readers_see_a_newly_published_snapshot(tmp_path):
+    catalog = Catalog(str(tmp_path))
+    catalog.recipes = [recipe('Pasta',1,['flour','water'])]
+    catalog.publish()
+    recipe_db = RecipeDb('recipe_hub',catalog,snapshot=SharedCatalog(str(tmp_path),check_interval=0))
+
+    assert recipe_db.get_recipe_page('pasta')['ingredients'][0]['ingredient_name'] == 'flour'
+    assert recipe_db.get_recipe_page('pizza') == []
+    assert recipe_db.search_index.search('pizza') == []
+    assert recipe_db.dietary_masks.mask_of('Pizza') == 0
+
+    # another process ingests a recipe and publishes the catalog
+    catalog.recipes.append(recipe('Pizza',0,['flour','tomato']))
+    catalog.publish()
+    assert catalog_snapshot.current_version(str(tmp_path)) == 2
+
+    catalog.queries.clear()
+    page = recipe_db.get_recipe_page('Pizza')
+    assert page['recipe_name'] == 'Pizza'
+    assert [row['ingredient_name'] for row in page['ingredients']] == ['flour','tomato']
+    assert all('recipe_stats' in query for query in catalog.queries) # only the like count
+    assert recipe_db.search_index.search('pizza') == ['Pizza']
+    assert recipe_db.dietary_masks.mask_of('Pizza') != 0
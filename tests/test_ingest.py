@@ -0,0 +1,88 @@
+import os
+from contextlib import contextmanager
+
+from db_connections import RecipeDb
+from ingest import Manifest, directory_pages, ingest
+
+
+def recipe_page(name: str,ingredients: list) -> str:
+    items = ''.join(f'<li><p><span>{quantity}</span><span>cup</span><span>{ingredient}</span></p></li>'
+                    for quantity,ingredient in ingredients)
+    return f'''<html><body>
+        <img src="logo.png"><img src="https://example.com/{name}.jpg">
+        <h1 id="article-heading_1-0">{name}</h1>
+        <p id="article-subheading_1-0">A saved page</p>
+        <div id="mntl-recipe-review-bar__rating_1-0">4.6</div>
+        <div class="mntl-recipe-details__value">15 mins</div>
+        <div class="mntl-recipe-details__value">1 hr 10 mins</div>
+        <ul class="mntl-structured-ingredients__list">{items}</ul>
+        <div id="recipe__steps-content_1-0"><ol><li><p>Cook it.</p></li></ol></div>
+    </body></html>'''
+
+
+class RecordingCursor:
+    def __init__(self,statements: list):
+        self.statements = statements
+
+    def execute(self,query,args=()):
+        self.statements.append((query,list(args)))
+
+    def executemany(self,query,args):
+        args = list(args)
+        self.statements.append((query,args))
+        return len(args) or None # like pymysql, None for no rows
+
+
+class RecordingConnection:
+    '''
+        Stands in for Connection, records the statements of upsert_recipes
+    '''
+    def __init__(self):
+        self.error = False
+        self.statements = []
+
+    def connect(self,dbname):
+        pass
+
+    @contextmanager
+    def transaction(self):
+        yield RecordingCursor(self.statements)
+
+    def execute_query(self,query,args=()):
+        return []
+
+    def rows(self,table: str) -> list:
+        return [row for query,args in self.statements if f'INSERT IGNORE INTO {table} ' in query for row in args]
+
+
+def test_ingests_saved_pages_offline(tmp_path):
+    os.makedirs(tmp_path / 'indian' / 'main-dishes' / 'rice')
+    (tmp_path / 'indian' / 'main-dishes' / 'rice' / 'butter-chicken.html').write_text(
+        recipe_page('Butter Chicken',[('2','chicken thighs'),('1','butter')]),encoding='utf8')
+    # saved straight under --pages, there is no listing to take a cuisine from
+    (tmp_path / 'pancakes.html').write_text(recipe_page('Pancakes',[('1','flour'),('2','milk')]),encoding='utf8')
+    (tmp_path / 'not-a-recipe.html').write_text('<html><body><p>Sign in</p></body></html>',encoding='utf8')
+
+    conn = RecordingConnection()
+    manifest = Manifest(str(tmp_path / 'manifest.json'))
+    stats = ingest(directory_pages(str(tmp_path),manifest,workers=2,processes=0),
+                   RecipeDb('recipe_hub',conn),manifest,batch_size=10)
+
+    assert stats['pages'] == 3
+    assert stats['changed'] == 2
+    assert stats['dropped'] == 1
+    assert stats['recipes'] == 2
+    assert conn.rows('cuisines') == ['indian']
+    recipes = {row[0]:row for query,args in conn.statements if 'INTO recipes ' in query for row in args}
+    assert recipes['Butter Chicken'][-1] == 'indian'
+    assert recipes['Pancakes'][-1] is None
+    assert recipes['Pancakes'][3:5] == (15,70)
+    assert sorted(conn.rows('ingredients')) == ['butter','chicken thighs','flour','milk']
+    assert ('Butter Chicken','Main Course') in conn.rows('recipes_to_categories')
+
+    # nothing changed, a second run writes nothing
+    conn.statements.clear()
+    stats = ingest(directory_pages(str(tmp_path),Manifest(manifest.path),workers=2,processes=0),
+                   RecipeDb('recipe_hub',conn),Manifest(manifest.path))
+    assert stats['unchanged'] == 2
+    assert conn.statements == []
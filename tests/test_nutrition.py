@@ -0,0 +1,24 @@
+import pytest
+
+from nutrition import DEFAULT_QUANTITY, NutritionIndex, parse_quantity
+
+
+@pytest.mark.parametrize('text,expected',[
+    ('2',2.0),('0.2',0.2),('½',0.5),('1 ½',1.5),('1½',1.5),('1/2',0.5),('1 1/2',1.5),('1-2',1.0),
+    ('',None),(None,None),('pinch',None),
+    # a zero denominator is unreadable, not a division error
+    ('1/0',None),('0/0',None),('1 1/0',None),
+])
+def test_parse_quantity(text,expected):
+    if expected is None:
+        assert parse_quantity(text) is None
+    else:
+        assert parse_quantity(text) == pytest.approx(expected)
+
+def test_unreadable_quantity_counts_as_default():
+    index = NutritionIndex.build(
+        [{'recipe_name':'Pancakes','ingredient_name':'flour','quantity':'1/0'},
+         {'recipe_name':'Pancakes','ingredient_name':'milk','quantity':'2'}],
+        [{'ingredient_name':'flour','calories':100,'protein':3,'fats':1,'carbs':20,'sugar':0},
+         {'ingredient_name':'milk','calories':50,'protein':3,'fats':2,'carbs':5,'sugar':5}])
+    assert index.recipe_totals('Pancakes')['calories'] == pytest.approx(100*DEFAULT_QUANTITY + 2*50)
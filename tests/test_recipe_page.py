@@ -0,0 +1,55 @@
+import pytest
+
+from db_connections import RecipeDb
+
+
+class CountingConnection:
+    '''
+        Stands in for Connection, answers the recipe page queries from memory
+        and counts them
+    '''
+    def __init__(self,ingredient_count: int):
+        self.error = False
+        self.queries = []
+        self.recipe = {'recipe_name':'Butter Chicken','rating':4.5,'preparation_time':20,'cooking_time':40}
+        self.ingredients = [
+            {'ingredient_name':f'ingredient {i}','quantity':'1 cup','calories':10,'protein':1,'fats':1,
+             'carbs':1,'sugar':0,'measurement':'cup','image_link':None}
+            for i in range(ingredient_count)
+        ]
+
+    def connect(self,dbname):
+        pass
+
+    def execute_query(self,query,args=()):
+        self.queries.append(query)
+        if 'FROM recipes r' in query:
+            return [{**self.recipe,'like_count':3}] if args[0].casefold() == 'butter chicken' else []
+        if 'UNION ALL' in query:
+            return [{'kind':'category','step_number':None,'value':'Indian'},
+                    {'kind':'image','step_number':None,'value':'butter_chicken.jpg'},
+                    {'kind':'step','step_number':1,'value':'Cook it'}]
+        if 'FROM recipe_ingredients' in query:
+            return [dict(row) for row in self.ingredients]
+        raise AssertionError(f'unexpected query {query}')
+
+
+@pytest.mark.parametrize('ingredient_count',[1,10,200])
+def test_recipe_page_takes_at_most_three_queries(ingredient_count):
+    conn = CountingConnection(ingredient_count)
+    recipe_db = RecipeDb('recipe_hub',conn)
+
+    page = recipe_db.get_recipe_page('butter chicken')
+    assert len(conn.queries) <= 3
+    assert len(page['ingredients']) == ingredient_count
+    assert len(page['ingredient_details']) == ingredient_count
+    assert page['like_count'] == 3
+    assert page['images'] == [{'recipe_name':'Butter Chicken','recipe_image':'butter_chicken.jpg'}]
+    assert page['total_time'] == recipe_db.get_recipe_page('Butter Chicken')['total_time']
+    assert len(conn.queries) <= 3 # the second page came from the cache
+
+def test_missing_recipe_page():
+    conn = CountingConnection(5)
+    recipe_db = RecipeDb('recipe_hub',conn)
+    assert recipe_db.get_recipe_page('no such recipe') == []
+    assert len(conn.queries) == 1
@@ -0,0 +1,150 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from write_behind import WriteBehind
+
+
+class FakeApply:
+    '''
+        Records the batches it is called with, can be held inside a call or
+        made to fail
+    '''
+    def __init__(self,fail_first: int = 0,hold: bool = False):
+        self.batches = []
+        self.fail_first = fail_first
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        if not hold:
+            self.release.set()
+
+    def __call__(self,ops):
+        self.batches.append(list(ops))
+        self.entered.set()
+        self.release.wait(5)
+        if len(self.batches) <= self.fail_first:
+            raise RuntimeError('database is down')
+
+    @property
+    def ops(self):
+        return [op for batch in self.batches for op in batch]
+
+
+def op(name,value):
+    return {'kind':'like_recipe','user_id':1,'name':name,'liked':value}
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable,'-c','pass'])
+    process.wait()
+    return process.pid
+
+
+def test_coalesces_writes_to_one_key():
+    apply = FakeApply()
+    queue = WriteBehind(apply,batch_size=100,interval=60)
+    for value in (True,False,True):
+        assert queue.submit(('like_recipe',1,'a'),op('a',value))
+    assert queue.submit(('like_recipe',1,'b'),op('b',True))
+    assert queue.get(('like_recipe',1,'a'))['liked'] is True
+
+    assert queue.flush(5)
+    assert apply.ops == [op('a',True),op('b',True)]
+    assert queue.stats()['coalesced'] == 2
+    queue.stop()
+
+def test_full_queue_blocks_then_rejects():
+    apply = FakeApply(hold=True)
+    queue = WriteBehind(apply,max_pending=1,batch_size=1,interval=60,block_timeout=0.2)
+    assert queue.submit(('like_recipe',1,'a'),op('a',True))
+    assert apply.entered.wait(5) # the worker is writing a, so b fills the queue
+    assert queue.submit(('like_recipe',1,'b'),op('b',True))
+
+    start = time.monotonic()
+    assert not queue.submit(('like_recipe',1,'c'),op('c',True))
+    assert time.monotonic() - start >= 0.2
+    # a write to a queued key still fits
+    assert queue.submit(('like_recipe',1,'b'),op('b',False))
+    assert queue.stats()['rejected'] == 1
+
+    apply.release.set()
+    assert queue.flush(5)
+    assert apply.ops == [op('a',True),op('b',False)]
+    queue.stop()
+
+def test_replays_journal_with_torn_last_line(tmp_path):
+    journal = tmp_path / f'write_behind-{dead_pid()}.jsonl'
+    with open(journal,'w',encoding='utf8') as f:
+        for name in ('a','b'):
+            f.write(json.dumps({'key':['like_recipe',1,name],'op':op(name,True)}) + '\n')
+        f.write('{"key": ["like_recipe", 1, "c"], "op": {"ki')
+
+    apply = FakeApply()
+    queue = WriteBehind(apply,interval=60,journal_dir=str(tmp_path))
+    assert queue.submit(('like_recipe',1,'d'),op('d',True))
+    assert queue.flush(5)
+    assert apply.ops == [op('a',True),op('b',True),op('d',True)]
+    assert not journal.exists()
+
+    queue.stop()
+    assert os.listdir(tmp_path) == []
+
+def test_retries_failed_batch_with_newer_writes_winning():
+    apply = FakeApply(fail_first=1,hold=True)
+    queue = WriteBehind(apply,batch_size=1,interval=0.01)
+    assert queue.submit(('like_recipe',1,'a'),op('a',True))
+    assert apply.entered.wait(5)
+    # queued while the first attempt is being written, and then fails
+    assert queue.submit(('like_recipe',1,'a'),op('a',False))
+    assert queue.submit(('like_recipe',1,'b'),op('b',True))
+    apply.release.set()
+
+    assert queue.flush(5)
+    assert apply.batches[0] == [op('a',True)]
+    assert apply.ops[1:] == [op('a',False),op('b',True)]
+    assert queue.stats()['failures'] == 1
+    queue.stop()
+
+def test_flush_gives_up_while_database_is_down():
+    apply = FakeApply(fail_first=1000)
+    queue = WriteBehind(apply,interval=0.01)
+    assert queue.submit(('like_recipe',1,'a'),op('a',True))
+    assert not queue.flush(0.2)
+    assert queue.get(('like_recipe',1,'a')) == op('a',True)
+    queue.stop(0.5)
+
+def test_journal_keeps_writes_submitted_while_it_is_rewritten(tmp_path,monkeypatch):
+    second = threading.Event()
+    applied = []
+    def apply(ops):
+        applied.append(ops)
+        if len(applied) == 2:
+            second.wait(5)
+
+    queue = WriteBehind(apply,batch_size=1,interval=60,journal_dir=str(tmp_path))
+    fsync = os.fsync
+    submitted = []
+    def submitting_fsync(fd):
+        # the worker rewrites the journal without the lock, a request submits meanwhile
+        if threading.current_thread().name == 'write-behind' and not submitted:
+            submitted.append(queue.submit(('like_recipe',1,'b'),op('b',True)))
+        fsync(fd)
+    monkeypatch.setattr(os,'fsync',submitting_fsync)
+
+    assert queue.submit(('like_recipe',1,'a'),op('a',True))
+    deadline = time.monotonic() + 5
+    while len(applied) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert submitted == [True]
+    # a is written and compacted away, b is being written and still journaled
+    journal = tmp_path / f'write_behind-{os.getpid()}.jsonl'
+    records = [json.loads(line) for line in journal.read_text(encoding='utf8').splitlines()]
+    assert records == [{'key':['like_recipe',1,'b'],'op':op('b',True)}]
+
+    second.set()
+    assert queue.flush(5)
+    assert applied == [[op('a',True)],[op('b',True)]]
+    queue.stop()
+    assert os.listdir(tmp_path) == []
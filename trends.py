@@ -0,0 +1,144 @@
+import hashlib
+import importlib
+import logging
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+
+
+log = logging.getLogger('recipe_hub.trends')
+
+# chart name -> (graphs_drawer function, image shipped in static/ until the first render)
+CHARTS = {
+    'user_counts_per_preference': ('save_user_counts_plot_as_image','user_counts_per_preference.png'),
+    'most_liked_cuisines': ('plot_most_liked_cuisines','most_liked_cuisines.png'),
+    'top_rated_recipes': ('plot_rating_distribution','top_rated_recipes.png'),
+}
+
+# an image no worker used for this many refresh intervals is deleted
+UNUSED_INTERVALS = 2
+
+def data_digest(*args) -> str:
+    digest = hashlib.sha1()
+    for arg in args:
+        arg = np.asarray(arg)
+        digest.update(arg.dtype.str.encode())
+        digest.update(arg.tobytes())
+    return digest.hexdigest()[:16]
+
+
+class TrendsRefresher:
+    def __init__(self,recipe_db,static_dir: str = 'static',interval: float = 300.0):
+        '''
+            Renders the /trends charts on a background thread. Charts are only
+            re-rendered when their input aggregates change, and each image is
+            written atomically under a name derived from a hash of its data, so
+            requests never see a half-written file. Every worker process touches
+            the images it serves on each refresh, and images none of them touched
+            for UNUSED_INTERVALS intervals are deleted.
+            Args:
+                recipe_db: RecipeDb the aggregates are read from
+                static_dir: the Flask static folder, images go to its charts/ subfolder
+                interval: seconds between checks of the aggregates
+        '''
+        self.recipe_db = recipe_db
+        self.static_dir = static_dir
+        self.charts_dir = os.path.join(static_dir,'charts')
+        self.interval = interval
+        self._images = {name:fallback for name,(_,fallback) in CHARTS.items()}
+        self._lock = threading.Lock()
+        self._render_lock = threading.Lock() # pyplot keeps global state
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def images(self) -> dict:
+        '''
+            Chart name -> path of its latest image, relative to the static folder
+        '''
+        with self._lock:
+            return dict(self._images)
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,name='trends-refresher',daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                log.exception('trend charts refresh failed')
+            self._stop.wait(self.interval)
+
+    def refresh(self) -> None:
+        '''
+            Reads the aggregates and renders the charts whose data changed
+        '''
+        os.makedirs(self.charts_dir,exist_ok=True)
+        # before reading the aggregates, a worker that cannot read them keeps serving its images
+        for image in self.images.values():
+            self._touch(image)
+
+        stats = self.recipe_db.get_trend_statistics()
+        data = {
+            'user_counts_per_preference': self.recipe_db.get_user_count_by_preference(stats),
+            'most_liked_cuisines': self.recipe_db.get_most_liked_cuisines(stats),
+            'top_rated_recipes': self.recipe_db.get_rating_distribution(stats),
+        }
+        for name,args in data.items():
+            filename = f'{name}-{data_digest(*args)}.png'
+            if not self._touch(f'charts/{filename}'):
+                self._render(name,args,filename)
+            with self._lock:
+                self._images[name] = f'charts/{filename}'
+        self._remove_unused()
+
+    def _render(self,name: str,args: tuple,filename: str) -> None:
+        # matplotlib, seaborn and pandas are only imported by the first render,
+        # so processes that never serve /trends do not pay for them
+        graphs_drawer = importlib.import_module('graphs_drawer')
+        plot = getattr(graphs_drawer,CHARTS[name][0])
+        tmp = f'.{uuid.uuid4().hex}-{filename}'
+        with self._render_lock:
+            plot(*args,filename=tmp,directory=self.charts_dir)
+        os.replace(os.path.join(self.charts_dir,tmp),os.path.join(self.charts_dir,filename))
+
+    def _touch(self,image: str) -> bool:
+        '''
+            Marks an image as in use, False when there is no such image
+        '''
+        if not image.startswith('charts/'):
+            return True # shipped in static/
+        try:
+            os.utime(os.path.join(self.static_dir,image))
+        except OSError:
+            return False
+        return True
+
+    def _remove_unused(self) -> None:
+        '''
+            Deletes the images, and renders left behind by a crash, that no worker
+            touched for UNUSED_INTERVALS refresh intervals. Other workers may still
+            serve an image this one replaced, until their next refresh.
+        '''
+        current = set(self.images.values())
+        oldest = time.time() - UNUSED_INTERVALS*self.interval
+        for filename in os.listdir(self.charts_dir):
+            if f'charts/{filename}' in current or not filename.endswith('.png'):
+                continue
+            path = os.path.join(self.charts_dir,filename)
+            try:
+                if os.path.getmtime(path) < oldest:
+                    os.remove(path)
+            except OSError:
+                pass # removed by another worker
@@ -0,0 +1,363 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
+
+log = logging.getLogger('recipe_hub.db')
+
+MAX_RETRY_DELAY = 30 # seconds between attempts while the database keeps failing
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _reset_in_child(ref) -> None:
+    # the forked child has a copy of the parent's queue and journal file, and
+    # its lock may have been held by a thread that does not exist in the child
+    queue = ref()
+    if queue is None:
+        return
+    if queue._journal is not None:
+        queue._journal.close()
+    queue._reset()
+
+
+class WriteBehind:
+    def __init__(self,apply,max_pending: int = 1000,batch_size: int = 200,interval: float = 0.5,
+                 journal_dir: str = None,fsync: bool = False,block_timeout: float = 1.0):
+        '''
+            Queues writes in memory and applies them in batches from a background
+            thread. Writes are keyed, e.g. ("like_recipe", user_id, folded name),
+            and a newer write to a key replaces the queued one, so a burst of
+            toggles ends up as one row change.
+            Args:
+                apply: called with a list of ops from the worker thread, writes them
+                    in one transaction and raises when it could not
+                max_pending: queued keys before submit blocks, see submit
+                batch_size: a batch is written once this many keys are queued ...
+                interval: ... or once the oldest queued write is this many seconds old
+                journal_dir: every accepted write is appended to a journal file of
+                    this process in this directory first. The journals of processes
+                    that died before writing their queue are replayed by the first
+                    write of a process.
+                fsync: fsync the journal on every write, survives power loss rather
+                    than only a crashed process
+                block_timeout: seconds submit waits for room in a full queue
+        '''
+        self.apply = apply
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.interval = interval
+        self.journal_dir = journal_dir
+        self.fsync = fsync
+        self.block_timeout = block_timeout
+        self._reset()
+        # the queue is per process: a worker forked from a process that created
+        # it, e.g. by gunicorn --preload, starts its own on its first write
+        os.register_at_fork(after_in_child=functools.partial(_reset_in_child,weakref.ref(self)))
+
+    def _reset(self) -> None:
+        self._pending = {} # key -> op, insertion ordered so the oldest writes go first
+        self._in_flight = {} # key -> op of the batch being written, still visible to readers
+        self._oldest = None # monotonic time the oldest pending write was queued
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._counts = dict.fromkeys(('submitted','coalesced','written','batches','rejected','failures'),0)
+        self._pid = None # process the worker thread and journal belong to
+        self._thread = None
+        self._journal = None
+        self._journal_path = None
+        self._journal_tail = None # records appended while the journal is being rewritten
+
+    def _ensure_started(self) -> None:
+        '''
+            Opens the journal and starts the worker thread on the first write of
+            this process. Called holding the condition.
+        '''
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        if self.journal_dir:
+            os.makedirs(self.journal_dir,exist_ok=True)
+            self._journal_path = os.path.join(self.journal_dir,f'write_behind-{pid}.jsonl')
+            replayed = self._recover(self.journal_dir)
+            self._journal = open(self._journal_path,'a',encoding='utf8')
+            self._compact()
+            for path in replayed:
+                os.remove(path)
+        self._thread = threading.Thread(target=self._run,name='write-behind',daemon=True)
+        self._thread.start()
+        self._pid = pid
+
+    def _recover(self,journal_dir: str) -> list:
+        '''
+            Queues the writes of journals left behind by processes that are gone
+            Returns:
+                the claimed journal paths, removed once their writes are in ours
+        '''
+        claimed = []
+        pid = os.getpid()
+        for entry in sorted(os.listdir(journal_dir)):
+            # write_behind-<pid>.jsonl, or <that>.<pid>.replay once a process claimed it
+            if not entry.startswith('write_behind-'):
+                continue
+            if entry.endswith('.jsonl'):
+                owner = entry[len('write_behind-'):-len('.jsonl')]
+            elif entry.endswith('.replay'):
+                owner = entry.split('.')[-2]
+            else:
+                continue
+            if not owner.isdigit() or (int(owner) != pid and _pid_alive(int(owner))):
+                continue
+            path = os.path.join(journal_dir,entry)
+            # renaming claims it, two starting workers cannot both replay one journal
+            claim = path if entry.endswith(f'.{pid}.replay') else f'{path}.{pid}.replay'
+            try:
+                os.rename(path,claim)
+            except FileNotFoundError:
+                continue
+            claimed.append(claim)
+
+        for path in claimed:
+            with open(path,encoding='utf8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break # a torn last line of a crashed process
+                    self._pending[tuple(record['key'])] = record['op']
+        if self._pending:
+            self._oldest = time.monotonic()
+            log.info('replaying queued writes',extra={'writes':len(self._pending),'journals':len(claimed)})
+        return claimed
+
+    def _append(self,key: tuple,op: dict) -> None:
+        if self._journal is None:
+            return
+        record = json.dumps({'key':key,'op':op}) + '\n'
+        self._journal.write(record)
+        self._journal.flush()
+        if self._journal_tail is not None:
+            self._journal_tail.append(record)
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    def _compact(self) -> None:
+        '''
+            Rewrites the journal with only the writes still queued or being written
+        '''
+        if self._journal is None:
+            return
+        temporary = self._journal_path + '.tmp'
+        with open(temporary,'w',encoding='utf8') as f:
+            for key,op in list(self._in_flight.items()) + list(self._pending.items()):
+                f.write(json.dumps({'key':key,'op':op}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal.close()
+        os.replace(temporary,self._journal_path)
+        self._journal = open(self._journal_path,'a',encoding='utf8')
+
+    def _rewrite_journal(self) -> None:
+        '''
+            Compacts the journal from the worker thread after a batch was written.
+            Unlike _compact the file is written and fsynced without holding the
+            condition, so submit, get and ops do not wait for the disk; records
+            appended meanwhile are copied over at the end.
+        '''
+        with self._condition:
+            live = list(self._in_flight.items()) + list(self._pending.items())
+            if self._journal is None:
+                return
+            self._journal_tail = []
+        # only this thread takes batches, so nothing but submit changes the queue meanwhile
+        temporary = self._journal_path + '.tmp'
+        f = open(temporary,'w',encoding='utf8')
+        try:
+            for key,op in live:
+                f.write(json.dumps({'key':key,'op':op}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            with self._condition:
+                tail,self._journal_tail = self._journal_tail,None
+                f.writelines(tail)
+                f.flush()
+                if tail:
+                    os.fsync(f.fileno())
+                f.close()
+                if self._journal is None:
+                    os.remove(temporary) # stop gave up waiting and compacted the journal itself
+                    return
+                self._journal.close()
+                os.replace(temporary,self._journal_path)
+                self._journal = open(self._journal_path,'a',encoding='utf8')
+        finally:
+            # the old journal stays complete when the rewrite failed
+            f.close()
+            with self._condition:
+                self._journal_tail = None
+
+    def submit(self,key: tuple,op: dict) -> bool:
+        '''
+            Queues op under key, replacing a queued op with the same key. When the
+            queue is full waits up to block_timeout for the worker to make room.
+            Returns:
+                False when the queue stayed full, the caller then writes synchronously
+        '''
+        with self._condition:
+            if self._stopping:
+                return False
+            self._ensure_started()
+            if key not in self._pending and len(self._pending) >= self.max_pending:
+                self._condition.notify_all() # writes a batch now rather than at the interval
+                deadline = time.monotonic() + self.block_timeout
+                while len(self._pending) >= self.max_pending and not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counts['rejected'] += 1
+                        return False
+                    self._condition.wait(remaining)
+            if self._stopping:
+                return False
+            self._append(key,op)
+            self._counts['submitted'] += 1
+            if key in self._pending:
+                self._counts['coalesced'] += 1
+                del self._pending[key] # re-queued at the end, as the newest write
+            self._pending[key] = op
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify_all()
+        return True
+
+    def get(self,key: tuple):
+        '''
+            The queued or in-flight op of key, None when there is none
+        '''
+        with self._condition:
+            op = self._pending.get(key)
+            return op if op is not None else self._in_flight.get(key)
+
+    def ops(self,kind: str,user_id: int = None,item: str = None) -> dict:
+        '''
+            Queued and in-flight ops of a kind, optionally of one user or one item
+            Returns:
+                key -> op, the newest op of each key
+        '''
+        with self._condition:
+            found = {}
+            for ops in (self._in_flight,self._pending):
+                for key,op in ops.items():
+                    if key[0] == kind and (user_id is None or key[1] == user_id) and (item is None or key[2] == item):
+                        found[key] = op
+            return found
+
+    def _take_batch(self) -> dict:
+        '''
+            Waits until a batch is due and moves it to in-flight, an empty dict
+            once stopping with nothing queued
+        '''
+        with self._condition:
+            while True:
+                if self._pending:
+                    due = self._oldest + self.interval
+                    if self._stopping or len(self._pending) >= self.batch_size or time.monotonic() >= due:
+                        break
+                    self._condition.wait(due - time.monotonic())
+                elif self._stopping:
+                    return {}
+                else:
+                    self._condition.wait()
+            keys = list(self._pending)[:self.batch_size]
+            self._in_flight = {key:self._pending.pop(key) for key in keys}
+            self._oldest = time.monotonic() if self._pending else None
+            self._condition.notify_all() # room for blocked submitters
+            return self._in_flight
+
+    def _run(self) -> None:
+        failures = 0
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            try:
+                self.apply(list(batch.values()))
+            except Exception:
+                failures += 1
+                log.exception('could not write queued writes',extra={'writes':len(batch),'attempt':failures})
+                with self._condition:
+                    self._counts['failures'] += 1
+                    # newer writes to the same keys were queued meanwhile and win
+                    self._pending = {**batch,**self._pending}
+                    self._in_flight = {}
+                    self._oldest = time.monotonic()
+                    if self._stopping:
+                        return # the journal keeps them for the next start
+                    self._condition.wait(min(self.interval*2**failures,MAX_RETRY_DELAY))
+                continue
+            failures = 0
+            with self._condition:
+                self._counts['written'] += len(batch)
+                self._counts['batches'] += 1
+                self._in_flight = {}
+                self._condition.notify_all()
+            try:
+                self._rewrite_journal()
+            except OSError:
+                log.exception('could not compact the write-behind journal')
+
+    def flush(self,timeout: float = 10.0) -> bool:
+        '''
+            Writes everything queued now
+            Args:
+                timeout: seconds to wait for the writes, None waits as long as
+                    the database keeps failing
+            Returns:
+                False when writes were still queued after timeout seconds
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            if self._pid != os.getpid():
+                return True # nothing was queued by this process
+            if self._pending:
+                self._oldest = time.monotonic() - self.interval # due now
+            self._condition.notify_all()
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stop(self,timeout: float = 10.0) -> None:
+        '''
+            Writes what is queued and stops the worker, writes it could not
+            make stay in the journal
+        '''
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+            if self._pid != os.getpid():
+                return
+        self._thread.join(timeout)
+        with self._condition:
+            if self._journal is not None:
+                self._compact()
+                self._journal.close()
+                self._journal = None
+                if not self._pending and not self._in_flight:
+                    os.remove(self._journal_path)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {**self._counts,'pending':len(self._pending),'in_flight':len(self._in_flight)}